@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in for clamd on a local socket, for checking brunnhilde.py --clamd
+
+Answers VERSION, and SCAN within IDSESSION/END sessions, with clamd's
+null-terminated replies. A scanned file is FOUND if it contains EICAR,
+an ERROR if it contains CLAMD-ERROR or can't be read, and OK otherwise.
+Like clamd, it needs a full path: relative paths are an ERROR.
+With split_replies, each reply is sent in two pieces, so clients must
+buffer partial replies.
+
+Runs in the foreground on its own: python benchmarks/fake_clamd.py SOCKET
+
+Python 2.7
+"""
+
+import os
+import sys
+import threading
+import time
+try:
+	import SocketServer as socketserver
+except ImportError: # python 3
+	import socketserver
+
+version = b'ClamAV 0.99.2/23000/Thu Jan  1 00:00:00 2017'
+
+def scan_reply(path):
+	'''Return clamd's reply to scanning path'''
+	if not os.path.isabs(path): # clamd would look in its own working directory
+		return path + b': lstat() failed: No such file or directory. ERROR'
+	try:
+		with open(path, 'rb') as f:
+			data = f.read()
+	except (IOError, OSError):
+		return path + b': Can\'t open file or directory ERROR'
+	if b'CLAMD-ERROR' in data:
+		return path + b': Can\'t allocate memory ERROR'
+	if b'EICAR' in data:
+		return path + b': Eicar-Test-Signature FOUND'
+	return path + b': OK'
+
+class Handler(socketserver.BaseRequestHandler):
+
+	def send(self, reply):
+		if self.server.split_replies and len(reply) > 1:
+			self.request.sendall(reply[:len(reply) // 2])
+			time.sleep(0.001)
+			self.request.sendall(reply[len(reply) // 2:])
+		else:
+			self.request.sendall(reply)
+
+	def handle(self):
+		buffer = b''
+		session = False
+		request_id = 0
+		while True:
+			while b'\0' not in buffer:
+				data = self.request.recv(4096)
+				if not data:
+					return
+				buffer += data
+			command, buffer = buffer.split(b'\0', 1)
+			command = command[1:] # drop z prefix
+			with self.server.lock:
+				self.server.commands.append(command)
+			if command == b'IDSESSION':
+				session = True
+				continue
+			if command == b'END':
+				return
+			request_id += 1
+			if command == b'VERSION':
+				reply = version
+			elif command.startswith(b'SCAN '):
+				reply = scan_reply(command[5:])
+			else:
+				reply = command + b': Unknown command ERROR'
+			if session:
+				reply = b'%d: ' % request_id + reply
+			self.send(reply + b'\0')
+			if not session:
+				return
+
+class FakeClamd(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	'''Fake clamd listening on socket_path, recording commands received'''
+	daemon_threads = True
+
+	def __init__(self, socket_path, split_replies=False):
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		socketserver.UnixStreamServer.__init__(self, socket_path, Handler)
+		self.split_replies = split_replies
+		self.commands = []
+		self.lock = threading.Lock()
+
+	def start(self):
+		'''Serve in a background thread'''
+		thread = threading.Thread(target=self.serve_forever)
+		thread.daemon = True
+		thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+		os.remove(self.server_address)
+
+if __name__ == '__main__':
+	server = FakeClamd(sys.argv[1])
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		os.remove(sys.argv[1])
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generate synthetic Siegfried CSV output for benchmarking Brunnhilde
+
+Rows look like pronom-only `sf -csv -hash md5` output. The share of
+duplicate files, unidentified files and the spread of modified dates
+are controlled by options, and output is repeatable for a given seed.
+
+Python 2.7
+"""
+
+import argparse
+import csv
+import hashlib
+import random
+
+# siegfried csv header (pronom-only output)
+sf_header = ['filename', 'filesize', 'modified', 'errors', 'md5', 'namespace', 'id', 'format', 'version', 'mime', 'basis', 'warning']
+
+# identified formats, drawn with these weights
+formats = [
+	(40, ('x-fmt/111', 'Plain Text File', '', 'text/plain', 'extension match txt; text match ASCII')),
+	(20, ('fmt/18', 'Acrobat PDF 1.4 - Portable Document Format', '1.4', 'application/pdf', 'extension match pdf; byte match at [[0 8] [1064 5]]')),
+	(15, ('fmt/40', 'Microsoft Word Document', '97-2003', 'application/msword', 'extension match doc; byte match at [[0 8] [512 4]]')),
+	(10, ('fmt/43', 'JPEG File Interchange Format', '1.01', 'image/jpeg', 'extension match jpg; byte match at [[0 14]]')),
+	(8, ('fmt/11', 'Portable Network Graphics', '1.0', 'image/png', 'extension match png; byte match at [[0 16]]')),
+	(5, ('fmt/214', 'Microsoft Excel for Windows', '2007 onwards', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'extension match xlsx; container match with name [Content_Types].xml')),
+	(2, ('fmt/353', 'Tagged Image File Format', '', 'image/tiff', 'extension match tif; byte match at [[0 4]]')),
+]
+extensions = {'x-fmt/111': 'txt', 'fmt/18': 'pdf', 'fmt/40': 'doc', 'fmt/43': 'jpg', 'fmt/11': 'png', 'fmt/214': 'xlsx', 'fmt/353': 'tif'}
+
+def content(number):
+	'''Return md5 and size of distinct file content number'''
+	md5 = hashlib.md5(str(number)).hexdigest()
+	size = int(md5[:6], 16) % 2000000 # under 2 MB, derived from hash so copies match
+	return md5, size
+
+def generate(path, rows, duplicates=0.2, unknown=0.1, years=(1990, 2016), seed=1):
+	'''Write synthetic siegfried csv of given number of rows to path'''
+	rand = random.Random(seed)
+	choices = []
+	for weight, ident in formats:
+		choices.extend([ident] * weight)
+	distinct = 0
+	with open(path, 'wb') as f:
+		w = csv.writer(f)
+		w.writerow(sf_header)
+		for number in range(rows):
+			if distinct > 0 and rand.random() < duplicates: # copy of earlier content
+				md5, size = content(rand.randrange(distinct))
+			else:
+				md5, size = content(distinct)
+				distinct += 1
+			year = rand.randint(years[0], years[1])
+			modified = '%d-%02d-%02dT%02d:%02d:%02d-05:00' % (year, rand.randint(1, 12), rand.randint(1, 28),
+				rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59))
+			directory = '/accession/series%d/folder%d' % (number % 20, number % 5000)
+			if rand.random() < unknown:
+				filename = '%s/file%d.dat' % (directory, number)
+				w.writerow([filename, size, modified, '', md5, 'pronom', 'UNKNOWN', '', '', '', '', 'no match'])
+			else:
+				puid, format_name, version, mime, basis = rand.choice(choices)
+				filename = '%s/file%d.%s' % (directory, number, extensions[puid])
+				w.writerow([filename, size, modified, '', md5, 'pronom', puid, format_name, version, mime, basis, ''])
+
+def parse_years(value):
+	'''Parse year range like 1990-2016'''
+	begin, end = value.split('-')
+	return int(begin), int(end)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument("rows", help="Number of files", type=int)
+	parser.add_argument("output", help="Path of csv file to write")
+	parser.add_argument("--duplicates", help="Share of files that copy earlier content (default: 0.2)", type=float, default=0.2)
+	parser.add_argument("--unknown", help="Share of files with no format identification (default: 0.1)", type=float, default=0.1)
+	parser.add_argument("--years", help="Range of last modified years (default: 1990-2016)", type=parse_years, default=(1990, 2016))
+	parser.add_argument("--seed", help="Random seed (default: 1)", type=int, default=1)
+	args = parser.parse_args()
+	generate(args.output, args.rows, args.duplicates, args.unknown, args.years, args.seed)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark Brunnhilde's processing stages on synthetic Siegfried output
+
+For each size, a synthetic siegfried csv is generated (and kept for
+later runs), then an accession is processed in a fresh worker process
+with the stand-in sf and clamscan from benchmarks/fakebin on PATH.
+Wall time, CPU time and peak memory are recorded per stage and written
+as JSON, optionally compared against an earlier results file.
+
+Runs offline. Peak memory per stage needs Linux /proc; elsewhere the
+process-wide peak is reported.
+
+Python 2.7
+"""
+
+import argparse
+import datetime
+import errno
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+
+import brunnhilde
+import generate_sf_csv
+
+def measure(stage, function, *function_args):
+	'''Run one stage, return its timings and peak memory'''
+	brunnhilde.reset_peak_rss()
+	started = time.time()
+	cpu_started = sum(os.times()[:2])
+	function(*function_args)
+	return {'stage': stage, 'seconds': round(time.time() - started, 3),
+		'cpu_seconds': round(sum(os.times()[:2]) - cpu_started, 3), 'peak_rss_kb': brunnhilde.peak_rss_kb()}
+
+def write_full_table(accession, html_path):
+	'''Write whole siegfried table as one html section, the worst case for write_html'''
+	report_html = accession.html
+	with open(html_path, 'wb') as out:
+		accession.html = out
+		try:
+			sql = "SELECT %s FROM siegfried" % brunnhilde.sf_select
+			brunnhilde.write_html(accession, 'All files', brunnhilde.sf_columns, accession.cursor.execute(sql))
+		finally:
+			accession.html = report_html
+
+def bench_size(task):
+	'''Process one synthetic accession in a worker process, return its results'''
+	rows, sf_csv, work_dir, paginate = task
+	basename = 'bench-%d' % rows
+	report_dir = os.path.join(work_dir, basename)
+	if os.path.isdir(report_dir):
+		shutil.rmtree(report_dir)
+	source = os.path.join(work_dir, 'source') # empty, the stand-in sf reports the synthetic files
+	try:
+		os.makedirs(source)
+	except OSError as exception:
+		if exception.errno != errno.EEXIST:
+			raise
+
+	# keep brunnhilde's progress output out of the results table
+	log = open(os.path.join(work_dir, '%s.log' % basename), 'wb')
+	sys.stdout.flush()
+	os.dup2(log.fileno(), 1)
+
+	os.environ['BRUNNHILDE_BENCH_SF_CSV'] = sf_csv
+	accession = brunnhilde.Accession(source, basename, output_dir=work_dir, yes=True, paginate=paginate)
+	stages = []
+	accession.open()
+	try:
+		stages.append(measure('scan', accession.scan)) # stand-in sf and clamscan, then import
+		# scan resets peak memory between its own stages, so take the highest of them
+		stages[-1]['peak_rss_kb'] = max(record['peak_rss_kb'] for record in accession.metrics['stages'] if record['concurrent'] == False)
+		stages.append(measure('import_csv', brunnhilde.import_csv, accession))
+		stages.append(measure('find_duplicates', brunnhilde.find_duplicates, accession))
+		stages.append(measure('get_stats', brunnhilde.get_stats, accession, accession.scan_started))
+		stages.append(measure('generate_reports', brunnhilde.generate_reports, accession))
+		stages.append(measure('write_html', write_full_table, accession, os.path.join(report_dir, 'all-files.html')))
+	finally:
+		accession.close()
+		sys.stdout.flush()
+		log.close()
+	return {'rows': rows, 'csv_bytes': os.path.getsize(sf_csv), 'db_bytes': os.path.getsize(accession.db_file),
+		'html_bytes': os.path.getsize(accession.html_file), 'stages': stages}
+
+def synthetic_csv(work_dir, rows, options):
+	'''Return path of synthetic siegfried csv for these options, generating it if needed'''
+	path = os.path.join(work_dir, 'sf-%d-d%s-u%s-y%d-%d-s%d.csv' % (rows, options.duplicates, options.unknown,
+		options.years[0], options.years[1], options.seed))
+	if not os.path.exists(path):
+		print("Generating %s rows of synthetic siegfried output." % rows)
+		generate_sf_csv.generate(path + '.part', rows, options.duplicates, options.unknown, options.years, options.seed)
+		os.rename(path + '.part', path)
+	return path
+
+def compare(results, previous_path):
+	'''Print stage times relative to an earlier results file'''
+	with open(previous_path) as f:
+		previous = json.load(f)
+	before = {}
+	for result in previous['results']:
+		for stage in result['stages']:
+			before[(result['rows'], stage['stage'])] = stage
+	print("\nCompared with %s (%s):" % (previous_path, previous['started']))
+	print("%10s  %-18s %10s %10s %8s" % ('rows', 'stage', 'before s', 'now s', 'ratio'))
+	for result in results:
+		for stage in result['stages']:
+			old = before.get((result['rows'], stage['stage']))
+			if old is None:
+				continue
+			ratio = stage['seconds'] / old['seconds'] if old['seconds'] > 0 else float('inf')
+			print("%10d  %-18s %10.3f %10.3f %7.2fx" % (result['rows'], stage['stage'], old['seconds'], stage['seconds'], ratio))
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--rows", help="Comma-separated accession sizes in files (default: 10000,100000,1000000)", default="10000,100000,1000000")
+	parser.add_argument("--duplicates", help="Share of files that copy earlier content (default: 0.2)", type=float, default=0.2)
+	parser.add_argument("--unknown", help="Share of files with no format identification (default: 0.1)", type=float, default=0.1)
+	parser.add_argument("--years", help="Range of last modified years (default: 1990-2016)", type=generate_sf_csv.parse_years, default=(1990, 2016))
+	parser.add_argument("--seed", help="Random seed (default: 1)", type=int, default=1)
+	parser.add_argument("--paginate", help="Process accessions with --paginate", action="store_true")
+	parser.add_argument("--work-dir", help="Directory for synthetic csvs and reports (default: brunnhilde-bench in temp dir)",
+		default=os.path.join(tempfile.gettempdir(), 'brunnhilde-bench'))
+	parser.add_argument("-o", "--output", help="Path of JSON results (default: benchmark-<timestamp>.json)")
+	parser.add_argument("--compare", help="Earlier JSON results to compare stage times against", metavar="JSON")
+	options = parser.parse_args()
+
+	sizes = [int(rows) for rows in options.rows.split(',')]
+	try:
+		os.makedirs(options.work_dir)
+	except OSError as exception:
+		if exception.errno != errno.EEXIST:
+			raise
+	os.environ['PATH'] = os.path.join(bench_dir, 'fakebin') + os.pathsep + os.environ.get('PATH', '')
+	started = datetime.datetime.now()
+	output = options.output or 'benchmark-%s.json' % started.strftime('%Y%m%d-%H%M%S')
+
+	results = []
+	for rows in sizes:
+		sf_csv = synthetic_csv(options.work_dir, rows, options)
+		print("Benchmarking %s rows." % rows)
+		# fresh process per size, so peak memory and caches don't carry over
+		pool = multiprocessing.Pool(1, maxtasksperchild=1)
+		result = pool.apply(bench_size, ((rows, sf_csv, options.work_dir, options.paginate),))
+		pool.close()
+		pool.join()
+		results.append(result)
+		for stage in result['stages']:
+			print("  %-18s %9.3f s %9.3f s cpu %9.1f MB peak" % (stage['stage'], stage['seconds'], stage['cpu_seconds'], stage['peak_rss_kb'] / 1024.0))
+
+	with open(output, 'w') as f:
+		json.dump({'brunnhilde_version': brunnhilde.brunnhilde_version, 'python': platform.python_version(),
+			'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 'started': str(started),
+			'options': {'duplicates': options.duplicates, 'unknown': options.unknown, 'years': list(options.years),
+				'seed': options.seed, 'paginate': options.paginate},
+			'results': results}, f, indent=2, sort_keys=True)
+	print("\nResults written to %s." % output)
+	if options.compare is not None:
+		compare(results, options.compare)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,745 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Check Brunnhilde's scan paths against the stand-in tools in benchmarks/fakebin
+
+Each check processes a small generated accession in a temp directory,
+running brunnhilde.py as a subprocess with benchmarks/fakebin first on
+PATH, then inspects its exit status, output, reports and sqlite db.
+Stand-ins are steered through environment variables documented at the
+top of each one.
+
+Runs offline: python benchmarks/run_checks.py [-v] [Checks.test_name]
+
+Python 2.7
+"""
+
+import csv
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+fakebin = os.path.join(bench_dir, 'fakebin')
+brunnhilde_py = os.path.join(os.path.dirname(bench_dir), 'brunnhilde.py')
+sys.path.insert(0, os.path.dirname(bench_dir))
+
+import brunnhilde
+import fake_clamd
+
+# relative path and contents of each file in the generated accession
+source_files = [
+	('top.txt', 'top level text\n'),
+	('notes/a.txt', 'first note\n'),
+	('notes/b.pdf', '%PDF-1.4\n'),
+	('notes/copy of a.txt', 'first note\n'),
+	('notes/old/c.bin', '\x00\x01\x02'),
+	('notes/old/empty.txt', ''),
+	('photos/with,comma.txt', 'comma in name\n'),
+	('photos/2016/d.txt', 'photo notes\n'),
+	('photos/2016/e.bin', '\xff' * 100),
+	('photos/2017/f.pdf', '%PDF-1.4\n' * 10),
+]
+
+def write_files(root, files):
+	'''Create files under root from (relative path, contents) pairs'''
+	for path, contents in files:
+		path = os.path.join(root, path)
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'wb') as f:
+			f.write(contents)
+
+class Checks(unittest.TestCase):
+
+	def setUp(self):
+		self.work_dir = tempfile.mkdtemp(prefix='brunnhilde-checks-')
+		self.source = os.path.join(self.work_dir, 'source')
+		write_files(self.source, source_files)
+		self.log = os.path.join(self.work_dir, 'tools.log')
+
+	def tearDown(self):
+		shutil.rmtree(self.work_dir)
+
+	def environment(self, **env):
+		'''Return environment with stand-ins first on PATH, steered by env'''
+		environ = dict(os.environ, PATH=fakebin + os.pathsep + os.environ.get('PATH', ''), BRUNNHILDE_FAKE_LOG=self.log)
+		environ.pop('BRUNNHILDE_BENCH_SF_CSV', None)
+		environ.update(env)
+		return environ
+
+	def brunnhilde(self, options, basename='accession', source=None, cwd=None, **env):
+		'''Run brunnhilde.py with stand-ins on PATH, return exit status and output'''
+		command = [sys.executable, brunnhilde_py] + options
+		if basename is not None:
+			command += [source or self.source, basename]
+		process = subprocess.Popen(command, cwd=cwd or self.work_dir, env=self.environment(**env), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=open(os.devnull))
+		output = process.communicate()[0]
+		return process.returncode, output
+
+	def report_dir(self, basename='accession'):
+		return os.path.join(self.work_dir, basename)
+
+	def query(self, sql, basename='accession'):
+		'''Return rows of query on accession's sqlite db'''
+		conn = sqlite3.connect(os.path.join(self.report_dir(basename), 'siegfried.sqlite'))
+		conn.text_factory = str
+		try:
+			return conn.execute(sql).fetchall()
+		finally:
+			conn.close()
+
+	def siegfried_rows(self, basename='accession'):
+		return self.query("SELECT filename, filesize, md5, id FROM siegfried ORDER BY filename", basename)
+
+	def tool_calls(self, tool):
+		'''Return command lines stand-in tool was run with'''
+		if not os.path.isfile(self.log):
+			return []
+		with open(self.log) as f:
+			return [line.split() for line in f if line.split()[0] == tool]
+
+	def test_stream_matches_load_after_scan(self):
+		'''Rows streamed from a slow sf match a load after the scan, and short rows are skipped either way'''
+		status, output = self.brunnhilde(['-n'], 'loaded', BRUNNHILDE_FAKE_SF_SHORT_ROWS='1')
+		self.assertEqual(status, 0, output)
+		status, output = self.brunnhilde(['-n', '-s'], 'streamed', BRUNNHILDE_FAKE_SF_SHORT_ROWS='1', BRUNNHILDE_FAKE_SF_DELAY='0.05')
+		self.assertEqual(status, 0, output)
+		self.assertEqual(len(self.siegfried_rows('streamed')), len(source_files))
+		self.assertEqual(self.siegfried_rows('streamed'), self.siegfried_rows('loaded'))
+		# raw output is kept for provenance, short rows included
+		with open(os.path.join(self.report_dir('loaded'), 'siegfried.csv'), 'rb') as loaded:
+			with open(os.path.join(self.report_dir('streamed'), 'siegfried.csv'), 'rb') as streamed:
+				self.assertEqual(streamed.read(), loaded.read())
+
+	def test_stream_json_split_across_reads(self):
+		'''Json output arriving in small pieces, splitting file objects between reads, loads every file'''
+		status, output = self.brunnhilde(['-n', '--json'], 'loaded')
+		self.assertEqual(status, 0, output)
+		status, output = self.brunnhilde(['-n', '--json', '-s'], 'streamed', BRUNNHILDE_FAKE_SF_DELAY='0.001')
+		self.assertEqual(status, 0, output)
+		self.assertEqual(len(self.siegfried_rows('streamed')), len(source_files))
+		self.assertEqual(self.siegfried_rows('streamed'), self.siegfried_rows('loaded'))
+
+	def test_csv_reports_quote_filenames(self):
+		'''Filenames with commas survive siegfried csv and report csvs'''
+		status, output = self.brunnhilde(['-n'])
+		self.assertEqual(status, 0, output)
+		with open(os.path.join(self.report_dir(), 'csv_reports', 'duplicates.csv'), 'rb') as f:
+			rows = list(csv.reader(f))
+		self.assertEqual(sorted(os.path.basename(row[0]) for row in rows[1:]), ['a.txt', 'copy of a.txt'])
+		self.assertIn((os.path.join(self.source, 'photos', 'with,comma.txt'),), self.query("SELECT filename FROM files"))
+
+	def test_sharded_scan_matches_single_scan(self):
+		'''Shards merge into the same siegfried.csv as one sf run, with one sf launch per directory unit'''
+		status, output = self.brunnhilde(['-n'], 'single')
+		self.assertEqual(status, 0, output)
+		os.remove(self.log)
+		status, output = self.brunnhilde(['-n', '-j', '2'], 'sharded')
+		self.assertEqual(status, 0, output)
+		with open(os.path.join(self.report_dir('single'), 'siegfried.csv'), 'rb') as single:
+			with open(os.path.join(self.report_dir('sharded'), 'siegfried.csv'), 'rb') as sharded:
+				self.assertEqual(sharded.read(), single.read())
+		# notes, photos/2016 and photos/2017 recursively, and the loose files of the top level and photos with -nr
+		scans = [call for call in self.tool_calls('sf') if '-version' not in call]
+		self.assertEqual(len(scans), 5)
+		self.assertEqual(len([call for call in scans if '-nr' in call]), 2)
+		status, output = self.brunnhilde(['-n', '-j', '2', '--json'], 'sharded-json')
+		self.assertEqual(status, 0, output)
+		self.assertEqual(self.siegfried_rows('sharded-json'), self.siegfried_rows('single'))
+
+	def test_flat_source_runs_one_sf(self):
+		'''Loose files are not split into one sf launch each; a flat source gets a single unsharded scan'''
+		flat = os.path.join(self.work_dir, 'flat')
+		write_files(flat, [('file%03d.txt' % number, 'file %d\n' % number) for number in range(200)])
+		status, output = self.brunnhilde(['-n', '-j', '4'], source=flat)
+		self.assertEqual(status, 0, output)
+		self.assertEqual(len([call for call in self.tool_calls('sf') if '-version' not in call]), 1)
+		self.assertEqual(len(self.siegfried_rows()), 200)
+
+	def test_shard_launches_capped(self):
+		'''Many small directories never cost more than the capped number of sf launches per shard'''
+		wide = os.path.join(self.work_dir, 'wide')
+		write_files(wide, [('big/dir%03d/file.txt' % number, 'x' * (number + 1)) for number in range(40)] +
+			[('other/dir%03d/file.txt' % number, 'y' * (number + 1)) for number in range(40)])
+		status, output = self.brunnhilde(['-n', '-j', '2'], source=wide)
+		self.assertEqual(status, 0, output)
+		self.assertLessEqual(len([call for call in self.tool_calls('sf') if '-version' not in call]), 2 * 8)
+		self.assertEqual(len(self.siegfried_rows()), 80)
+
+	def test_incremental_rescans_changed_directories(self):
+		'''A rerun scans each directory holding changes once with -nr, caching only the changed files' rows'''
+		status, output = self.brunnhilde(['-n', '-i'])
+		self.assertEqual(status, 0, output)
+		os.remove(self.log)
+		os.remove(os.path.join(self.source, 'top.txt'))
+		write_files(self.source, [('notes/new.txt', 'new note\n'), ('notes/newer.txt', 'newer note\n'), ('notes/a.txt', 'edited note\n')])
+		status, output = self.brunnhilde(['-n', '-i'])
+		self.assertEqual(status, 0, output)
+		scans = [call for call in self.tool_calls('sf') if '-version' not in call]
+		self.assertEqual([call[-1] for call in scans], [os.path.join(self.source, 'notes')])
+		self.assertIn('-nr', scans[0])
+		with open(os.path.join(self.report_dir(), 'accession.html')) as f:
+			html = f.read()
+		self.assertIn('Rows reused from cache: 8', html)
+		self.assertIn('Rows from fresh scan: 3', html)
+		self.assertIn('Deleted files pruned from cache: 1', html)
+		status, output = self.brunnhilde(['-n'], 'fresh')
+		self.assertEqual(status, 0, output)
+		self.assertEqual(self.siegfried_rows(), self.siegfried_rows('fresh'))
+
+	def test_incremental_falls_back_to_full_scan(self):
+		'''When sf launches for each changed directory would cost more than one full scan, a full scan runs'''
+		status, output = self.brunnhilde(['-n', '-i'])
+		self.assertEqual(status, 0, output)
+		os.remove(self.log)
+		# two launches cost more than one full scan of so small a source
+		write_files(self.source, [('notes/new.txt', 'new note\n'), ('photos/2016/d.txt', 'edited photo notes\n')])
+		status, output = self.brunnhilde(['-n', '-i'])
+		self.assertEqual(status, 0, output)
+		self.assertEqual([call[-1] for call in self.tool_calls('sf') if '-version' not in call], [self.source])
+		self.assertIn('Rows from fresh scan: %s' % (len(source_files) + 1), open(os.path.join(self.report_dir(), 'accession.html')).read())
+
+	def test_incremental_cache_is_durable(self):
+		'''The cache is kept in its own write-ahead-logged db, not in siegfried.sqlite'''
+		status, output = self.brunnhilde(['-n', '-i'])
+		self.assertEqual(status, 0, output)
+		conn = sqlite3.connect(os.path.join(self.report_dir(), 'sf_cache.sqlite'))
+		try:
+			self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+			self.assertEqual(conn.execute("SELECT COUNT(*) FROM sf_cache").fetchone()[0], len(source_files))
+		finally:
+			conn.close()
+		self.assertEqual(self.query("SELECT name FROM sqlite_master WHERE name LIKE 'sf_cache%'"), [])
+
+	def test_siegfried_failure_stops_run(self):
+		'''An sf that exits with an error stops the run with a failed status, whichever way it is run'''
+		for options in [[], ['-s'], ['-j', '2'], ['-i'], ['--json']]:
+			status, output = self.brunnhilde(['-n'] + options, BRUNNHILDE_FAKE_SF_FAIL='1')
+			self.assertEqual(status, 1, options)
+			self.assertIn('Siegfried: exit status 1', output)
+			self.assertIn('Siegfried scan failed', output)
+			self.assertNotIn('Process complete', output)
+
+	def test_csv_columns_mapped_by_name(self):
+		'''Siegfried csv with the class column loads the same rows, however sf is run'''
+		status, output = self.brunnhilde(['-n'], 'plain')
+		self.assertEqual(status, 0, output)
+		for options in [[], ['-s'], ['-j', '2'], ['-i']]:
+			status, output = self.brunnhilde(['-n'] + options, BRUNNHILDE_FAKE_SF_CLASS='1')
+			self.assertEqual(status, 0, output)
+			self.assertEqual(self.siegfried_rows(), self.siegfried_rows('plain'), options)
+			self.assertEqual(self.query("SELECT basis, warning FROM siegfried WHERE filename LIKE '%top.txt'"),
+				self.query("SELECT basis, warning FROM siegfried WHERE filename LIKE '%top.txt'", 'plain'))
+		# rows of a rescanned directory go into the incremental cache by column name too
+		os.remove(self.log)
+		write_files(self.source, [('notes/new.txt', 'new note\n')])
+		status, output = self.brunnhilde(['-n', '-i'], BRUNNHILDE_FAKE_SF_CLASS='1')
+		self.assertEqual(status, 0, output)
+		self.assertIn('-nr', [call for call in self.tool_calls('sf') if '-version' not in call][0])
+		status, output = self.brunnhilde(['-n'], 'plain')
+		self.assertEqual(status, 0, output)
+		self.assertEqual(self.siegfried_rows(), self.siegfried_rows('plain'))
+		# identifiers' columns repeat, each group starting at its namespace column
+		header = ['filename', 'filesize', 'modified', 'errors', 'md5'] + ['namespace', 'id', 'format', 'version', 'mime', 'class', 'basis', 'warning'] * 2
+		self.assertEqual(brunnhilde.csv_layout(header), ([0, 1, 2, 3, 4], [[5, 6, 7, 8, 9, 11, 12], [13, 14, 15, 16, 17, 19, 20]]))
+
+	def test_unexpected_csv_header_stops_run(self):
+		'''Siegfried csv without the columns Brunnhilde loads stops the run, naming the header, instead of reporting no files'''
+		with self.assertRaises(brunnhilde.BrunnhildeError) as raised:
+			brunnhilde.insert_rows(None, csv.reader(['filename,filesize,modified,errors,namespace,id,format,version,mime,basis,warning\n']))
+		self.assertIn('(no md5 column): filename,filesize,', str(raised.exception))
+		with self.assertRaises(brunnhilde.BrunnhildeError):
+			list(brunnhilde.sf_rows(csv.reader(['filename,filesize,modified,errors,md5\n'])))
+
+	def test_accessions_run_side_by_side(self):
+		'''Two Accessions run at once in threads of one process, each with its own results, probing sf -version once'''
+		other = os.path.join(self.work_dir, 'other')
+		write_files(other, source_files + [('extra.txt', 'only in other\n')])
+		environ = dict(os.environ)
+		stdout = sys.stdout
+		os.environ.update(self.environment(BRUNNHILDE_FAKE_SF_DELAY='0.05'))
+		brunnhilde.tool_versions.clear()
+		spans = {}
+		def process(task):
+			source, basename = task
+			accession = brunnhilde.Accession(source, basename, output_dir=self.work_dir, noclam=True, yes=True)
+			started = time.time()
+			accession.open()
+			try:
+				accession.scan()
+				accession.ingest()
+				accession.stats()
+				summary = brunnhilde.summarize(accession) # stage functions take the accession they work on
+				accession.reports()
+			finally:
+				accession.close()
+			spans[basename] = (started, time.time())
+			return summary
+		try:
+			sys.stdout = open(os.path.join(self.work_dir, 'output.txt'), 'wb')
+			pool = ThreadPool(2)
+			try:
+				summaries = pool.map(process, [(self.source, 'first'), (other, 'second')])
+			finally:
+				pool.close()
+				pool.join()
+		finally:
+			sys.stdout.close()
+			sys.stdout = stdout
+			os.environ.clear()
+			os.environ.update(environ)
+			brunnhilde.tool_versions.clear()
+		self.assertEqual([summary['num_files'] for summary in summaries], [len(source_files), len(source_files) + 1])
+		self.assertTrue(all(row[0].startswith(self.source + os.sep) for row in self.siegfried_rows('first')))
+		self.assertTrue(all(row[0].startswith(other + os.sep) for row in self.siegfried_rows('second')))
+		self.assertLess(spans['first'][0], spans['second'][1]) # neither waited for the other to finish
+		self.assertLess(spans['second'][0], spans['first'][1])
+		for basename in ['first', 'second']:
+			with open(os.path.join(self.report_dir(basename), '%s.html' % basename)) as f:
+				self.assertIn('siegfried 1.7.8 (benchmark stand-in)', f.read())
+		self.assertEqual(len([call for call in self.tool_calls('sf') if '-version' in call]), 1)
+
+	def scans_seconds(self, options):
+		'''Run slow stand-in scans with options, return seconds taken by the scans stage'''
+		status, output = self.brunnhilde(['-b'] + options, BRUNNHILDE_FAKE_SF_DELAY='0.1',
+			BRUNNHILDE_FAKE_CLAMSCAN_DELAY='1', BRUNNHILDE_FAKE_BE_DELAY='1')
+		self.assertEqual(status, 0, output)
+		with open(os.path.join(self.report_dir(), 'metrics.json')) as f:
+			return [stage['seconds'] for stage in json.load(f)['stages'] if stage['stage'] == 'Scans'][0]
+
+	def test_scans_run_concurrently(self):
+		'''ClamAV, Siegfried and bulk_extractor overlap, up to --parallel at a time'''
+		self.assertLess(self.scans_seconds([]), 2.5)
+		self.assertGreaterEqual(self.scans_seconds(['-p', '1']), 3)
+
+	def test_failed_scans_reported(self):
+		'''Failed bulk_extractor skips the PII report, failed or infected virus checks continue with --yes'''
+		status, output = self.brunnhilde(['-b', '-y'], BRUNNHILDE_FAKE_BE_FAIL='1', BRUNNHILDE_FAKE_CLAMSCAN_FAIL='1')
+		self.assertEqual(status, 0, output)
+		self.assertIn('Bulk Extractor: exit status 1', output)
+		self.assertIn('ClamAV: exit status 2', output)
+		self.assertIn('Virus check failed. Continuing (--yes).', output)
+		self.assertIn('Skipping PII report', output)
+		write_files(self.source, [('notes/eicar.txt', 'EICAR test\n')])
+		status, output = self.brunnhilde(['-y'], 'infected')
+		self.assertEqual(status, 0, output)
+		self.assertIn('ClamAV: exit status 1', output)
+		self.assertIn('Infected file(s) found. Continuing (--yes).', output)
+		with open(os.path.join(self.report_dir('infected'), 'logs', 'viruscheck-log.txt')) as f:
+			self.assertIn('eicar.txt: Eicar-Test-Signature FOUND', f.read())
+
+	def test_clamd_replies(self):
+		'''OK, FOUND and ERROR replies from a pooled clamd session land in virus_results and a clamscan-style log'''
+		write_files(self.source, [('notes/eicar.txt', 'EICAR test\n'), ('notes/broken.txt', 'CLAMD-ERROR\n'), ('odd: name.txt', 'colon\n')])
+		num_files = len(source_files) + 3
+		clamd = fake_clamd.FakeClamd(os.path.join(self.work_dir, 'clamd.sock'), split_replies=True).start()
+		try:
+			status, output = self.brunnhilde(['-y', '--clamd', clamd.server_address])
+		finally:
+			clamd.stop()
+		self.assertEqual(status, 0, output)
+		results = dict((os.path.relpath(path, self.source), (result, signature)) for path, result, signature in self.query("SELECT * FROM virus_results"))
+		self.assertEqual(len(results), num_files)
+		self.assertEqual(results['notes/eicar.txt'], ('FOUND', 'Eicar-Test-Signature'))
+		self.assertEqual(results['notes/broken.txt'], ('ERROR', "Can't allocate memory"))
+		self.assertEqual(results['odd: name.txt'], ('OK', ''))
+		self.assertEqual(len([result for result, signature in results.values() if result == 'OK']), num_files - 2)
+		with open(os.path.join(self.report_dir(), 'logs', 'viruscheck-log.txt')) as f:
+			log = f.read()
+		self.assertIn('eicar.txt: Eicar-Test-Signature FOUND', log)
+		self.assertIn("broken.txt: Can't allocate memory ERROR", log)
+		self.assertIn('Engine version: 0.99.2', log)
+		self.assertIn('Scanned files: %s\nInfected files: 1\nTotal errors: 1' % (num_files - 1), log)
+		# the file clamd could not scan counts as missed against the inventory
+		self.assertIn('The virus scan missed 1 file(s)', log)
+		self.assertIn('Infected file(s) found. Continuing (--yes).', output)
+		# one version probe, then every file scanned on a few reused sessions
+		commands = [command.split(' ')[0] for command in clamd.commands]
+		self.assertEqual(commands.count('VERSION'), 1)
+		self.assertEqual(commands.count('SCAN'), num_files)
+		self.assertEqual(commands.count('IDSESSION'), commands.count('END'))
+		self.assertLessEqual(commands.count('IDSESSION'), 4)
+
+	def test_clamd_relative_source(self):
+		'''A source given relative to the working directory is sent to clamd as full paths'''
+		write_files(self.source, [('notes/eicar.txt', 'EICAR test\n')])
+		clamd = fake_clamd.FakeClamd(os.path.join(self.work_dir, 'clamd.sock')).start()
+		try:
+			status, output = self.brunnhilde(['-y', '--clamd', clamd.server_address], source='source')
+		finally:
+			clamd.stop()
+		self.assertEqual(status, 0, output)
+		self.assertEqual(sorted(result for path, result in self.query("SELECT path, result FROM virus_results")), ['FOUND'] + ['OK'] * len(source_files))
+		self.assertTrue(all(os.path.isabs(command.split(' ', 1)[1]) for command in clamd.commands if command.startswith('SCAN ')))
+		self.assertIn('The virus scan missed 0 files', open(os.path.join(self.report_dir(), 'logs', 'viruscheck-log.txt')).read())
+
+	def test_rewritten_report_drops_old_pages(self):
+		'''Pages written by an earlier paginated run are removed when the report is written again'''
+		status, output = self.brunnhilde(['-n', '--paginate', '--preview', '1', '--page-size', '1'])
+		self.assertEqual(status, 0, output)
+		pages_dir = os.path.join(self.report_dir(), 'html_pages')
+		self.assertIn('duplicates-0002.html', os.listdir(pages_dir))
+		status, output = self.brunnhilde(['-n', '--report-only', '--paginate', '--preview', '1', '--page-size', '5'])
+		self.assertEqual(status, 0, output)
+		self.assertNotIn('duplicates-0002.html', os.listdir(pages_dir))
+		self.assertIn('duplicates-0001.html', os.listdir(pages_dir))
+		status, output = self.brunnhilde(['-n', '--report-only'])
+		self.assertEqual(status, 0, output)
+		self.assertFalse(os.path.exists(pages_dir))
+
+	def make_image(self, name, prefixes=['']):
+		'''Write generated accession into a tar file the stand-in tsk_recover reads as a disk image, once under each prefix'''
+		image = os.path.join(self.work_dir, name)
+		with tarfile.open(image, 'w') as tar:
+			for prefix in prefixes:
+				tar.add(self.source, prefix + 'files')
+		return image
+
+	def test_carving_reused_until_image_changes(self):
+		'''An unchanged image reuses its carved files, a changed one is carved again'''
+		image = self.make_image('disk.img')
+		status, output = self.brunnhilde(['-n', '-d'], source=image)
+		self.assertEqual(status, 0, output)
+		self.assertEqual(len(self.tool_calls('tsk_recover')), 1)
+		status, output = self.brunnhilde(['-n', '-d'], source=image)
+		self.assertEqual(status, 0, output)
+		self.assertEqual(len(self.tool_calls('tsk_recover')), 1)
+		self.assertIn('Reused files carved on', open(os.path.join(self.report_dir(), 'accession.html')).read())
+		self.assertEqual(len(self.siegfried_rows()), len(source_files))
+		write_files(self.source, [('notes/new.txt', 'new note\n')])
+		self.make_image('disk.img')
+		status, output = self.brunnhilde(['-n', '-d'], source=image)
+		self.assertEqual(status, 0, output)
+		self.assertEqual(len(self.tool_calls('tsk_recover')), 2)
+		self.assertEqual(len(self.siegfried_rows()), len(source_files) + 1)
+
+	def test_carve_cache_shared_across_accessions(self):
+		'''With --carve-cache, another accession of the same image reuses its files, and -r leaves them in place'''
+		image = self.make_image('disk.img')
+		cache = os.path.join(self.work_dir, 'carve-cache')
+		for basename in ['first', 'second']:
+			status, output = self.brunnhilde(['-n', '-d', '-r', '--carve-cache', cache], basename, source=image)
+			self.assertEqual(status, 0, output)
+		self.assertEqual(len(self.tool_calls('tsk_recover')), 1)
+		self.assertEqual(self.siegfried_rows('second'), self.siegfried_rows('first'))
+		self.assertEqual(len([name for name in os.listdir(cache) if name.endswith('.json')]), 1)
+
+	def test_failed_carve_not_reused(self):
+		'''A failed extraction leaves no record, so the next run carves again'''
+		image = self.make_image('disk.img')
+		cache = os.path.join(self.work_dir, 'carve-cache')
+		status, output = self.brunnhilde(['-n', '-d', '--carve-cache', cache], source=image, BRUNNHILDE_FAKE_TSK_FAIL='1')
+		self.assertEqual(status, 1, output)
+		self.assertIn('unable to export files from disk image', output)
+		self.assertEqual([name for name in os.listdir(cache) if not name.endswith('.lock')], [])
+		status, output = self.brunnhilde(['-n', '-d', '--carve-cache', cache], source=image)
+		self.assertEqual(status, 0, output)
+		self.assertEqual(len(self.tool_calls('tsk_recover')), 2)
+
+	def test_failed_hfs_carve_not_reused(self):
+		'''A failed HFS Explorer extraction stops the run without recording an extraction to reuse'''
+		image = self.make_image('disk.img')
+		cache = os.path.join(self.work_dir, 'carve-cache')
+		# the stand-in image is not an HFS volume, so unhfs.sh fails whether or not HFS Explorer is installed
+		status, output = self.brunnhilde(['-n', '-d', '--hfs', '--carve-cache', cache], source=image)
+		self.assertEqual(status, 1, output)
+		self.assertIn('unable to export files from disk image', output)
+		self.assertEqual([name for name in os.listdir(cache) if not name.endswith('.lock')], [])
+
+	def test_partitions_carved_in_parallel(self):
+		'''With --carve-jobs, each partition is carved into its own directory, skipping ones without a file system'''
+		image = self.make_image('disk.img', ['sector_2048/', 'sector_206848/'])
+		status, output = self.brunnhilde(['-n', '-d', '--carve-jobs', '3'], source=image)
+		self.assertEqual(status, 0, output)
+		self.assertEqual(sorted(call[call.index('-o') + 1] for call in self.tool_calls('tsk_recover')), ['2048', '206848', '999'])
+		self.assertEqual(sorted(os.listdir(os.path.join(self.report_dir(), 'carved_files'))), ['partition_2048', 'partition_206848'])
+		self.assertEqual(len(self.siegfried_rows()), 2 * len(source_files))
+
+	def test_pii_hits_by_file(self):
+		'''Forensic paths split into file and offset, including extensionless names ending in numbers'''
+		write_files(self.source, [('notes/scan-2016-07', 'ssn 123-45-6789 and 987-65-4321\n'), ('notes/a.txt', 'mail someone@example.com\n')])
+		status, output = self.brunnhilde(['-n', '-b'])
+		self.assertEqual(status, 0, output)
+		self.assertEqual(self.query("SELECT file, offset, feature FROM pii_hits ORDER BY file, offset"), [
+			(os.path.join(self.source, 'notes', 'a.txt'), '5', 'email'),
+			(os.path.join(self.source, 'notes', 'scan-2016-07'), '20', 'pii'),
+			(os.path.join(self.source, 'notes', 'scan-2016-07'), '4', 'pii')])
+		with open(os.path.join(self.report_dir(), 'csv_reports', 'piiFiles.csv'), 'rb') as f:
+			self.assertEqual(list(csv.reader(f))[1], [os.path.join(self.source, 'notes', 'scan-2016-07'), '2', 'pii'])
+		# offsets within decoded data keep their decoder steps
+		match = brunnhilde.forensic_path_re.match('/source/b.zip-1024-ZIP-0-GZIP-12')
+		self.assertEqual(match.groups(), ('/source/b.zip', '1024-ZIP-0-GZIP-12'))
+
+	def hash_index(self, sql):
+		conn = sqlite3.connect(os.path.join(self.work_dir, 'hashes.sqlite'))
+		conn.text_factory = str
+		try:
+			return conn.execute(sql).fetchall()
+		finally:
+			conn.close()
+
+	def test_hash_index(self):
+		'''Hashes are recorded with paths relative to the source, other accessions' copies are reported, and re-runs replace entries'''
+		index = os.path.join(self.work_dir, 'hashes.sqlite')
+		num_hashed = len([path for path, contents in source_files if contents]) # empty files are not indexed
+		status, output = self.brunnhilde(['-n', '--hash-index', index], 'first', source='source')
+		self.assertEqual(status, 0, output)
+		self.assertEqual(sorted(path for path, in self.hash_index("SELECT path FROM hashes WHERE accession = 'first'")),
+			sorted(path for path, contents in source_files if contents))
+		self.assertEqual(self.hash_index("SELECT source FROM accessions"), [(self.source,)])
+		# a copy of the same material, and an image of it whose carved files are deleted with -r
+		copy = os.path.join(self.work_dir, 'copy')
+		shutil.copytree(self.source, copy)
+		write_files(copy, [('new.txt', 'not held anywhere\n')])
+		status, output = self.brunnhilde(['-n', '--hash-index', index], 'second', source=copy)
+		self.assertEqual(status, 0, output)
+		held = self.query("SELECT filename, accessions, example_accession, example_source, example_path FROM held_elsewhere", 'second')
+		self.assertEqual(len(held), num_hashed)
+		self.assertIn((os.path.join(copy, 'notes', 'b.pdf'), 1, 'first', self.source, 'notes/b.pdf'), held)
+		with open(os.path.join(self.report_dir('second'), 'csv_reports', 'heldElsewhere.csv'), 'rb') as f:
+			self.assertEqual(list(csv.reader(f))[0][-2:], ['Example source', 'Example path'])
+		image = self.make_image('disk.img')
+		status, output = self.brunnhilde(['-n', '-d', '-r', '--hash-index', index], 'image', source=image)
+		self.assertEqual(status, 0, output)
+		self.assertIn(('files/notes/b.pdf', image), self.hash_index("SELECT h.path, a.source FROM hashes h JOIN accessions a ON a.accession = h.accession WHERE h.accession = 'image'"))
+		self.assertEqual(self.query("SELECT DISTINCT accessions FROM held_elsewhere", 'image'), [(2,)])
+		# a re-run replaces the accession's entries rather than adding to them
+		os.remove(os.path.join(self.source, 'top.txt'))
+		status, output = self.brunnhilde(['-n', '--hash-index', index], 'first', source='source')
+		self.assertEqual(status, 0, output)
+		self.assertEqual(self.hash_index("SELECT COUNT(*) FROM hashes WHERE accession = 'first'"), [(num_hashed - 1,)])
+		self.assertEqual(self.hash_index("SELECT accession, num_files FROM accessions ORDER BY accession"),
+			[('first', num_hashed - 1), ('image', num_hashed), ('second', num_hashed + 1)])
+
+	def test_hash_index_concurrent_writers(self):
+		'''Accessions run at once share the hash index, each waiting its turn to write'''
+		index = os.path.join(self.work_dir, 'hashes.sqlite')
+		pool = ThreadPool(3)
+		results = pool.map(lambda basename: self.brunnhilde(['-n', '--hash-index', index], basename), ['one', 'two', 'three'])
+		pool.close()
+		pool.join()
+		for status, output in results:
+			self.assertEqual(status, 0, output)
+		num_hashed = len([path for path, contents in source_files if contents])
+		self.assertEqual(self.hash_index("SELECT accession, COUNT(*) FROM hashes GROUP BY accession ORDER BY accession"),
+			[('one', num_hashed), ('three', num_hashed), ('two', num_hashed)])
+
+	def drop_tables(self, *tables):
+		conn = sqlite3.connect(os.path.join(self.report_dir(), 'siegfried.sqlite'))
+		for table in tables:
+			conn.execute("DROP TABLE %s" % table)
+		conn.commit()
+		conn.close()
+
+	def test_report_only_without_earlier_run(self):
+		'''Rewriting reports for a basename never processed fails without creating a report directory'''
+		status, output = self.brunnhilde(['--report-only'], 'never-run')
+		self.assertEqual(status, 1, output)
+		self.assertIn('No siegfried.sqlite or Siegfried output to report on', output)
+		self.assertFalse(os.path.exists(self.report_dir('never-run')))
+
+	def test_report_only_notes_retaken_inventory(self):
+		'''An inventory rebuilt from the source as it is now is noted in the report, on this and later rewrites'''
+		status, output = self.brunnhilde(['-n'])
+		self.assertEqual(status, 0, output)
+		self.drop_tables('inventory')
+		for rewrite in range(2):
+			status, output = self.brunnhilde(['--report-only'])
+			self.assertEqual(status, 0, output)
+			with open(os.path.join(self.report_dir(), 'accession.html')) as f:
+				self.assertIn('<h3>Inventory</h3>', f.read())
+		# a scan takes its own inventory, so there is nothing to note
+		status, output = self.brunnhilde(['-n'])
+		self.assertEqual(status, 0, output)
+		with open(os.path.join(self.report_dir(), 'accession.html')) as f:
+			self.assertNotIn('<h3>Inventory</h3>', f.read())
+
+	def test_report_only_reimports_any_pii_feature(self):
+		'''PII hits are re-imported when any feature file is left, not only pii.txt'''
+		write_files(self.source, [('notes/a.txt', 'mail someone@example.com\n')])
+		status, output = self.brunnhilde(['-n', '-b'])
+		self.assertEqual(status, 0, output)
+		os.remove(os.path.join(self.report_dir(), 'bulk_extractor', 'pii.txt'))
+		self.drop_tables('pii_hits')
+		status, output = self.brunnhilde(['--report-only'])
+		self.assertEqual(status, 0, output)
+		self.assertEqual(self.query("SELECT feature, value FROM pii_hits"), [('email', 'someone@example.com')])
+		with open(os.path.join(self.report_dir(), 'accession.html')) as f:
+			self.assertIn('PII by feature type', f.read())
+
+	def test_watch_queue_one_job_per_source(self):
+		'''A source queued again while its job runs waits for that job, while other sources' jobs start'''
+		queue = brunnhilde.JobQueue(os.path.join(self.work_dir, 'queue.sqlite'))
+		try:
+			first = queue.enqueue('/drop/a', 'a', '-n', (1, 1.0, 1), 0)
+			again = queue.enqueue('/drop/a', 'a', '-n', (2, 2.0, 1), 1)
+			other = queue.enqueue('/drop/b', 'b', '-n', (1, 1.0, 1), 2)
+			self.assertEqual(queue.start_next()[0], first)
+			self.assertEqual(queue.start_next()[0], other)
+			self.assertIsNone(queue.start_next())
+			queue.finish({'position': first, 'status': 'ok', 'error': '', 'report': '', 'log': ''})
+			self.assertEqual(queue.start_next()[0], again)
+		finally:
+			queue.close()
+
+	def test_batch_isolates_failures(self):
+		'''Each batch accession gets its own report and log, and bad rows or accessions are recorded as failed without stopping the rest'''
+		manifest = os.path.join(self.work_dir, 'manifest.csv')
+		with open(manifest, 'wb') as f:
+			csv.writer(f).writerows([
+				['source', 'basename', 'options'],
+				[self.source, 'b1', '-n'],
+				[self.source], # no basename
+				[self.source, 'b1', '-n -j 2'], # same basename as line 2
+				[os.path.join(self.work_dir, 'missing'), 'b2', '-n'],
+				[self.source, 'b3', '-n --json'],
+				[self.source, 'b4', '--no-such-option'],
+			])
+		status, output = self.brunnhilde(['--batch', manifest, '-w', '3'], None)
+		self.assertEqual(status, 1, output)
+		with open(os.path.join(self.work_dir, 'batch-summary.csv'), 'rb') as f:
+			rows = list(csv.DictReader(f))
+		self.assertEqual([(row['Basename'], row['Status']) for row in rows],
+			[('b1', 'ok'), ('', 'failed'), ('b1', 'failed'), ('b2', 'failed'), ('b3', 'ok'), ('b4', 'failed')])
+		self.assertEqual(rows[1]['Error'], 'Manifest line 3 needs a source and a basename.')
+		self.assertEqual(rows[2]['Error'], 'Basename b1 is already used on manifest line 2.')
+		self.assertIn('Source is not a Directory', rows[3]['Error'])
+		self.assertIn('unrecognized arguments: --no-such-option', rows[5]['Error'])
+		self.assertIn('Batch complete', output)
+		self.assertIn('2 succeeded, 4 failed', output)
+		# the duplicate row never ran, so b1 was scanned once, without -j
+		self.assertEqual(len([call for call in self.tool_calls('sf') if '-version' not in call]), 2)
+		for basename in ['b1', 'b3']:
+			self.assertEqual(len(self.siegfried_rows(basename)), len(source_files))
+			with open(os.path.join(self.work_dir, 'batch_logs', '%s.txt' % basename)) as f:
+				self.assertIn('Process complete', f.read())
+		self.assertEqual(sorted(os.listdir(os.path.join(self.work_dir, 'batch_logs'))), ['b1.txt', 'b2.txt', 'b3.txt', 'b4.txt'])
+		# workers share the one version probe
+		self.assertEqual(len([call for call in self.tool_calls('sf') if '-version' in call]), 1)
+
+	def start_watch(self, options=[], **env):
+		'''Start brunnhilde.py --watch on drop directory in its own process group, with output to watch.log'''
+		output = open(os.path.join(self.work_dir, 'watch.log'), 'ab')
+		service = subprocess.Popen([sys.executable, brunnhilde_py, '--watch', self.drop, '--job-options=-n', '--quiet-period', '1',
+			'--poll-interval', '0.2'] + options, cwd=self.work_dir, env=self.environment(**env), stdout=output, stderr=subprocess.STDOUT,
+			stdin=open(os.devnull), preexec_fn=os.setsid)
+		output.close()
+		self.addCleanup(self.kill_watch, service)
+		return service
+
+	def kill_watch(self, service):
+		if service.poll() is None:
+			os.killpg(service.pid, signal.SIGKILL)
+			service.wait()
+
+	def stop_watch(self, service):
+		'''Send SIGTERM to the service's whole process group, as systemd and timeout do, return its exit status'''
+		os.killpg(service.pid, signal.SIGTERM)
+		self.wait_for(lambda: service.poll() is not None, 10)
+		return service.returncode
+
+	def wait_for(self, condition, timeout=30):
+		'''Poll until condition holds, failing after timeout seconds'''
+		deadline = time.time() + timeout
+		while not condition():
+			if time.time() > deadline:
+				with open(os.path.join(self.work_dir, 'watch.log')) as f:
+					self.fail("Timed out. Watch output:\n%s" % f.read())
+			time.sleep(0.1)
+
+	def watch_jobs(self):
+		'''Return (basename, status) of each --watch job, in the order queued'''
+		queue = os.path.join(self.work_dir, 'brunnhilde-queue.sqlite')
+		if not os.path.isfile(queue):
+			return []
+		conn = sqlite3.connect(queue)
+		try:
+			return conn.execute("SELECT basename, status FROM jobs ORDER BY job_id").fetchall()
+		except sqlite3.OperationalError: # not created yet
+			return []
+		finally:
+			conn.close()
+
+	def running_tools(self, tool):
+		'''Return pids of stand-in tool processes working under the temp directory'''
+		pids = []
+		for pid in os.listdir('/proc'):
+			try:
+				with open('/proc/%s/cmdline' % pid) as f:
+					command = f.read().split('\0')
+			except IOError: # exited, or not a process
+				continue
+			if os.path.join(fakebin, tool) in command and any(arg.startswith(self.work_dir) for arg in command):
+				pids.append(pid)
+		return pids
+
+	def test_watch_queues_settled_accessions(self):
+		'''Accessions are queued once unchanged for the quiet period, and again only when they change'''
+		self.drop = os.path.join(self.work_dir, 'drop')
+		write_files(os.path.join(self.drop, 'first'), source_files)
+		service = self.start_watch()
+		self.wait_for(lambda: self.watch_jobs() == [('first', 'done')])
+		self.assertEqual(len(self.siegfried_rows('first')), len(source_files))
+		# a folder still being copied is not queued
+		for number in range(12):
+			write_files(os.path.join(self.drop, 'second'), [('part%02d.txt' % number, 'part\n')])
+			time.sleep(0.25)
+			self.assertEqual(self.watch_jobs(), [('first', 'done')])
+		self.wait_for(lambda: self.watch_jobs() == [('first', 'done'), ('second', 'done')])
+		self.assertEqual(len(self.siegfried_rows('second')), 12)
+		with open(os.path.join(self.work_dir, 'watch-status.json')) as f:
+			status = json.load(f)
+		self.assertGreaterEqual([job for job in status['recent'] if job['basename'] == 'second'][0]['quiet_seconds'], 3)
+		# an unchanged accession is not queued again, a changed one is
+		time.sleep(2)
+		self.assertEqual(len(self.watch_jobs()), 2)
+		write_files(os.path.join(self.drop, 'first'), [('notes/new.txt', 'new note\n')])
+		self.wait_for(lambda: self.watch_jobs()[2:] == [('first', 'done')])
+		self.assertEqual(len(self.siegfried_rows('first')), len(source_files) + 1)
+		self.assertEqual(self.stop_watch(service), 0)
+
+	def test_watch_recovers_jobs_after_sigterm(self):
+		'''SIGTERM to the process group stops the service and its tools, and running jobs are run again on restart'''
+		self.drop = os.path.join(self.work_dir, 'drop')
+		write_files(os.path.join(self.drop, 'slow'), source_files)
+		service = self.start_watch(BRUNNHILDE_FAKE_SF_DELAY='1')
+		self.wait_for(lambda: self.watch_jobs() == [('slow', 'running')] and self.running_tools('sf'))
+		self.assertEqual(self.stop_watch(service), 0)
+		self.assertEqual(self.running_tools('sf'), [])
+		self.assertEqual(self.watch_jobs(), [('slow', 'running')])
+		service = self.start_watch()
+		self.wait_for(lambda: self.watch_jobs() == [('slow', 'done')])
+		self.assertEqual(len(self.siegfried_rows('slow')), len(source_files))
+		self.assertEqual(self.stop_watch(service), 0)
+		with open(os.path.join(self.work_dir, 'watch.log')) as f:
+			output = f.read()
+		self.assertIn('Stopping. Running jobs will be queued again on restart.', output)
+		self.assertIn('Queued again 1 jobs interrupted when the service last stopped.', output)
+
+	def test_watch_rejects_bad_setup(self):
+		'''A missing drop directory, job options that can't run per accession, or running inside the drop directory stop the service at once'''
+		drop = os.path.join(self.work_dir, 'drop')
+		status, output = self.brunnhilde(['--watch', drop], None)
+		self.assertEqual(status, 1, output)
+		self.assertIn('is not a directory', output)
+		os.makedirs(drop)
+		status, output = self.brunnhilde(['--watch', drop, '--job-options=-n --batch manifest.csv'], None)
+		self.assertEqual(status, 1, output)
+		self.assertIn('--batch cannot be used in --job-options.', output)
+		status, output = self.brunnhilde(['--watch', drop], None, cwd=drop)
+		self.assertEqual(status, 1, output)
+		self.assertIn('Run --watch from outside the drop directory', output)
+
+if __name__ == '__main__':
+	unittest.main()
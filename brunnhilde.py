@@ -19,524 +19,2538 @@ http://bitarchivist.net
 """
 
 import argparse
+import cgi
+import contextlib
+import copy
+import cProfile
 import csv
 import datetime
 import errno
-from itertools import islice
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import operator
 import os
+import Queue
 import re
+import resource
+import shlex
 import shutil
+import signal
+import socket
 import sqlite3
+import stat
+from StringIO import StringIO
 import subprocess
 import sys
+import threading
+import time
+import traceback
+try:
+	from os import scandir
+except ImportError: # python < 3.5
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+# siegfried csv columns (pronom-only output), in order
+sf_columns = ['filename', 'filesize', 'modified', 'errors', 'md5', 'namespace', 'id', 'format', 'version', 'mime', 'basis', 'warning']
+sf_select = ", ".join(sf_columns)
+
+# PRONOM IDs, linked to PRONOM in html report
+puid_re = re.compile(r'^(x-)?fmt/\d+$')
+
+# rows per executemany call when loading siegfried output
+insert_batch_size = 10000
+
+# bulk extractor feature files loaded into pii_hits
+pii_features = ['pii', 'ccn', 'ccn_track2', 'email', 'telephone']
+
+# file and offset of bulk extractor forensic path, offset followed by any decoder steps (decoder names start with a letter)
+forensic_path_re = re.compile(r'^(.*?)-(\d+(?:-[A-Z][A-Z0-9_]*-\d+)*)$')
+
+# most sf processes run per shard with --jobs, since each one loads the signature file
+sf_launches_per_shard = 8
+
+# rough bytes sf identifies in the time it takes to load its signature file, to weigh launches against bytes rescanned
+sf_launch_bytes = 64 * 1024 * 1024
+
+# clamd sessions kept open for --clamd scans
+clamd_pool_size = 4
+
+# wait up to 10 minutes for other runs writing to a shared --hash-index
+hash_index_timeout = 600000
+
+# bytes of a disk image hashed at each of its start, middle and end to tell if it changed since carving
+carve_sample_bytes = 1024 * 1024
+
+# tool version output, probed on first use and kept for the life of the process
+tool_versions = {}
+
+# guards tool versions, probed from the threads of accessions run side by side
+tool_version_lock = threading.Lock()
+
+def tool_version(command):
+	'''Return version output of external tool, probing it once per process'''
+	key = " ".join(command)
+	with tool_version_lock:
+		if key not in tool_versions:
+			tool_versions[key] = subprocess.check_output(command)
+		return tool_versions[key]
+
+def siegfried_version():
+	'''Return siegfried version output'''
+	return tool_version(['sf', '-version'])
+
+# guards tool usage in run metrics, recorded from scan threads
+tool_lock = threading.Lock()
+
+def reset_peak_rss():
+	'''Reset this process's peak resident set size, where the kernel allows it'''
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+	except IOError:
+		pass
+
+def peak_rss_kb():
+	'''Return peak resident set size of this process in KB'''
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1])
+	except IOError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def start_profile(accession):
+	'''Start profiling current thread if --profile is set'''
+	if accession.args.profile == False:
+		return None
+	profiler = cProfile.Profile()
+	profiler.enable()
+	return profiler
+
+def stop_profile(accession, profiler, name):
+	'''Stop profiler and write its data to profiles directory'''
+	if profiler is None:
+		return
+	profiler.disable()
+	profile_dir = os.path.join(accession.report_dir, 'profiles')
+	try:
+		os.makedirs(profile_dir)
+	except OSError as exception:
+		if exception.errno != errno.EEXIST:
+			raise
+	profiler.dump_stats(os.path.join(profile_dir, '%s.prof' % name.lower().replace(' ', '_')))
+
+@contextlib.contextmanager
+def stage(accession, name):
+	'''Record wall time, CPU time including subprocesses, peak memory, rows and bytes read of a stage in run metrics'''
+	record = {'stage': name, 'rows': None, 'bytes_read': None, 'concurrent': False}
+	reset_peak_rss()
+	profiler = start_profile(accession)
+	started = time.time()
+	cpu_started = os.times()
+	try:
+		yield record
+	finally:
+		cpu = os.times()
+		stop_profile(accession, profiler, name)
+		record['seconds'] = round(time.time() - started, 3)
+		record['cpu_seconds'] = round(sum(cpu[:4]) - sum(cpu_started[:4]), 3)
+		record['peak_rss_kb'] = peak_rss_kb()
+		accession.metrics['stages'].append(record)
+
+def call_tool(accession, name, command, **kwargs):
+	'''Run external tool like subprocess.call, recording its resource usage under name'''
+	return wait_tool(accession, name, subprocess.Popen(command, **kwargs))
+
+def wait_tool(accession, name, process):
+	'''Wait for external tool to exit, recording its CPU time and peak memory under name, return exit status'''
+	while True:
+		try:
+			pid, status, usage = os.wait4(process.pid, 0)
+			break
+		except OSError as exception:
+			if exception.errno != errno.EINTR:
+				raise
+	if os.WIFSIGNALED(status):
+		process.returncode = -os.WTERMSIG(status)
+	else:
+		process.returncode = os.WEXITSTATUS(status)
+	with tool_lock:
+		tool = accession.metrics['tools'].setdefault(name, {'processes': 0, 'cpu_seconds': 0.0, 'peak_rss_kb': 0})
+		tool['processes'] += 1
+		tool['cpu_seconds'] = round(tool['cpu_seconds'] + usage.ru_utime + usage.ru_stime, 3)
+		tool['peak_rss_kb'] = max(tool['peak_rss_kb'], usage.ru_maxrss)
+	return process.returncode
 
-def run_siegfried(source_dir):
-	'''Run siegfried on directory'''
+def list_entries(directory):
+	'''Return (name, type, size, mtime) for each entry in directory, without following symlinks'''
+	entries = []
+	if scandir is not None:
+		for entry in scandir(directory):
+			st = entry.stat(follow_symlinks=False)
+			if entry.is_symlink():
+				entry_type = 'link'
+			elif entry.is_dir(follow_symlinks=False):
+				entry_type = 'dir'
+			elif entry.is_file(follow_symlinks=False):
+				entry_type = 'file'
+			else:
+				entry_type = 'other'
+			entries.append((entry.name, entry_type, st.st_size, st.st_mtime))
+	else:
+		for name in os.listdir(directory):
+			st = os.lstat(os.path.join(directory, name))
+			if stat.S_ISLNK(st.st_mode):
+				entry_type = 'link'
+			elif stat.S_ISDIR(st.st_mode):
+				entry_type = 'dir'
+			elif stat.S_ISREG(st.st_mode):
+				entry_type = 'file'
+			else:
+				entry_type = 'other'
+			entries.append((name, entry_type, st.st_size, st.st_mtime))
+	return entries
+
+def walk_entries(source_dir):
+	'''Yield (path, parent, name, type, size, mtime) for each entry under source_dir, with paths relative to it'''
+	directories = ['']
+	while directories:
+		parent = directories.pop()
+		try:
+			entries = list_entries(os.path.join(source_dir, parent))
+		except OSError as e:
+			print("\nUnable to read %s: %s" % (os.path.join(source_dir, parent), e))
+			continue
+		for name, entry_type, size, mtime in entries:
+			path = os.path.join(parent, name)
+			yield (path, parent, name, entry_type, size, mtime)
+			if entry_type == 'dir':
+				directories.append(path)
+
+def take_inventory(accession, source_dir):
+	'''Walk source directory once, recording every entry in inventory table'''
+	print("\nTaking inventory of %s." % source_dir)
+	accession.cursor.execute("DROP TABLE IF EXISTS inventory")
+	accession.cursor.execute("CREATE TABLE inventory (path text, parent text, name text, type text, size integer, mtime real)")
+	batch = []
+	for record in walk_entries(source_dir):
+		batch.append(record)
+		if len(batch) >= insert_batch_size:
+			accession.cursor.executemany("INSERT INTO inventory VALUES (?, ?, ?, ?, ?, ?)", batch)
+			batch = []
+	if batch:
+		accession.cursor.executemany("INSERT INTO inventory VALUES (?, ?, ?, ?, ?, ?)", batch)
+	accession.cursor.execute("CREATE INDEX idx_inventory_parent ON inventory (parent)")
+	accession.conn.commit()
+
+def count_inventory_files(accession):
+	'''Return number of regular files in inventory'''
+	accession.cursor.execute("SELECT COUNT(*) FROM inventory WHERE type = 'file'")
+	return accession.cursor.fetchone()[0]
+
+def siegfried_args(accession, source_dir, recursive=True):
+	'''Build siegfried command line for directory, or for only the files directly in it'''
+	sf_args = ['sf']
+	if accession.args.scanarchives == True:
+		sf_args.append('-z')
+	if accession.args.json == True:
+		sf_args.append('-json')
+	else:
+		sf_args.append('-csv')
+	if accession.args.throttle == True:
+		sf_args.extend(['-throttle', '10ms'])
+	if recursive == False:
+		sf_args.append('-nr')
+	sf_args.extend(['-hash', 'md5', source_dir])
+	return sf_args
+
+def run_siegfried(accession, source_dir):
+	'''Run siegfried on directory, return its exit status'''
 	# run siegfried against specified directory
 	print("\nRunning Siegfried against %s. This may take a few minutes." % source_dir)
-	global sf_command
-	sf_command = "sf -csv -hash md5 '%s' > %s" % (source_dir, sf_file)
-	if args.scanarchives == True:
-		sf_command = sf_command.replace('sf -csv', 'sf -z -csv')
-	if args.throttle == True:
-		sf_command = sf_command.replace('-csv -hash', '-csv -throttle 10ms -hash')
-	subprocess.call(sf_command, shell=True)
+	sf_args = siegfried_args(accession, source_dir)
+	accession.sf_command = "%s '%s' > %s" % (" ".join(sf_args[:-1]), source_dir, accession.sf_file)
+	with open(accession.sf_file, 'wb') as sf_output:
+		returncode = call_tool(accession, 'Siegfried', sf_args, stdout=sf_output)
+	if returncode != 0:
+		print("\nSiegfried exited with status %s." % returncode)
+		return returncode
 	print("\nCharacterization complete. Processing results.")
-	return sf_command
-	
-def run_clamav(source_dir):
-    '''Run ClamAV on directory'''
+	return returncode
+
+def stream_siegfried(accession, source_dir):
+	'''Run siegfried on directory, loading rows into sqlite db as they are output, return its exit status'''
+	print("\nRunning Siegfried against %s and loading results as they arrive. This may take a few minutes." % source_dir)
+	sf_args = siegfried_args(accession, source_dir)
+	accession.sf_command = "%s '%s' | tee %s" % (" ".join(sf_args[:-1]), source_dir, accession.sf_file)
+	started = time.time()
+	create_siegfried_table(accession)
+	sf = subprocess.Popen(sf_args, stdout=subprocess.PIPE)
+	# keep raw output in siegfried.csv or siegfried.json for provenance
+	with open(accession.sf_file, 'wb') as sf_output:
+		try:
+			if accession.args.json == True:
+				chunks = tee_lines(iter(lambda: os.read(sf.stdout.fileno(), 65536), ''), sf_output) # os.read returns what has arrived
+				header, header_text, files = read_sf_json(chunks)
+				num_rows = insert_json(accession, header, files)
+				for chunk in chunks: # copy rest of output
+					pass
+			else:
+				num_rows = insert_rows(accession, csv.reader(tee_lines(iter(sf.stdout.readline, ''), sf_output))) # readline avoids read-ahead on pipes
+		except BaseException:
+			sf.kill() # output can't be loaded, so stop the scan
+			sf.wait()
+			raise
+	returncode = wait_tool(accession, 'Siegfried', sf)
+	index_siegfried_table(accession)
+	if returncode != 0:
+		print("\nSiegfried exited with status %s." % returncode)
+		return returncode
+	print("\nCharacterization complete. Loaded %s rows in %.1f seconds." % (num_rows, time.time() - started))
+	return returncode
+
+def tee_lines(lines, copy):
+	'''Yield lines (or chunks of text), copying each to file'''
+	for line in lines:
+		copy.write(line)
+		yield line
+
+def directory_sizes(accession, source_dir):
+	'''Return dict of total bytes under each directory in source_dir, from inventory'''
+	sizes = {source_dir: 0}
+	for path, in accession.conn.execute("SELECT path FROM inventory WHERE type = 'dir'"):
+		sizes[os.path.join(source_dir, path)] = 0
+	for path, size in accession.conn.execute("SELECT path, size FROM inventory WHERE type = 'file'"):
+		sizes[source_dir] += size
+		parent = os.path.dirname(path)
+		while parent:
+			sizes[os.path.join(source_dir, parent)] += size
+			parent = os.path.dirname(parent)
+	return sizes
+
+def shard_source(accession, source_dir, num_shards):
+	'''Split source directory into shards of directories balanced by byte size, return lists of (path, recursive) units,
+	or None if one unit would hold most of the bytes'''
+	sizes = directory_sizes(accession, source_dir)
+	def split(path):
+		# each subdirectory, plus the directory's own files scanned without recursing
+		units = []
+		loose = None
+		sql = "SELECT path, type, size FROM inventory WHERE parent = ?"
+		for entry, entry_type, size in accession.conn.execute(sql, (os.path.relpath(path, source_dir) if path != source_dir else '',)):
+			if entry_type == 'dir':
+				entry = os.path.join(source_dir, entry)
+				units.append((sizes[entry], entry, True))
+			else:
+				loose = (loose or 0) + size
+		if loose is not None:
+			units.append((loose, path, False))
+		return units
+
+	# split the largest directories until none outweighs a shard, keeping sf launches (one per unit) capped
+	total = sizes.get(source_dir, 0)
+	target = total / float(num_shards)
+	units = [(total, source_dir, True)]
+	while True:
+		splittable = [unit for unit in units if unit[2] == True and unit[0] > target]
+		if not splittable:
+			break
+		largest = max(splittable)
+		parts = split(largest[1])
+		if len(units) - 1 + len(parts) > sf_launches_per_shard * num_shards:
+			break
+		units.remove(largest)
+		units.extend(parts)
+	# loose files can't be split further, and a shard holding most of the bytes gains little over one sf run
+	if len(units) < 2 or max(units)[0] > total / 2.0:
+		return None
+
+	# assign largest first to the lightest shard
+	shards = [[0, []] for i in range(num_shards)]
+	for size, path, recursive in sorted(units, key=lambda unit: (-unit[0], unit[1], unit[2])):
+		lightest = min(shards, key=lambda shard: shard[0])
+		lightest[0] += size
+		lightest[1].append((path, recursive))
+	return [paths for size, paths in shards if paths]
+
+def sf_path_key(source_dir, path):
+	'''Sort key matching siegfried's lexical walk order'''
+	return os.path.relpath(path, source_dir).split(os.sep)
+
+def run_siegfried_shard(accession, shard):
+	'''Run siegfried over each (index, path, recursive) unit in shard, writing one output file per unit, return (path, exit status) of failed runs'''
+	shard_dir, units = shard
+	failed = []
+	for index, path, recursive in units:
+		with open(os.path.join(shard_dir, '%08d.sf' % index), 'wb') as sf_output:
+			returncode = call_tool(accession, 'Siegfried', siegfried_args(accession, path, recursive), stdout=sf_output)
+		if returncode != 0:
+			failed.append((path, returncode))
+	return failed
+
+def csv_records(f):
+	'''Yield (row, raw text) of each record in csv file'''
+	raw = []
+	def lines():
+		for line in f:
+			raw.append(line)
+			yield line
+	# the reader consumes exactly the lines of a record before yielding it
+	for row in csv.reader(lines()):
+		yield row, ''.join(raw)
+		del raw[:]
+
+def keyed_records(records, index, source_dir, filename):
+	'''Yield (walk order key, unit index, raw text, record) for merging unit outputs'''
+	for record, raw in records:
+		yield sf_path_key(source_dir, filename(record)) if record else [], index, raw, record
+
+def merge_shard_csvs(shard_dir, num_units, source_dir):
+	'''Yield lines of per-unit csvs merged into siegfried walk order, keeping only the first header'''
+	unit_files = [open(os.path.join(shard_dir, '%08d.sf' % index), 'rb') for index in range(num_units)]
+	try:
+		header = None
+		streams = []
+		for index, f in enumerate(unit_files):
+			records = csv_records(f)
+			first = next(records, None)
+			if first is None: # no output
+				continue
+			if header is None:
+				header = first[1]
+			streams.append(keyed_records(records, index, source_dir, lambda row: row[0]))
+		if header is None:
+			return
+		yield header
+		# a directory's own files interleave with its subdirectories in walk order
+		for key, index, raw, row in heapq.merge(*streams):
+			yield raw
+	finally:
+		for f in unit_files:
+			f.close()
+
+def merge_shard_json(shard_dir, num_units, source_dir, sf_output):
+	'''Merge per-unit json outputs in siegfried walk order into one json document, return its header and generator of files'''
+	unit_files = [open(os.path.join(shard_dir, '%08d.sf' % index), 'rb') for index in range(num_units)]
+	header = None
+	streams = []
+	for index, f in enumerate(unit_files):
+		unit_header, unit_header_text, files = read_sf_json(read_chunks(f))
+		if unit_header is None: # no output
+			continue
+		if header is None:
+			header, header_text = unit_header, unit_header_text
+		streams.append(keyed_records(files, index, source_dir, lambda item: item.get('filename', '')))
+	if header is None:
+		for f in unit_files:
+			f.close()
+		return None, iter([])
+
+	def merged_files():
+		try:
+			sf_output.write(header_text + '"files":[')
+			separator = ''
+			for key, index, raw, item in heapq.merge(*streams):
+				sf_output.write(separator + raw)
+				separator = ',\n'
+				yield item, raw
+			sf_output.write(']}\n')
+		finally:
+			for f in unit_files:
+				f.close()
+
+	return header, merged_files()
+
+def run_siegfried_sharded(accession, source_dir, shards):
+	'''Run parallel siegfried workers over shards of directory, merging results into siegfried.csv and sqlite db, return exit status of first failed run or 0'''
+	print("\nRunning Siegfried against %s with %s parallel workers. This may take a few minutes." % (source_dir, len(shards)))
+	started = time.time()
+	units = sorted(unit for shard in shards for unit in shard)
+	order = dict((unit, index) for index, unit in enumerate(units))
+	shard_dir = os.path.join(accession.report_dir, 'sf_shards')
+	try:
+		os.makedirs(shard_dir)
+	except OSError as exception:
+		if exception.errno != errno.EEXIST:
+			raise
+
+	# each pool thread drives its own sf processes, one per unit
+	pool = ThreadPool(len(shards))
+	failed = sum(pool.map(lambda shard: run_siegfried_shard(accession, shard), [(shard_dir, [(order[unit],) + unit for unit in shard]) for shard in shards]), [])
+	pool.close()
+	pool.join()
+	for path, returncode in failed:
+		print("\nSiegfried exited with status %s on %s." % (returncode, path))
+	if failed:
+		shutil.rmtree(shard_dir)
+		return failed[0][1]
+
+	sf_args = siegfried_args(accession, source_dir)
+	num_loose = len([unit for unit in units if unit[1] == False])
+	accession.sf_command = "%s [directory] for each of %s directories under '%s' (-nr for the %s whose subdirectories are scanned separately), in %s parallel shards, merged in path order > %s" % (
+		" ".join(sf_args[:-1]), len(units), source_dir, num_loose, len(shards), accession.sf_file)
+
+	# merge into siegfried.csv and sqlite db in one pass
+	create_siegfried_table(accession)
+	with open(accession.sf_file, 'wb') as sf_output:
+		if accession.args.json == True:
+			header, files = merge_shard_json(shard_dir, len(units), source_dir, sf_output)
+			num_rows = insert_json(accession, header, files)
+		else:
+			num_rows = insert_rows(accession, csv.reader(tee_lines(merge_shard_csvs(shard_dir, len(units), source_dir), sf_output)))
+	shutil.rmtree(shard_dir)
+	index_siegfried_table(accession)
+	print("\nCharacterization complete. Loaded %s rows in %.1f seconds." % (num_rows, time.time() - started))
+	return 0
+
+def stat_source(accession):
+	'''Return dict of (size, mtime) for each file in inventory, keyed by relative path'''
+	return dict((path, (size, mtime)) for path, size, mtime in accession.conn.execute("SELECT path, size, mtime FROM inventory WHERE type = 'file'"))
+
+def cache_key(relpath, files):
+	'''Return relative path of the file a siegfried row came from (archive members map to their archive)'''
+	if relpath in files:
+		return relpath
+	return relpath.split('#', 1)[0]
+
+def prepare_sf_cache(accession, sf_options):
+	'''Attach identification cache db, creating its tables if needed and clearing it if siegfried version or options changed'''
+	# kept out of siegfried.sqlite, which trades durability for speed, so a crash can't corrupt the cache
+	accession.cursor.execute("ATTACH DATABASE ? AS cache", (os.path.join(accession.report_dir, 'sf_cache.sqlite'),))
+	accession.cursor.execute("PRAGMA cache.journal_mode = WAL")
+	accession.cursor.execute("PRAGMA cache.synchronous = NORMAL")
+	accession.cursor.execute("CREATE TABLE IF NOT EXISTS cache.sf_cache_info (key text primary key, value text)")
+	accession.cursor.execute("CREATE TABLE IF NOT EXISTS cache.sf_cache (path text, size integer, mtime real, %s)" % ", ".join(["%s text" % column for column in sf_columns]))
+	accession.cursor.execute("CREATE INDEX IF NOT EXISTS cache.idx_sf_cache_path ON sf_cache (path)")
+	if 'sf_cache' in db_tables(accession): # cache of an earlier version, kept in siegfried.sqlite
+		accession.cursor.execute("INSERT INTO cache.sf_cache_info SELECT * FROM main.sf_cache_info WHERE key NOT IN (SELECT key FROM cache.sf_cache_info)")
+		accession.cursor.execute("INSERT INTO cache.sf_cache SELECT * FROM main.sf_cache WHERE NOT EXISTS (SELECT 1 FROM cache.sf_cache)")
+		accession.cursor.execute("DROP TABLE main.sf_cache")
+		accession.cursor.execute("DROP TABLE main.sf_cache_info")
+	accession.cursor.execute("SELECT value FROM cache.sf_cache_info WHERE key = 'options'")
+	row = accession.cursor.fetchone()
+	if row is None or row[0] != sf_options:
+		accession.cursor.execute("DELETE FROM cache.sf_cache")
+		accession.cursor.execute("INSERT OR REPLACE INTO cache.sf_cache_info VALUES ('options', ?)", (sf_options,))
+	accession.conn.commit()
+
+def cache_rows(accession, rows, source_dir, files, keep=None):
+	'''Add siegfried rows to identification cache, only those of files in keep if given, return number of rows added'''
+	insertsql = "INSERT INTO cache.sf_cache VALUES (%s)" % ", ".join(["?"] * (len(sf_columns) + 3))
+	num_rows = 0
+	batch = []
+	for row in rows:
+		relpath = os.path.relpath(row[0], source_dir)
+		key = cache_key(relpath, files)
+		if key not in files or (keep is not None and key not in keep):
+			continue
+		size, mtime = files[key]
+		batch.append([key, size, mtime, relpath] + list(row[1:]))
+		if len(batch) >= insert_batch_size:
+			accession.cursor.executemany(insertsql, batch)
+			num_rows += len(batch)
+			batch = []
+	if batch:
+		accession.cursor.executemany(insertsql, batch)
+		num_rows += len(batch)
+	accession.conn.commit()
+	return num_rows
+
+def cached_csv_lines(accession, source_dir):
+	'''Yield siegfried csv lines for all cached rows, with filenames under source_dir'''
+	line = StringIO()
+	w = csv.writer(line)
+	rows = accession.conn.execute("SELECT %s FROM cache.sf_cache ORDER BY path, rowid" % sf_select)
+	for row in itertools.chain([sf_columns], ([os.path.join(source_dir, row[0])] + list(row[1:]) for row in rows)):
+		w.writerow(row)
+		yield line.getvalue()
+		line.seek(0)
+		line.truncate()
+
+def run_siegfried_incremental(accession, source_dir):
+	'''Run siegfried only on directories with new or changed files, reusing cached results for the rest, return exit status'''
+	started = time.time()
+	files = stat_source(accession)
+	sf_args = siegfried_args(accession, source_dir)
+	prepare_sf_cache(accession, "%s %s" % (siegfried_version().strip(), " ".join(sf_args[:-1])))
+	cached = dict((path, (size, mtime)) for path, size, mtime in accession.cursor.execute("SELECT path, size, mtime FROM cache.sf_cache GROUP BY path").fetchall())
+	changed = set(path for path in files if cached.get(path) != files[path])
+	deleted = [path for path in cached if path not in files]
+	# prune deleted and changed files from cache
+	accession.cursor.executemany("DELETE FROM cache.sf_cache WHERE path = ?", [(path,) for path in deleted + sorted(changed)])
+	accession.conn.commit()
+
+	# each directory holding changes gets one sf -nr run, which also rereads its unchanged files
+	directories = sorted(set(os.path.dirname(path) for path in changed))
+	scan_bytes = sum(size for path, (size, mtime) in files.items() if os.path.dirname(path) in directories)
+	total_bytes = sum(size for size, mtime in files.values())
+	if scan_bytes + len(directories) * sf_launch_bytes >= total_bytes + sf_launch_bytes: # rescanning everything in one pass is cheaper
+		print("\n%s of %s files are new or changed, in %s directories. Running full scan." % (len(changed), len(files), len(directories)))
+		returncode = characterize(accession, source_dir)
+		if returncode != 0: # rows of failed scan are not cached
+			return returncode
+		accession.cursor.execute("DELETE FROM cache.sf_cache")
+		num_fresh = cache_rows(accession, accession.conn.execute("SELECT %s FROM siegfried" % sf_select), source_dir, files)
+		accession.cache_stats = {'cached': 0, 'fresh': num_fresh, 'pruned': len(deleted)}
+		return 0
+
+	print("\nRunning Siegfried against %s directories of %s with new or changed files (%s unchanged files cached)." % (len(directories), source_dir, len(files) - len(changed)))
+	accession.cursor.execute("SELECT COUNT(*) FROM cache.sf_cache")
+	num_cached = accession.cursor.fetchone()[0]
+	shard_dir = os.path.join(accession.report_dir, 'sf_shards')
+	try:
+		os.makedirs(shard_dir)
+	except OSError as exception:
+		if exception.errno != errno.EEXIST:
+			raise
+	units = [(index, os.path.join(source_dir, directory), False) for index, directory in enumerate(directories)]
+	pool = ThreadPool(max(accession.args.jobs, 1))
+	failed = sum(pool.map(lambda shard: run_siegfried_shard(accession, shard), [(shard_dir, units[i::max(accession.args.jobs, 1)]) for i in range(max(accession.args.jobs, 1))]), [])
+	pool.close()
+	pool.join()
+	for path, returncode in failed:
+		print("\nSiegfried exited with status %s on %s." % (returncode, path))
+	if failed: # changed files stay out of the cache, so they are scanned again next run
+		shutil.rmtree(shard_dir)
+		return failed[0][1]
+	rows = sf_rows(csv.reader(merge_shard_csvs(shard_dir, len(directories), source_dir)))
+	num_fresh = cache_rows(accession, rows, source_dir, files, changed) # rows of unchanged files are cached already
+	shutil.rmtree(shard_dir)
+
+	accession.sf_command = "%s -nr [directory] for each of %s directories with new or changed files under '%s', merged with %s cached rows > %s" % (" ".join(sf_args[:-1]), len(directories), source_dir, num_cached, accession.sf_file)
+	accession.cache_stats = {'cached': num_cached, 'fresh': num_fresh, 'pruned': len(deleted)}
+
+	# write cache out as siegfried.csv and load into sqlite db in one pass
+	create_siegfried_table(accession)
+	with open(accession.sf_file, 'wb') as sf_output:
+		num_rows = insert_rows(accession, csv.reader(tee_lines(cached_csv_lines(accession, source_dir), sf_output)))
+	index_siegfried_table(accession)
+	print("\nCharacterization complete. Loaded %s rows (%s from cache) in %.1f seconds." % (num_rows, num_cached, time.time() - started))
+	return 0
+
+def characterize(accession, source_dir):
+	'''Run siegfried on directory and load results into sqlite db, return siegfried exit status'''
+	shards = None
+	if accession.args.jobs > 1:
+		shards = shard_source(accession, source_dir, accession.args.jobs)
+		if shards is None:
+			print("\nSource is not split across enough directories to share out between Siegfried workers. Running one scan.")
+	if shards is not None:
+		return run_siegfried_sharded(accession, source_dir, shards) # run siegfried workers in parallel, merging output into sqlite db
+	elif accession.args.stream == True:
+		return stream_siegfried(accession, source_dir) # run siegfried, loading output into sqlite db as it arrives
+	returncode = run_siegfried(accession, source_dir) # run siegfried
+	if returncode == 0:
+		import_csv(accession) # load csv into sqlite db
+	return returncode
+
+def run_clamav(accession, source_dir):
+    '''Run ClamAV on directory, return clamscan exit status'''
     # run virus check on specified directory
     timestamp = str(datetime.datetime.now())
     print("\nRunning virus check on %s. This may take a few minutes." % source_dir)
-    virus_log = 'viruscheck-log.txt'
-    clamav_command = "clamscan -i -r '%s' | tee %s" % (source_dir, virus_log)
-    subprocess.call(clamav_command, shell=True)
-    # add timestamp
-    target = open(virus_log, 'a')
-    target.write("Date scanned: %s" % timestamp)
-    target.close()
+    with open(accession.virus_log, 'wb') as target:
+        returncode = call_tool(accession, 'ClamAV', ['clamscan', '-i', '-r', source_dir], stdout=target)
+        # add timestamp
+        target.write("Date scanned: %s" % timestamp)
+    return returncode
+
+def keep_processing(accession, question):
+    '''Ask whether to keep processing, unless running non-interactively'''
+    if accession.args.yes == True:
+        print(question + " Continuing (--yes).")
+        return True
+    raw_answer = raw_input(question + " Do you want to keep processing (y/n)?")
+    answer = str.lower(raw_answer)
+    return answer != "n"
+
+def check_clamav(accession, source_dir):
+    '''Check ClamAV log for missed and infected files'''
+    if accession.args.clamd is not None:
+        load_virus_results(accession)
+    with open(accession.virus_log) as f:
+        print(f.read())
     # compare number of files scanned to inventory of source_dir
-    inventory = []
-    for root, directories, filenames in os.walk(source_dir):
-        for filename in filenames:
-            inventory.append(os.path.join(root, filename))
-    with open(virus_log) as f:
+    num_files = count_inventory_files(accession)
+    with open(accession.virus_log) as f:
         for line in f:
             if "Scanned files: " in line:
                 scnd = line.split()
-                diff = len(inventory) - int(scnd[2])
+                diff = num_files - int(scnd[2])
                 if diff >= 1:
                     msg = ("\nThe virus scan missed %s file(s) in %s" % (diff, source_dir))
-                    q = " Do you want to keep processing (y/n)?"
-                    target = open(virus_log, 'a')
+                    target = open(accession.virus_log, 'a')
                     target.write("%s" % msg)
                     target.close()
-                    raw_answer = raw_input(msg + q)
-                    answer = str.lower(raw_answer)
-                    if answer == "n":
-                        sys.exit()
+                    if not keep_processing(accession, msg + "."):
+                        raise BrunnhildeError("Processing stopped after virus check.")
                 else:
                     msg = ("\nThe virus scan missed %s files in %s" % (diff, source_dir))
-                    target = open(virus_log, 'a')
+                    target = open(accession.virus_log, 'a')
                     target.write("%s" % msg)
                     target.close()
                     print(msg)
     # check log for infected files
-    if "Infected files: 0" not in open(virus_log).read():
-        raw_answer = raw_input("Infected file(s) found. Do you want to keep processing (y/n)?")
-        answer = str.lower(raw_answer)
-        if answer == "n":
-            sys.exit()
+    if "Infected files: 0" not in open(accession.virus_log).read():
+        if not keep_processing(accession, "Infected file(s) found."):
+            raise BrunnhildeError("Processing stopped after virus check.")
     else:
         print("No infections found in %s." % source_dir)
 
-def run_bulkext(source_dir):
-	'''Run bulk extractor on directory'''
+def clamd_connect(socket_path):
+	'''Open clamd session on local socket'''
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	connection.connect(socket_path)
+	connection.sendall('zIDSESSION\0')
+	return {'socket': connection, 'buffer': ''}
+
+def clamd_command(connection, command):
+	'''Send command on clamd connection, return reply without session request id'''
+	connection['socket'].sendall('z%s\0' % command)
+	while '\0' not in connection['buffer']:
+		data = connection['socket'].recv(4096)
+		if not data:
+			raise IOError("clamd closed connection")
+		connection['buffer'] += data
+	reply, connection['buffer'] = connection['buffer'].split('\0', 1)
+	return re.sub(r'^\d+: ', '', reply, 1)
+
+def clamd_version(socket_path):
+	'''Return clamd engine version, e.g. 0.99.2'''
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	connection.connect(socket_path)
+	connection.sendall('zVERSION\0')
+	reply = ''
+	while '\0' not in reply:
+		data = connection.recv(4096)
+		if not data:
+			break
+		reply += data
+	connection.close()
+	return reply.split('\0')[0].split('/')[0].replace('ClamAV ', '')
+
+def clamd_scan_file(task):
+	'''Scan one file on a pooled clamd connection, return (path, size, result, detail)'''
+	connections, path, size = task
+	connection = connections.get()
+	try:
+		reply = clamd_command(connection, 'SCAN %s' % path)
+	finally:
+		connections.put(connection)
+	# replies are "<path>: OK", "<path>: <signature> FOUND" or "<path>: <message> ERROR"
+	if reply.startswith(path + ': '):
+		status = reply[len(path) + 2:]
+	else:
+		status = reply.rsplit(': ', 1)[-1]
+	if status == 'OK':
+		return path, size, 'OK', ''
+	elif status.endswith(' FOUND'):
+		return path, size, 'FOUND', status[:-len(' FOUND')]
+	return path, size, 'ERROR', re.sub(r' ERROR$', '', status)
+
+def run_clamd(accession, source_dir, files, num_dirs):
+	'''Run virus check on files through clamd, writing log in clamscan format, return clamscan exit status'''
+	timestamp = str(datetime.datetime.now())
+	started = time.time()
+	print("\nRunning virus check on %s using clamd at %s. This may take a few minutes." % (source_dir, accession.args.clamd))
+	engine_version = clamd_version(accession.args.clamd)
+	connections = Queue.Queue()
+	for i in range(clamd_pool_size):
+		connections.put(clamd_connect(accession.args.clamd))
+	pool = ThreadPool(clamd_pool_size)
+	scan_dir = os.path.abspath(source_dir) # clamd needs full paths, resolving others in its own working directory
+	tasks = [(connections, os.path.join(scan_dir, path), size) for path, size in files]
+	scanned = infected = errors = data_scanned = 0
+	# per-file results are spooled to csv and loaded into virus_results once the other scans finish
+	with open(accession.virus_results_file, 'wb') as spool:
+		with open(accession.virus_log, 'wb') as log:
+			w = csv.writer(spool)
+			for path, size, result, detail in pool.imap_unordered(clamd_scan_file, tasks, 64):
+				w.writerow([path, result, detail])
+				if result == 'ERROR':
+					errors += 1
+					log.write("%s: %s ERROR\n" % (path, detail))
+					continue
+				scanned += 1
+				data_scanned += size
+				if result == 'FOUND':
+					infected += 1
+					log.write("%s: %s FOUND\n" % (path, detail))
+			pool.close()
+			pool.join()
+			while not connections.empty():
+				connection = connections.get()
+				connection['socket'].sendall('zEND\0')
+				connection['socket'].close()
+
+			elapsed = time.time() - started
+			log.write("\n----------- SCAN SUMMARY -----------\n")
+			log.write("Engine version: %s\n" % engine_version)
+			log.write("Scanned directories: %s\n" % (num_dirs + 1))
+			log.write("Scanned files: %s\n" % scanned)
+			log.write("Infected files: %s\n" % infected)
+			if errors:
+				log.write("Total errors: %s\n" % errors)
+			log.write("Data scanned: %.2f MB\n" % (data_scanned / 1048576.0))
+			log.write("Time: %.3f sec (%d m %d s)\n" % (elapsed, elapsed // 60, elapsed % 60))
+			log.write("Date scanned: %s" % timestamp)
+	if infected:
+		return 1
+	return 0
+
+def load_virus_results(accession):
+	'''Load spooled clamd results into virus_results table'''
+	accession.cursor.execute("DROP TABLE IF EXISTS virus_results")
+	accession.cursor.execute("CREATE TABLE virus_results (path text, result text, signature text)")
+	with open(accession.virus_results_file, 'rb') as f:
+		accession.cursor.executemany("INSERT INTO virus_results VALUES (?, ?, ?)", csv.reader(f))
+	accession.cursor.execute("CREATE INDEX idx_virus_results_result ON virus_results (result)")
+	accession.conn.commit()
+	os.remove(accession.virus_results_file)
+
+def run_bulkext(accession, source_dir):
+	'''Run bulk extractor on directory, return exit status'''
 	# run bulk extractor against specified directory if option is chosen
-	bulkext_log = os.path.join(log_dir, 'bulkext-log.txt')
+	bulkext_log = os.path.join(accession.log_dir, 'bulkext-log.txt')
 	print("\nRunning Bulk Extractor on %s. This may take a few minutes." % source_dir)
 	try:
-		os.makedirs(bulkext_dir)
+		os.makedirs(accession.bulkext_dir)
 	except OSError as exception:
 		if exception.errno != errno.EEXIST:
 			raise
-	bulkext_command = "bulk_extractor -S ssn_mode=2 -o %s -R '%s' | tee %s" % (bulkext_dir, source_dir, bulkext_log)
-	subprocess.call(bulkext_command, shell=True)
+	with open(bulkext_log, 'wb') as log:
+		return call_tool(accession, 'Bulk Extractor', ['bulk_extractor', '-S', 'ssn_mode=2', '-o', accession.bulkext_dir, '-R', source_dir], stdout=log)
 
-def import_csv():
-	'''Import csv file into sqlite db'''
-	with open(sf_file, 'rb') as f:
-		reader = csv.reader(f)
-		header = True
+def run_sf_scan(accession, source_dir):
+	'''Run siegfried and load results into sqlite db, return siegfried exit status'''
+	if accession.args.incremental == True:
+		return run_siegfried_incremental(accession, source_dir) # rescan only new and changed files
+	return characterize(accession, source_dir) # run siegfried and load results into sqlite db
+
+def run_scan(accession, scan):
+	'''Run one scan for scheduler, catching errors so other scans keep going'''
+	name, function, function_args = scan
+	started = time.time()
+	profiler = start_profile(accession)
+	try:
+		returncode = function(*function_args)
+		error = None
+	except Exception as e:
+		returncode = None
+		error = "%s: %s" % (type(e).__name__, e)
+	stop_profile(accession, profiler, name)
+	return {'name': name, 'returncode': returncode, 'error': error, 'seconds': time.time() - started}
+
+def run_scans(accession, source_dir):
+	'''Run virus check, siegfried and bulk extractor on directory concurrently, return results by scan name'''
+	# name, function, arguments, exit statuses that count as success
+	scans = []
+	if accession.args.noclam == False and accession.args.clamd is not None: # scan inventory through clamd
+		# read inventory here, since the siegfried scan thread writes to the db meanwhile
+		files = accession.conn.execute("SELECT path, size FROM inventory WHERE type = 'file'").fetchall()
+		num_dirs = accession.conn.execute("SELECT COUNT(*) FROM inventory WHERE type = 'dir'").fetchone()[0]
+		scans.append(('ClamAV', run_clamd, (accession, source_dir, files, num_dirs), [0, 1]))
+	elif accession.args.noclam == False: # run clamAV virus check unless specified otherwise
+		scans.append(('ClamAV', run_clamav, (accession, source_dir), [0, 1])) # 1 means infected files found, checked once scans finish
+	scans.append(('Siegfried', run_sf_scan, (accession, source_dir), [0]))
+	if accession.args.bulkextractor == True: # bulk extractor option is chosen
+		scans.append(('Bulk Extractor', run_bulkext, (accession, source_dir), [0]))
+
+	pool = ThreadPool(max(min(accession.args.parallel, len(scans)), 1))
+	results = pool.map(lambda scan: run_scan(accession, scan), [(name, function, function_args) for name, function, function_args, ok in scans])
+	pool.close()
+	pool.join()
+
+	print("\nScans complete:")
+	for (name, function, function_args, ok), result in zip(scans, results):
+		result['ok'] = result['error'] is None and result['returncode'] in ok
+		if result['error'] is not None:
+			status = result['error']
+		else:
+			status = "exit status %s" % result['returncode']
+		print("  %s: %s (%.1f seconds)" % (name, status, result['seconds']))
+	return dict((result['name'], result) for result in results)
+
+def record_scans(accession, scans):
+	'''Add each concurrent scan to run metrics, with CPU time and peak memory of its external tool'''
+	num_files = count_inventory_files(accession)
+	accession.cursor.execute("SELECT IFNULL(SUM(size), 0) FROM inventory WHERE type = 'file'")
+	num_bytes = accession.cursor.fetchone()[0]
+	for name in ['ClamAV', 'Siegfried', 'Bulk Extractor']:
+		if name not in scans:
+			continue
+		tool = accession.metrics['tools'].get(name, {})
+		record = {'stage': name, 'seconds': round(scans[name]['seconds'], 3), 'cpu_seconds': tool.get('cpu_seconds'),
+			'peak_rss_kb': tool.get('peak_rss_kb'), 'rows': None, 'bytes_read': num_bytes, 'concurrent': True}
+		if name == 'ClamAV':
+			record['rows'] = num_files
+		elif name == 'Siegfried' and scans[name]['ok']:
+			accession.cursor.execute("SELECT COUNT(*) FROM files")
+			record['rows'] = accession.cursor.fetchone()[0]
+		accession.metrics['stages'].append(record)
+		if name == 'Siegfried' and 'import' in accession.metrics:
+			accession.metrics['stages'].append(accession.metrics.pop('import'))
+
+def create_siegfried_table(accession):
+	'''Drop and recreate normalized tables for siegfried output, and siegfried view over them'''
+	accession.cursor.execute("DROP VIEW IF EXISTS siegfried")
+	accession.cursor.execute("DROP TABLE IF EXISTS siegfried") # flat table of older report dbs
+	for table in ['files', 'identifications', 'namespaces', 'formats', 'mimes', 'bases', 'warnings']:
+		accession.cursor.execute("DROP TABLE IF EXISTS %s" % table)
+	accession.cursor.execute("CREATE TABLE files (file_id integer primary key, filename text, filesize integer, modified text, errors text, md5 text, year integer, mtime integer)")
+	# one row per match, several per file when siegfried uses more than one identifier
+	accession.cursor.execute("CREATE TABLE identifications (file_id integer, namespace_id integer, format_id integer, mime_id integer, basis_id integer, warning_id integer)")
+	# repeated strings, stored once and referenced by integer key
+	accession.cursor.execute("CREATE TABLE namespaces (namespace_id integer primary key, namespace text, details text)")
+	accession.cursor.execute("CREATE TABLE formats (format_id integer primary key, id text, format text, version text)")
+	accession.cursor.execute("CREATE TABLE mimes (mime_id integer primary key, mime text)")
+	accession.cursor.execute("CREATE TABLE bases (basis_id integer primary key, basis text)")
+	accession.cursor.execute("CREATE TABLE warnings (warning_id integer primary key, warning text)")
+	# one row per match in the first identifier, with the columns of the flat siegfried csv
+	accession.cursor.execute("CREATE VIEW siegfried AS SELECT f.filename, f.filesize, f.modified, f.errors, f.md5, n.namespace, "
+		"fo.id, fo.format, fo.version, m.mime, b.basis, w.warning, f.year, f.mtime, f.file_id "
+		"FROM identifications i JOIN files f ON f.file_id = i.file_id JOIN namespaces n ON n.namespace_id = i.namespace_id "
+		"JOIN formats fo ON fo.format_id = i.format_id JOIN mimes m ON m.mime_id = i.mime_id "
+		"JOIN bases b ON b.basis_id = i.basis_id JOIN warnings w ON w.warning_id = i.warning_id "
+		"WHERE i.namespace_id = 1")
+
+def index_siegfried_table(accession):
+	'''Build indexes used by stats and reports (after load, so inserts stay fast)'''
+	accession.cursor.execute("CREATE INDEX idx_files_md5 ON files (md5)")
+	accession.cursor.execute("CREATE INDEX idx_identifications_file ON identifications (file_id)")
+	accession.cursor.execute("CREATE INDEX idx_identifications_format ON identifications (namespace_id, format_id)")
+	accession.cursor.execute("CREATE INDEX idx_identifications_mime ON identifications (namespace_id, mime_id)")
+	accession.cursor.execute("CREATE INDEX idx_identifications_warning ON identifications (namespace_id, warning_id)")
+	accession.conn.commit()
+
+class SiegfriedLoader(object):
+	'''Batch loader of siegfried results into an accession's files, identifications and lookup tables'''
+
+	def __init__(self, accession):
+		self.accession = accession
+		self.namespaces = {}
+		self.lookups = dict((table, {}) for table in ['formats', 'mimes', 'bases', 'warnings'])
+		self.new_lookups = dict((table, []) for table in ['namespaces', 'formats', 'mimes', 'bases', 'warnings'])
+		self.matches = {}
+		self.files = []
+		self.identifications = []
+		self.num_files = 0
+
+	def lookup(self, table, key):
+		'''Return integer key of value in lookup table, adding it if new'''
+		keys = self.lookups[table]
+		value_id = keys.get(key)
+		if value_id is None:
+			value_id = len(keys) + 1
+			keys[key] = value_id
+			self.new_lookups[table].append((value_id,) + key)
+		return value_id
+
+	def add_namespace(self, namespace, details):
+		'''Return integer key of identifier namespace, adding it if new (the first added is the one reported on)'''
+		namespace_id = self.namespaces.get(namespace)
+		if namespace_id is None:
+			namespace_id = len(self.namespaces) + 1
+			self.namespaces[namespace] = namespace_id
+			self.new_lookups['namespaces'].append((namespace_id, namespace, details))
+		return namespace_id
+
+	def add_match(self, match):
+		'''Return integer keys of a (namespace, id, format, version, mime, basis, warning) match, adding new values'''
+		namespace, ident, format_name, version, mime, basis, warning = match
+		ids = (self.add_namespace(namespace, ''), self.lookup('formats', (ident, format_name, version)),
+			self.lookup('mimes', (mime,)), self.lookup('bases', (basis,)), self.lookup('warnings', (warning,)))
+		self.matches[match] = ids
+		return ids
+
+	def add_file(self, filename, filesize, modified, errors, md5, matches):
+		'''Add file and its matches, each a (namespace, id, format, version, mime, basis, warning) tuple'''
+		self.num_files += 1
+		file_id = self.num_files
+		self.files.append((file_id, filename, filesize, modified, errors, md5))
+		for match in matches:
+			# few distinct matches in an accession, so look up each combination once
+			ids = self.matches.get(match)
+			if ids is None:
+				ids = self.add_match(match)
+			self.identifications.append((file_id,) + ids)
+		if len(self.files) >= insert_batch_size:
+			self.flush()
+
+	def flush(self):
+		'''Insert batched rows'''
+		for table, rows in self.new_lookups.items():
+			if rows:
+				self.accession.cursor.executemany("INSERT INTO %s VALUES (%s)" % (table, ", ".join(["?"] * len(rows[0]))), rows)
+				self.new_lookups[table] = []
+		# filesize is converted by column affinity; year and utc mtime are parsed by sqlite from the modified date
+		self.accession.cursor.executemany("INSERT INTO files VALUES (?1, ?2, ?3, ?4, ?5, ?6, NULLIF(CAST(SUBSTR(?4, 1, 4) AS INTEGER), 0), CAST(strftime('%s', ?4) AS INTEGER))", self.files)
+		self.accession.cursor.executemany("INSERT INTO identifications VALUES (?, ?, ?, ?, ?, ?)", self.identifications)
+		self.files = []
+		self.identifications = []
+
+	def close(self):
+		'''Insert remaining rows and commit, return number of files loaded'''
+		self.flush()
+		self.accession.conn.commit()
+		return self.num_files
+
+def csv_layout(header):
+	'''Return positions of file columns and of each identifier's match columns in siegfried csv header, by column name'''
+	names = [name.strip().lower() for name in header]
+	missing = [column for column in sf_columns[:5] if column not in names]
+	# each identifier's columns start at its namespace column; others, such as class, are ignored
+	starts = [position for position, name in enumerate(names) if name == 'namespace']
+	if not starts:
+		missing.append('namespace')
+	match_fields = []
+	for start, end in zip(starts, starts[1:] + [len(names)]):
+		section = names[start:end]
+		missing += [column for column in sf_columns[5:] if column not in section]
+		match_fields.append([start + section.index(column) for column in sf_columns[5:] if column in section])
+	if missing: # not csv with hash and one or more identifiers
+		raise BrunnhildeError("Unexpected Siegfried csv header (no %s column): %s" % (", ".join(sorted(set(missing))), ",".join(header)))
+	return [names.index(column) for column in sf_columns[:5]], match_fields
+
+def insert_rows(accession, reader):
+	'''Batch insert rows from siegfried csv reader, return number of files inserted'''
+	header = next(reader, None)
+	if header is None: # empty siegfried output
+		return 0
+	rowlen = len(header) # number of columns in header
+	file_fields, match_fields = csv_layout(header)
+	loader = SiegfriedLoader(accession)
+	add_file = loader.add_file
+	if rowlen == len(sf_columns) and file_fields + match_fields[0] == range(rowlen): # one identifier in the usual layout
 		for row in reader:
-			if header:
-				header = False # gather column names from first row of csv
-				sql = "DROP TABLE IF EXISTS siegfried"
-				cursor.execute(sql)
-				sql = "CREATE TABLE siegfried (filename text, filesize text, modified text, errors text, md5 text, namespace text, id text, format text, version text, mime text, basis text, warning text)"
-				cursor.execute(sql)
-				insertsql = "INSERT INTO siegfried VALUES (%s)" % (", ".join([ "?" for column in row ]))
-				rowlen = len(row)
-			else:
-				# skip lines that don't have right number of columns
-				if len(row) == rowlen:
-					cursor.execute(insertsql, row)
-		conn.commit()
-
-def get_stats(source_dir, scan_started):
-	'''Get aggregate statistics and write to html report'''
-	
-	# get stats from sqlite db
-	cursor.execute("SELECT COUNT(*) from siegfried;") # total files
-	num_files = cursor.fetchone()[0]
-
-	cursor.execute("SELECT COUNT(DISTINCT md5) from siegfried WHERE filesize<>'0';") # distinct files
-	distinct_files = cursor.fetchone()[0]
-
-	cursor.execute("SELECT COUNT(*) from siegfried where filesize='0';") # empty files
-	empty_files = cursor.fetchone()[0]
-
-	cursor.execute("SELECT COUNT(md5) FROM siegfried t1 WHERE EXISTS (SELECT 1 from siegfried t2 WHERE t2.md5 = t1.md5 AND t1.filename != t2.filename) AND filesize<>'0'") # duplicates
-	all_dupes = cursor.fetchone()[0]
-
-	cursor.execute("SELECT COUNT(DISTINCT md5) FROM siegfried t1 WHERE EXISTS (SELECT 1 from siegfried t2 WHERE t2.md5 = t1.md5 AND t1.filename != t2.filename) AND filesize<>'0'") # distinct duplicates
-	distinct_dupes = cursor.fetchone()[0]
-
-	duplicate_copies = int(all_dupes) - int(distinct_dupes) # number of duplicate copies of unique files
-	duplicate_copies = str(duplicate_copies)
-
-	cursor.execute("SELECT COUNT(*) FROM siegfried WHERE id='UNKNOWN';") # unidentified files
-	unidentified_files = cursor.fetchone()[0]
-
-	year_sql = "SELECT DISTINCT SUBSTR(modified, 1, 4) as 'year' FROM siegfried;" # min and max year
-	year_path = os.path.join(csv_dir, 'uniqueyears.csv')
-	with open(year_path, 'wb') as year_report:
-		w = csv.writer(year_report)
-		for row in cursor.execute(year_sql):
-			w.writerow(row)
-	with open(year_path, 'rb') as year_report:
-		r = csv.reader(year_report)
-		years = []
-		for row in r:
-			years.append(row[0])
-		begin_date = min(years, key=float)
-		end_date = max(years, key=float)
-	os.remove(year_path) # delete temporary "uniqueyear" file from csv reports directory
-
-	datemodified_sql = "SELECT DISTINCT modified FROM siegfried;" # min and max full modified date
-	datemodified_path = os.path.join(csv_dir, 'datemodified.csv')
-	with open(datemodified_path, 'wb') as date_report:
-		w = csv.writer(date_report)
-		for row in cursor.execute(datemodified_sql):
-			w.writerow(row)
-	with open(datemodified_path, 'rb') as date_report:
-		r = csv.reader(date_report)
-		dates = []
-		for row in r:
-			dates.append(row[0])
-		earliest_date = min(dates)
-		latest_date = max(dates)
-
-	cursor.execute("SELECT COUNT(DISTINCT format) as formats from siegfried WHERE format <> '';") # number of identfied file formats
-	num_formats = cursor.fetchone()[0]
-
-	cursor.execute("SELECT COUNT(*) FROM siegfried WHERE errors <> '';") # number of siegfried errors
-	num_errors = cursor.fetchone()[0]
-
-	cursor.execute("SELECT COUNT(*) FROM siegfried WHERE warning <> '';") # number of siegfried warnings
-	num_warnings = cursor.fetchone()[0]
-
-	# get size from du and format
-	size = subprocess.check_output(['du', '-sh', source_dir])
-	size = size.replace('%s' % source_dir, '')
-	size = size.replace('K', ' KB')
-	size = size.replace('M', ' MB')
-	size = size.replace('G', ' GB')
+			# skip lines that don't have right number of columns
+			if len(row) != rowlen:
+				continue
+			add_file(row[0], row[1], row[2], row[3], row[4], (tuple(row[5:]),))
+		return loader.close()
+	get_file = operator.itemgetter(*file_fields)
+	get_matches = [operator.itemgetter(*fields) for fields in match_fields]
+	for row in reader:
+		if len(row) != rowlen:
+			continue
+		filename, filesize, modified, errors, md5 = get_file(row)
+		add_file(filename, filesize, modified, errors, md5, [get_match(row) for get_match in get_matches])
+	return loader.close()
+
+def sf_rows(reader):
+	'''Yield rows of siegfried csv reader with the columns of sf_columns, from the first identifier'''
+	header = next(reader, None)
+	if header is None: # empty siegfried output
+		return
+	file_fields, match_fields = csv_layout(header)
+	get_row = operator.itemgetter(*(file_fields + match_fields[0]))
+	for row in reader:
+		if len(row) == len(header):
+			yield get_row(row)
+
+def read_sf_json(chunks):
+	'''Parse siegfried json output incrementally from chunks of text, return header and generator of (file, raw json)'''
+	decoder = json.JSONDecoder()
+	chunks = iter(chunks)
+	buffer = ''
+	# siegfried writes the files list last, so everything before it is the header
+	while re.search(r'"files"\s*:\s*\[', buffer) is None:
+		chunk = next(chunks, None)
+		if chunk is None: # empty or truncated output
+			return None, '', iter([])
+		buffer += chunk
+	files_start = re.search(r'"files"\s*:\s*\[', buffer)
+	header_text = buffer[:files_start.start()]
+	header = json.loads(header_text + '"files": []}')
+
+	def files(buffer, position):
+		while True:
+			# skip separators, reading on as needed
+			while position < len(buffer) and buffer[position] in ' \t\r\n,':
+				position += 1
+			if position == len(buffer):
+				chunk = next(chunks, None)
+				if chunk is None: # truncated output
+					return
+				buffer = chunk
+				position = 0
+				continue
+			if buffer[position] == ']': # end of files list
+				return
+			try:
+				item, end = decoder.raw_decode(buffer, position)
+			except ValueError: # file object continues in next chunk
+				chunk = next(chunks, None)
+				if chunk is None:
+					raise
+				buffer = buffer[position:] + chunk
+				position = 0
+				continue
+			yield item, buffer[position:end]
+			position = end
+
+	return header, header_text, files(buffer, files_start.end())
+
+def insert_json(accession, header, files):
+	'''Batch insert files from parsed siegfried json output, return number of files inserted'''
+	if header is None: # empty siegfried output
+		return 0
+	loader = SiegfriedLoader(accession)
+	for identifier in header.get('identifiers', []):
+		loader.add_namespace(identifier.get('name', ''), identifier.get('details', ''))
+	for item, raw in files:
+		matches = [(match.get('ns', ''), match.get('id', ''), match.get('format', ''), match.get('version', ''),
+			match.get('mime', ''), match.get('basis', ''), match.get('warning', '')) for match in item.get('matches', [])]
+		loader.add_file(item.get('filename', ''), item.get('filesize', 0), item.get('modified', ''), item.get('errors', ''),
+			item.get('md5', ''), matches)
+	return loader.close()
+
+def read_chunks(f):
+	'''Yield chunks of text read from file'''
+	return iter(lambda: f.read(65536), '')
+
+def import_csv(accession):
+	'''Import siegfried csv or json output file into sqlite db'''
+	started = time.time()
+	create_siegfried_table(accession)
+	with open(accession.sf_file, 'rb') as f:
+		if accession.args.json == True:
+			header, header_text, files = read_sf_json(read_chunks(f))
+			num_rows = insert_json(accession, header, files)
+		else:
+			num_rows = insert_rows(accession, csv.reader(f))
+	index_siegfried_table(accession)
+	elapsed = time.time() - started
+	print("\nImported %s rows in %.1f seconds (%d rows/sec)." % (num_rows, elapsed, num_rows / max(elapsed, 0.001)))
+	# runs in the siegfried scan thread, so listed with the scans
+	accession.metrics['import'] = {'stage': 'Import', 'seconds': round(elapsed, 3), 'cpu_seconds': None, 'peak_rss_kb': None,
+		'rows': num_rows, 'bytes_read': os.path.getsize(accession.sf_file), 'concurrent': True}
+
+def import_pii(accession):
+	'''Stream bulk extractor feature files into indexed pii_hits table, return number of hits and bytes read'''
+	# sorts spill to disk instead of memory, so memory use stays flat however many hits there are
+	accession.cursor.execute("PRAGMA temp_store = FILE")
+	accession.cursor.execute("DROP TABLE IF EXISTS pii_hits")
+	accession.cursor.execute("CREATE TABLE pii_hits (file text, offset text, feature text, value text, context text)")
+	num_hits = 0
+	num_bytes = 0
+	for feature in pii_features:
+		path = os.path.join(accession.bulkext_dir, '%s.txt' % feature)
+		if not os.path.isfile(path): # scanner found nothing or is disabled
+			continue
+		num_bytes += os.path.getsize(path)
+		batch = []
+		with open(path, 'rb') as in_file:
+			for row in csv.reader(in_file, delimiter='\t', quoting=csv.QUOTE_NONE):
+				if len(row) < 2 or row[0].startswith('#'): # skip banner lines
+					continue
+				# forensic path is file and offset, e.g. /source/a.txt-120 or /source/b.zip-1024-ZIP-0
+				match = forensic_path_re.match(row[0])
+				if match is None:
+					batch.append((row[0], '', feature, row[1], row[2] if len(row) > 2 else ''))
+				else:
+					batch.append((match.group(1), match.group(2), feature, row[1], row[2] if len(row) > 2 else ''))
+				if len(batch) == insert_batch_size:
+					accession.cursor.executemany("INSERT INTO pii_hits VALUES (?, ?, ?, ?, ?)", batch)
+					num_hits += len(batch)
+					batch = []
+		accession.cursor.executemany("INSERT INTO pii_hits VALUES (?, ?, ?, ?, ?)", batch)
+		num_hits += len(batch)
+	accession.cursor.execute("CREATE INDEX idx_pii_hits_file ON pii_hits (file, feature)")
+	accession.cursor.execute("CREATE INDEX idx_pii_hits_feature ON pii_hits (feature, file)")
+	accession.conn.commit()
+	accession.cursor.execute("PRAGMA temp_store = MEMORY")
+	return num_hits, num_bytes
+
+def find_duplicates(accession):
+	'''Group duplicate files into duplicate_groups table'''
+	accession.cursor.execute("DROP TABLE IF EXISTS duplicate_groups")
+	accession.cursor.execute("CREATE TABLE duplicate_groups (group_id integer primary key, md5 text, filesize integer, copies integer, wasted_bytes integer)")
+	# only files sharing a size can share a hash, so group by size first and hash within those sizes
+	sql = ("INSERT INTO duplicate_groups (md5, filesize, copies, wasted_bytes) "
+		"SELECT md5, filesize, COUNT(*), (COUNT(*) - 1) * filesize FROM files "
+		"WHERE filesize IN (SELECT filesize FROM files WHERE filesize > 0 GROUP BY filesize HAVING COUNT(*) > 1) AND md5 <> '' "
+		"GROUP BY filesize, md5 HAVING COUNT(*) > 1 ORDER BY md5, filesize")
+	accession.cursor.execute(sql)
+	accession.cursor.execute("CREATE INDEX idx_duplicate_groups_md5 ON duplicate_groups (md5, filesize)")
+	accession.conn.commit()
+
+def attach_hash_index(accession):
+	'''Attach shared hash index db, creating its tables if needed'''
+	accession.cursor.execute("ATTACH DATABASE ? AS hash_index", (accession.args.hash_index,))
+	accession.cursor.execute("PRAGMA busy_timeout = %d" % hash_index_timeout)
+	accession.cursor.execute("PRAGMA hash_index.journal_mode = WAL") # readers and the one writer don't block each other
+	accession.cursor.execute("PRAGMA hash_index.cache_size = -65536") # 64 MB
+	# keyed on (md5, filesize) so lookups are index seeks however many accessions are indexed
+	accession.cursor.execute("CREATE TABLE IF NOT EXISTS hash_index.hashes (md5 text, filesize integer, accession text, path text, "
+		"PRIMARY KEY (md5, filesize, accession, path)) WITHOUT ROWID")
+	accession.cursor.execute("CREATE INDEX IF NOT EXISTS hash_index.idx_hashes_accession ON hashes (accession)")
+	accession.cursor.execute("CREATE TABLE IF NOT EXISTS hash_index.accessions (accession text PRIMARY KEY, source text, num_files integer, indexed text)")
+
+def update_hash_index(accession, source_dir):
+	'''Find files already held in other accessions, then record this accession's hashes in shared index, with paths relative to source_dir'''
+	attach_hash_index(accession)
+	accession.cursor.execute("DROP TABLE IF EXISTS held_elsewhere")
+	accession.cursor.execute("CREATE TABLE held_elsewhere (filename text, md5 text, filesize integer, accessions integer, example_accession text, "
+		"example_source text, example_path text)")
+	# CROSS JOIN keeps this accession's files as the outer loop, seeking into the much larger index
+	accession.cursor.execute("INSERT INTO held_elsewhere "
+		"SELECT s.filename, s.md5, s.filesize, COUNT(DISTINCT h.accession), MIN(h.accession), a.source, h.path "
+		"FROM files s CROSS JOIN hash_index.hashes h ON h.md5 = s.md5 AND h.filesize = s.filesize "
+		"LEFT JOIN hash_index.accessions a ON a.accession = h.accession "
+		"WHERE s.md5 <> '' AND s.filesize > 0 AND h.accession <> ? "
+		"GROUP BY s.filename ORDER BY s.filename", (accession.basename,))
+	accession.conn.commit()
 
+	# replace this accession's hashes in one write transaction, waiting for other writers up to busy timeout
+	accession.cursor.execute("BEGIN IMMEDIATE")
+	accession.cursor.execute("DELETE FROM hash_index.hashes WHERE accession = ?", (accession.basename,))
+	# sf filenames start with source_dir as given, relative to the working directory or under carved_files, so keep the rest,
+	# compared as bytes since sqlite counts text in characters
+	prefix = os.path.join(source_dir, '')
+	accession.cursor.execute("INSERT OR IGNORE INTO hash_index.hashes (md5, filesize, accession, path) "
+		"SELECT md5, filesize, ?1, CASE WHEN SUBSTR(CAST(filename AS BLOB), 1, ?2) = CAST(?3 AS BLOB) "
+		"THEN CAST(SUBSTR(CAST(filename AS BLOB), ?2 + 1) AS TEXT) ELSE filename END "
+		"FROM files WHERE md5 <> '' AND filesize > 0 ORDER BY md5, filesize", (accession.basename, len(prefix), prefix))
+	num_hashes = accession.cursor.rowcount
+	accession.cursor.execute("INSERT OR REPLACE INTO hash_index.accessions (accession, source, num_files, indexed) VALUES (?, ?, ?, ?)",
+		(accession.basename, os.path.abspath(accession.args.source), num_hashes, str(datetime.datetime.now())))
+	accession.conn.commit()
+	accession.cursor.execute("DETACH DATABASE hash_index")
+	print("\nRecorded %s hashes in hash index %s." % (num_hashes, accession.args.hash_index))
+
+def summarize(accession):
+	'''Compute aggregate statistics in one pass over files table plus counts by integer key, return summary dict'''
+	sql = ("SELECT COUNT(*), "
+		"COUNT(DISTINCT CASE WHEN filesize > 0 THEN md5 END), " # distinct files
+		"IFNULL(SUM(filesize = 0), 0), " # empty files
+		"IFNULL(SUM(errors <> ''), 0), " # siegfried errors
+		"MIN(year), MAX(year), " # year range
+		"MIN(NULLIF(modified, '')), MAX(NULLIF(modified, '')) " # date range
+		"FROM files")
+	accession.cursor.execute(sql)
+	keys = ['num_files', 'distinct_files', 'empty_files', 'num_errors', 'begin_date', 'end_date', 'earliest_date', 'latest_date']
+	summary = dict(zip(keys, accession.cursor.fetchone()))
+
+	# matches in first identifier, counted per format and warning key before looking up their strings
+	accession.cursor.execute("SELECT IFNULL(SUM(CASE WHEN fo.id = 'UNKNOWN' THEN c.num END), 0), COUNT(DISTINCT NULLIF(fo.format, '')) "
+		"FROM (SELECT format_id, COUNT(*) AS num FROM identifications WHERE namespace_id = 1 GROUP BY format_id) c "
+		"JOIN formats fo ON fo.format_id = c.format_id")
+	summary['unidentified_files'], summary['num_formats'] = accession.cursor.fetchone()
+	accession.cursor.execute("SELECT IFNULL(SUM(c.num), 0) "
+		"FROM (SELECT warning_id, COUNT(*) AS num FROM identifications WHERE namespace_id = 1 GROUP BY warning_id) c "
+		"JOIN warnings w ON w.warning_id = c.warning_id WHERE w.warning <> ''")
+	summary['num_warnings'] = accession.cursor.fetchone()[0]
+	summary['namespaces'] = accession.cursor.execute("SELECT namespace, details FROM namespaces ORDER BY namespace_id").fetchall()
+
+	accession.cursor.execute("SELECT IFNULL(SUM(size), 0) FROM inventory WHERE type = 'file'") # total bytes
+	summary['total_bytes'] = accession.cursor.fetchone()[0]
+
+	accession.cursor.execute("SELECT COUNT(*), IFNULL(SUM(copies - 1), 0) FROM duplicate_groups;") # distinct duplicates and duplicate copies of unique files
+	summary['distinct_dupes'], summary['duplicate_copies'] = accession.cursor.fetchone()
+
+	if accession.args.hash_index is not None:
+		accession.cursor.execute("SELECT COUNT(*), IFNULL(SUM(filesize), 0) FROM held_elsewhere") # files already in other accessions
+		summary['held_elsewhere_files'], summary['held_elsewhere_bytes'] = accession.cursor.fetchone()
+	return summary
+
+def human_size(num_bytes):
+	'''Format byte count for display, e.g. 1.5 MB'''
+	size = float(num_bytes)
+	for unit in ['bytes', 'KB', 'MB', 'GB', 'TB']:
+		if size < 1024 or unit == 'TB':
+			break
+		size /= 1024
+	if unit == 'bytes':
+		return '%d bytes' % num_bytes
+	return '%.1f %s' % (size, unit)
+
+def get_stats(accession, scan_started, summary=None):
+	'''Get aggregate statistics, unless stored by an earlier run, and write to html report'''
+	if summary is None:
+		summary = summarize(accession)
+	write_stats_html(accession, summary, scan_started)
+	return summary
+
+def db_tables(accession):
+	'''Return names of tables and views in sqlite db'''
+	return set(name for name, in accession.cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"))
+
+def from_json(text):
+	'''Decode json stored in db, with strings as utf-8 str like the rest of the db'''
+	def encode(value):
+		if isinstance(value, unicode):
+			return value.encode('utf-8')
+		if isinstance(value, list):
+			return [encode(item) for item in value]
+		if isinstance(value, dict):
+			return dict((encode(key), encode(item)) for key, item in value.items())
+		return value
+	return encode(json.loads(text))
+
+def save_run(accession, summary, scan_started, source_dir):
+	'''Store provenance and aggregate stats in db, so --report-only can rewrite reports without rescanning'''
+	provenance = {'source': os.path.abspath(accession.args.source), 'source_dir': source_dir, 'scan_started': scan_started,
+		'sf_command': accession.sf_command, 'siegfried_version': accession.sf_version or siegfried_version(), 'brunnhilde_version': brunnhilde_version,
+		'cache_stats': accession.cache_stats, 'carve_stats': accession.carve_stats, 'stages': accession.metrics['stages'], 'inventory_retaken': accession.inventory_retaken,
+		'hash_index': os.path.abspath(accession.args.hash_index) if accession.args.hash_index is not None else None}
+	for table, values in [('provenance', provenance), ('summary', summary)]:
+		accession.cursor.execute("DROP TABLE IF EXISTS %s" % table)
+		accession.cursor.execute("CREATE TABLE %s (name text primary key, value text)" % table)
+		accession.cursor.executemany("INSERT INTO %s VALUES (?, ?)" % table, [(name, json.dumps(value)) for name, value in values.items()])
+	accession.conn.commit()
+
+def load_run(accession):
+	'''Load results of an earlier run from db for --report-only, re-importing siegfried output if needed, return stored provenance and summary'''
+	tables = db_tables(accession)
+	if 'files' not in tables: # db missing, or from before siegfried output was normalized
+		if not os.path.isfile(accession.sf_file):
+			for name in ['siegfried.csv', 'siegfried.json']:
+				if os.path.isfile(os.path.join(accession.report_dir, name)):
+					accession.sf_file = os.path.join(accession.report_dir, name)
+					accession.args.json = name.endswith('.json')
+		if not os.path.isfile(accession.sf_file):
+			raise BrunnhildeError("No siegfried.sqlite or Siegfried output to report on in %s." % accession.report_dir)
+		print("\nRe-importing %s." % accession.sf_file)
+		import_csv(accession)
+		tables = db_tables(accession)
+	retaken = None
+	if 'inventory' not in tables:
+		if not os.path.isdir(accession.args.source):
+			raise BrunnhildeError("No inventory in siegfried.sqlite, and source directory %s is not available to take one." % accession.args.source)
+		take_inventory(accession, accession.args.source)
+		retaken = str(datetime.datetime.now()) # from the source as it is now, which may differ from what was scanned
+	if 'duplicate_groups' not in tables:
+		find_duplicates(accession)
+	if 'pii_hits' not in tables and any(os.path.isfile(os.path.join(accession.bulkext_dir, '%s.txt' % feature)) for feature in pii_features):
+		import_pii(accession)
+		tables = db_tables(accession)
+
+	provenance = {}
+	summary = None
+	if 'provenance' in tables and 'summary' in tables:
+		provenance = dict((name, from_json(value)) for name, value in accession.cursor.execute("SELECT name, value FROM provenance"))
+		summary = dict((name, from_json(value)) for name, value in accession.cursor.execute("SELECT name, value FROM summary"))
+	else:
+		print("\nNo provenance stored in siegfried.sqlite. Scan details are reported as unknown.")
+	accession.sf_command = provenance.get('sf_command', 'Unknown')
+	accession.sf_version = provenance.get('siegfried_version', 'Unknown')
+	accession.cache_stats = provenance.get('cache_stats')
+	accession.carve_stats = provenance.get('carve_stats')
+	accession.inventory_retaken = retaken or provenance.get('inventory_retaken')
+	accession.metrics['stages'] = provenance.get('stages', [])
+	accession.args.source = provenance.get('source', accession.args.source)
+	# report on what the earlier run loaded, whatever options are given now
+	accession.args.hash_index = provenance.get('hash_index') if 'held_elsewhere' in tables else None
+	accession.args.bulkextractor = 'pii_hits' in tables
+	return provenance, summary
+
+def write_stats_html(accession, summary, scan_started):
+	'''Write report head, provenance and aggregate statistics to html report'''
 	# write html
-	html.write('<!DOCTYPE html>')
-	html.write('\n<html lang="en">')
-	html.write('\n<head>')
-	html.write('\n<title>Brunnhilde report for: %s</title>' % basename)
-	html.write('\n<meta http-equiv="Content-Type" content="text/html; charset=utf-8">')
-	html.write('\n<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u" crossorigin="anonymous">')
-	html.write('\n</head>')
-	html.write('\n<body max>')
-	html.write('\n<h1>Brunnhilde HTML report</h1>')
-	html.write('\n<h3>Input source (directory or disk image)</h3>')
-	html.write('\n<p>%s</p>' % os.path.abspath(args.source))
-	html.write('\n<h3>Accession/Identifier</h3>')
-	html.write('\n<p>%s</p>' % basename)
-	html.write('\n<h2>Provenance information</h2>')
-	html.write('\n<h3>Brunnhilde version</h3>')
-	html.write('\n<p>%s</p>' % brunnhilde_version)
-	html.write('\n<h3>Siegfried version</h3>')
-	html.write('\n<p>%s</p>' % siegfried_version)
-	html.write('\n<h3>Siegfried command</h3>')
-	html.write('\n<p>%s</p>' % sf_command)
-	html.write('\n<h3>Time of scan</h3>')
-	html.write('\n<p>%s</p>' % scan_started)
-	html.write('\n<h2>Aggregate stats</h2>')
-	html.write('\n<h3>Overview</h3>')
-	html.write('\n<p>Total files: %s</p>' % num_files)
-	html.write('\n<p>Total size: %s</p>' % size)
-	html.write('\n<p>Years (last modified): %s - %s</p>' % (begin_date, end_date))
-	html.write('\n<p>Earliest date: %s</p>' % earliest_date)
-	html.write('\n<p>Latest date: %s</p>' % latest_date)
-	html.write('\n<h3>File contents*</h3>')
-	html.write('\n<p>Distinct files: %s</p>' % distinct_files)
-	html.write('\n<p>Distinct files that have duplicates: %s</p>' % distinct_dupes)
-	html.write('\n<p>Duplicate copies of distinct files: %s</p>' % duplicate_copies)
-	html.write('\n<p>Empty files: %s</p>' % empty_files)
-	html.write('\n<p>*<em>Calculated by md5 hash. Empty files are not counted in first three categories. Total files = distinct files + duplicate copies + empty files.</em></p>')
-	html.write('\n<h3>Format identification</h3>')
-	html.write('\n<p>Identified file formats: %s</p>' % num_formats)
-	html.write('\n<p>Unidentified files: %s</p>' % unidentified_files)
-	html.write('\n<p>Siegfried warnings: %s</p>' % num_warnings)
-	html.write('\n<h3>Errors</h3>')
-	html.write('\n<p>Siegfried errors: %s</p>' % num_errors)
-	html.write('\n<h2>Detailed reports</h2>')
-	html.write('\n<p><a href="#File formats">File formats</a></p>')
-	html.write('\n<p><a href="#File formats and versions">File formats and versions</a></p>')
-	html.write('\n<p><a href="#MIME types">MIME types</a></p>')
-	html.write('\n<p><a href="#Last modified dates by year">Last modified dates by year</a></p>')
-	html.write('\n<p><a href="#Unidentified">Unidentified</a></p>')
-	html.write('\n<p><a href="#Warnings">Warnings</a></p>')
-	html.write('\n<p><a href="#Errors">Errors</a></p>')
-	html.write('\n<p><a href="#Duplicates">Duplicates</a></p>')
-	if args.bulkextractor == True:
-		html.write('\n<p><a href="#Personally Identifiable Information (PII)">Personally Identifiable Information (PII)</a></p>')
-
-def generate_reports():
-	'''Run sql queries on db to generate reports, write to csv and html'''
+	write_html_head(accession.html, 'Brunnhilde report for: %s' % accession.basename)
+	accession.html.write('\n<h1>Brunnhilde HTML report</h1>')
+	accession.html.write('\n<h3>Input source (directory or disk image)</h3>')
+	accession.html.write('\n<p>%s</p>' % html_cell(os.path.abspath(accession.args.source)))
+	accession.html.write('\n<h3>Accession/Identifier</h3>')
+	accession.html.write('\n<p>%s</p>' % html_cell(accession.basename))
+	accession.html.write('\n<h2>Provenance information</h2>')
+	accession.html.write('\n<h3>Brunnhilde version</h3>')
+	accession.html.write('\n<p>%s</p>' % brunnhilde_version)
+	accession.html.write('\n<h3>Siegfried version</h3>')
+	accession.html.write('\n<p>%s</p>' % html_cell(accession.sf_version or siegfried_version()))
+	accession.html.write('\n<h3>Siegfried command</h3>')
+	accession.html.write('\n<p>%s</p>' % html_cell(accession.sf_command))
+	accession.html.write('\n<h3>Siegfried identifiers</h3>')
+	for number, (namespace, details) in enumerate(summary['namespaces']):
+		note = ''
+		if number == 0 and len(summary['namespaces']) > 1:
+			note = ' (used for aggregate stats and reports)'
+		accession.html.write('\n<p>%s%s</p>' % (html_cell(' '.join([namespace, details]).strip()), note))
+	if accession.cache_stats is not None:
+		accession.html.write('\n<h3>Incremental scan</h3>')
+		accession.html.write('\n<p>Rows reused from cache: %s</p>' % accession.cache_stats['cached'])
+		accession.html.write('\n<p>Rows from fresh scan: %s</p>' % accession.cache_stats['fresh'])
+		accession.html.write('\n<p>Deleted files pruned from cache: %s</p>' % accession.cache_stats['pruned'])
+	if accession.carve_stats is not None:
+		accession.html.write('\n<h3>Disk image carving</h3>')
+		if accession.carve_stats['reused'] == True:
+			accession.html.write('\n<p>Reused files carved on %s from unchanged disk image (same size, modification time and sampled md5)</p>' % accession.carve_stats['carved'])
+			accession.html.write('\n<p>Time saved: %.1f seconds</p>' % accession.carve_stats['seconds'])
+			accession.html.write('\n<p>Writes saved: %s</p>' % human_size(accession.carve_stats['bytes']))
+		else:
+			accession.html.write('\n<p>Carved %s files (%s) from %s partition(s) in %.1f seconds</p>' % (accession.carve_stats['files'],
+				human_size(accession.carve_stats['bytes']), accession.carve_stats['partitions'], accession.carve_stats['seconds']))
+		accession.html.write('\n<p>Carved files: %s</p>' % html_cell(accession.carve_stats['path']))
+	accession.html.write('\n<h3>Time of scan</h3>')
+	accession.html.write('\n<p>%s</p>' % scan_started)
+	if accession.inventory_retaken is not None:
+		accession.html.write('\n<h3>Inventory</h3>')
+		accession.html.write('\n<p>Taken again on %s, as siegfried.sqlite had none. Total size and tree.txt describe the source as it was then, and may not match the scanned files.</p>' % accession.inventory_retaken)
+	accession.html.write('\n<h3>Performance</h3>')
+	accession.html.write('\n<table class="table table-striped table-bordered table-condensed">')
+	write_row(accession.html, ['Stage', 'Seconds', 'CPU seconds', 'Peak memory', 'Rows', 'Bytes read'])
+	for record in accession.metrics['stages']:
+		peak = None
+		if record['peak_rss_kb'] is not None:
+			peak = human_size(record['peak_rss_kb'] * 1024)
+		bytes_read = None
+		if record['bytes_read'] is not None:
+			bytes_read = human_size(record['bytes_read'])
+		write_row(accession.html, [record['stage'], '%.1f' % record['seconds'], record['cpu_seconds'], peak, record['rows'], bytes_read])
+	accession.html.write('\n</table>')
+	accession.html.write('\n<p><em>Scans run concurrently, so their CPU time and peak memory are those of the external tool alone. Later stages are recorded in <a href="metrics.json">metrics.json</a>.</em></p>')
+	accession.html.write('\n<h2>Aggregate stats</h2>')
+	accession.html.write('\n<h3>Overview</h3>')
+	accession.html.write('\n<p>Total files: %s</p>' % summary['num_files'])
+	accession.html.write('\n<p>Total size: %s</p>' % human_size(summary['total_bytes']))
+	accession.html.write('\n<p>Years (last modified): %s - %s</p>' % (summary['begin_date'], summary['end_date']))
+	accession.html.write('\n<p>Earliest date: %s</p>' % summary['earliest_date'])
+	accession.html.write('\n<p>Latest date: %s</p>' % summary['latest_date'])
+	accession.html.write('\n<h3>File contents*</h3>')
+	accession.html.write('\n<p>Distinct files: %s</p>' % summary['distinct_files'])
+	accession.html.write('\n<p>Distinct files that have duplicates: %s</p>' % summary['distinct_dupes'])
+	accession.html.write('\n<p>Duplicate copies of distinct files: %s</p>' % summary['duplicate_copies'])
+	accession.html.write('\n<p>Empty files: %s</p>' % summary['empty_files'])
+	accession.html.write('\n<p>*<em>Calculated by md5 hash. Empty files are not counted in first three categories. Total files = distinct files + duplicate copies + empty files.</em></p>')
+	if accession.args.hash_index is not None:
+		if summary['num_files'] > 0:
+			percent = 100.0 * summary['held_elsewhere_files'] / summary['num_files']
+		else:
+			percent = 0.0
+		accession.html.write('\n<h3>Previously held elsewhere*</h3>')
+		accession.html.write('\n<p>Files already in other accessions: %s (%.1f%% of files)</p>' % (summary['held_elsewhere_files'], percent))
+		accession.html.write('\n<p>Size of files already in other accessions: %s</p>' % human_size(summary['held_elsewhere_bytes']))
+		accession.html.write('\n<p>*<em>Calculated by md5 hash and size against hash index %s. Empty files are not counted.</em></p>' % html_cell(os.path.abspath(accession.args.hash_index)))
+	accession.html.write('\n<h3>Format identification</h3>')
+	accession.html.write('\n<p>Identified file formats: %s</p>' % summary['num_formats'])
+	accession.html.write('\n<p>Unidentified files: %s</p>' % summary['unidentified_files'])
+	accession.html.write('\n<p>Siegfried warnings: %s</p>' % summary['num_warnings'])
+	accession.html.write('\n<h3>Errors</h3>')
+	accession.html.write('\n<p>Siegfried errors: %s</p>' % summary['num_errors'])
+	accession.html.write('\n<h2>Detailed reports</h2>')
+	accession.html.write('\n<p><a href="#File formats">File formats</a></p>')
+	accession.html.write('\n<p><a href="#File formats and versions">File formats and versions</a></p>')
+	accession.html.write('\n<p><a href="#MIME types">MIME types</a></p>')
+	accession.html.write('\n<p><a href="#Last modified dates by year">Last modified dates by year</a></p>')
+	accession.html.write('\n<p><a href="#Unidentified">Unidentified</a></p>')
+	accession.html.write('\n<p><a href="#Warnings">Warnings</a></p>')
+	accession.html.write('\n<p><a href="#Errors">Errors</a></p>')
+	accession.html.write('\n<p><a href="#Duplicates">Duplicates</a></p>')
+	accession.html.write('\n<p><a href="#Largest wasted space">Largest wasted space</a></p>')
+	if accession.args.hash_index is not None:
+		accession.html.write('\n<p><a href="#Previously held elsewhere">Previously held elsewhere</a></p>')
+	if len(summary['namespaces']) > 1:
+		accession.html.write('\n<p><a href="#Other identifiers">Other identifiers</a></p>')
+	if accession.args.bulkextractor == True:
+		accession.html.write('\n<p><a href="#PII by feature type">PII by feature type</a></p>')
+		accession.html.write('\n<p><a href="#PII by file">PII by file</a></p>')
+		accession.html.write('\n<p><a href="#Personally Identifiable Information (PII)">Personally Identifiable Information (PII)</a></p>')
+
+def generate_reports(accession):
+	'''Run sql queries on db to generate reports, write to csv and html, return number of rows written'''
+	num_rows = 0
 	full_header = ['Filename', 'Filesize', 'Date modified', 'Errors', 'Checksum', 
 				'Namespace', 'ID', 'Format', 'Format Version', 'MIME type', 
 				'Basis for ID', 'Warning']
 
 	# sorted format list report
-	sql = "SELECT format, id, COUNT(*) as 'num' FROM siegfried GROUP BY format ORDER BY num DESC"
-	path = os.path.join(csv_dir, 'formats.csv')
+	sql = ("SELECT fo.format, fo.id, SUM(c.num) as 'num' FROM (SELECT format_id, COUNT(*) AS num FROM identifications WHERE namespace_id = 1 GROUP BY format_id) c "
+		"JOIN formats fo ON fo.format_id = c.format_id GROUP BY fo.format ORDER BY num DESC")
+	path = os.path.join(accession.csv_dir, 'formats.csv')
 	format_header = ['Format', 'ID', 'Count']
-	sqlite_to_csv(sql, path, format_header)
-	write_html('File formats', path, ',')
+	num_rows += write_report(accession, 'File formats', sql, path, format_header)
 
 	# sorted format and version list report
-	sql = "SELECT format, id, version, COUNT(*) as 'num' FROM siegfried GROUP BY format, version ORDER BY num DESC"
-	path = os.path.join(csv_dir, 'formatVersions.csv')
+	sql = ("SELECT fo.format, fo.id, fo.version, SUM(c.num) as 'num' FROM (SELECT format_id, COUNT(*) AS num FROM identifications WHERE namespace_id = 1 GROUP BY format_id) c "
+		"JOIN formats fo ON fo.format_id = c.format_id GROUP BY fo.format, fo.version ORDER BY num DESC")
+	path = os.path.join(accession.csv_dir, 'formatVersions.csv')
 	version_header = ['Format', 'ID', 'Version', 'Count']
-	sqlite_to_csv(sql, path, version_header)
-	write_html('File formats and versions', path, ',')
+	num_rows += write_report(accession, 'File formats and versions', sql, path, version_header)
 
 	# sorted mimetype list report
-	sql = "SELECT mime, COUNT(*) as 'num' FROM siegfried GROUP BY mime ORDER BY num DESC"
-	path = os.path.join(csv_dir, 'mimetypes.csv')
+	sql = ("SELECT m.mime, c.num FROM (SELECT mime_id, COUNT(*) AS num FROM identifications WHERE namespace_id = 1 GROUP BY mime_id) c "
+		"JOIN mimes m ON m.mime_id = c.mime_id ORDER BY c.num DESC")
+	path = os.path.join(accession.csv_dir, 'mimetypes.csv')
 	mime_header = ['MIME type', 'Count']
-	sqlite_to_csv(sql, path, mime_header)
-	write_html('MIME types', path, ',')
+	num_rows += write_report(accession, 'MIME types', sql, path, mime_header)
 
 	# dates report
-	sql = "SELECT SUBSTR(modified, 1, 4) as 'year', COUNT(*) as 'num' FROM siegfried GROUP BY year ORDER BY num DESC"
-	path = os.path.join(csv_dir, 'years.csv')
+	sql = "SELECT year, COUNT(*) as 'num' FROM files GROUP BY year ORDER BY num DESC"
+	path = os.path.join(accession.csv_dir, 'years.csv')
 	year_header = ['Year Last Modified', 'Count']
-	sqlite_to_csv(sql, path, year_header)
-	write_html('Last modified dates by year', path, ',')
+	num_rows += write_report(accession, 'Last modified dates by year', sql, path, year_header)
 
 	# unidentified files report
-	sql = "SELECT * FROM siegfried WHERE id='UNKNOWN';"
-	path = os.path.join(csv_dir, 'unidentified.csv')
-	sqlite_to_csv(sql, path, full_header)
-	write_html('Unidentified', path, ',')
+	sql = "SELECT %s FROM siegfried WHERE id='UNKNOWN';" % sf_select
+	path = os.path.join(accession.csv_dir, 'unidentified.csv')
+	num_rows += write_report(accession, 'Unidentified', sql, path, full_header)
 
 	# warnings report
-	sql = "SELECT * FROM siegfried WHERE warning <> '';"
-	path = os.path.join(csv_dir, 'warnings.csv')
-	sqlite_to_csv(sql, path, full_header)
-	write_html('Warnings', path, ',')
+	sql = "SELECT %s FROM siegfried WHERE warning <> '';" % sf_select
+	path = os.path.join(accession.csv_dir, 'warnings.csv')
+	num_rows += write_report(accession, 'Warnings', sql, path, full_header)
 
 	# errors report
-	sql = "SELECT * FROM siegfried WHERE errors <> '';"
-	path = os.path.join(csv_dir, 'errors.csv')
-	sqlite_to_csv(sql, path, full_header)
-	write_html('Errors', path, ',')
+	sql = "SELECT %s FROM siegfried WHERE errors <> '';" % sf_select
+	path = os.path.join(accession.csv_dir, 'errors.csv')
+	num_rows += write_report(accession, 'Errors', sql, path, full_header)
 
 	# duplicates report
-	sql = "SELECT * FROM siegfried t1 WHERE EXISTS (SELECT 1 from siegfried t2 WHERE t2.md5 = t1.md5 AND t1.filename != t2.filename) AND filesize<>'0' ORDER BY md5;"
-	path = os.path.join(csv_dir, 'duplicates.csv')
-	sqlite_to_csv(sql, path, full_header)
-	write_html('Duplicates', path, ',')
+	sql = "SELECT %s FROM siegfried s JOIN duplicate_groups d ON s.md5 = d.md5 AND s.filesize = d.filesize ORDER BY d.group_id, s.filename;" % ", ".join(["s.%s" % column for column in sf_columns])
+	path = os.path.join(accession.csv_dir, 'duplicates.csv')
+	num_rows += write_report(accession, 'Duplicates', sql, path, full_header)
 
-def sqlite_to_csv(sql, path, header):
-	'''Write sql query result to csv'''
+	# wasted space report
+	sql = "SELECT md5, filesize, copies, wasted_bytes FROM duplicate_groups ORDER BY wasted_bytes DESC, md5"
+	path = os.path.join(accession.csv_dir, 'wastedSpace.csv')
+	wasted_header = ['Checksum', 'Filesize', 'Copies', 'Wasted bytes']
+	num_rows += write_report(accession, 'Largest wasted space', sql, path, wasted_header)
+
+	# files already held in other accessions report
+	if accession.args.hash_index is not None:
+		sql = "SELECT filename, md5, filesize, accessions, example_accession, example_source, example_path FROM held_elsewhere ORDER BY filename"
+		path = os.path.join(accession.csv_dir, 'heldElsewhere.csv')
+		held_header = ['Filename', 'Checksum', 'Filesize', 'Other accessions', 'Example accession', 'Example source', 'Example path']
+		num_rows += write_report(accession, 'Previously held elsewhere', sql, path, held_header)
+
+	# formats found by identifiers after the first
+	accession.cursor.execute("SELECT COUNT(*) FROM namespaces")
+	if accession.cursor.fetchone()[0] > 1:
+		sql = ("SELECT n.namespace, fo.id, fo.format, fo.version, c.num FROM (SELECT namespace_id, format_id, COUNT(*) AS num "
+			"FROM identifications WHERE namespace_id > 1 GROUP BY namespace_id, format_id) c "
+			"JOIN namespaces n ON n.namespace_id = c.namespace_id JOIN formats fo ON fo.format_id = c.format_id "
+			"ORDER BY n.namespace_id, c.num DESC")
+		path = os.path.join(accession.csv_dir, 'otherIdentifiers.csv')
+		other_header = ['Namespace', 'ID', 'Format', 'Format Version', 'Count']
+		num_rows += write_report(accession, 'Other identifiers', sql, path, other_header)
+	return num_rows
+
+def write_report(accession, header, sql, path, csv_header):
+	'''Stream sql query result once into csv report and html table'''
 	with open(path, 'wb') as report:
 		w = csv.writer(report)
-		w.writerow(header)
-		for row in cursor.execute(sql):
-			w.writerow(row)
-
-def write_html(header, path, file_delimiter):
-	'''Write csv file to html table'''
-	with open(path, 'rb') as in_file:
-		# count lines and then return to start of file
-		numline = len(in_file.readlines())
-		in_file.seek(0)
-
-		#open csv reader
-		r = csv.reader(in_file, delimiter="%s" % file_delimiter)
-
-		# write header
-		html.write('\n<a name="%s"></a>' % header)
-		html.write('\n<h3>%s</h3>' % header)
-		if header == 'Duplicates':
-			html.write('\n<p><em>Duplicates are grouped by md5 hash.</em></p>')
-		elif header == 'Personally Identifiable Information (PII)':
-			html.write('\n<p><em>Potential PII in source, as identified by bulk_extractor.</em></p>')
-		
-		# if writing PII, handle separately
-		if header == 'Personally Identifiable Information (PII)':
-			if numline > 5: # aka more rows than just header
-				html.write('\n<table class="table table-striped table-bordered table-condensed">')
-				#write header
-				html.write('\n<tr>')
-				html.write('\n<td>File</td>')
-				html.write('\n<td>Value Found</td>')
-				html.write('\n<td>Context</td>')
-				# write data
-				for row in islice(r, 4, None): # skip header lines
-					html.write('\n</tr>')
-					for row in r:
-						# write data
-						html.write('\n<tr>')
-						for column in row:
-							html.write('\n<td>' + column + '</td>')
-						html.write('\n</tr>')
-					html.write('\n</table>')
+		w.writerow(csv_header)
+		def rows():
+			for row in accession.cursor.execute(sql):
+				w.writerow(row)
+				yield row
+		return write_html(accession, header, csv_header, rows())
+
+def write_pii(accession):
+	'''Write pii hit summaries and capped list of hits to html, all hits to csv, return number of rows written'''
+	num_rows = 0
+	accession.cursor.execute("PRAGMA temp_store = FILE") # as in import_pii
+
+	# hits per feature type report
+	sql = "SELECT feature, COUNT(*) AS hits, COUNT(DISTINCT file) FROM pii_hits GROUP BY feature ORDER BY hits DESC"
+	path = os.path.join(accession.csv_dir, 'piiFeatures.csv')
+	num_rows += write_report(accession, 'PII by feature type', sql, path, ['Feature type', 'Hits', 'Files'])
+
+	# hits per file report
+	sql = "SELECT file, COUNT(*) AS hits, GROUP_CONCAT(DISTINCT feature) FROM pii_hits GROUP BY file ORDER BY hits DESC, file"
+	path = os.path.join(accession.csv_dir, 'piiFiles.csv')
+	num_rows += write_report(accession, 'PII by file', sql, path, ['File', 'Hits', 'Feature types'])
+
+	# every hit in csv, first --pii-rows in html
+	pii_header = ['File', 'Offset', 'Feature type', 'Value found', 'Context']
+	with open(os.path.join(accession.csv_dir, 'piiHits.csv'), 'wb') as report:
+		w = csv.writer(report)
+		w.writerow(pii_header)
+		def rows():
+			for number, row in enumerate(accession.cursor.execute("SELECT file, offset, feature, value, context FROM pii_hits ORDER BY file, feature")):
+				w.writerow(row)
+				if number < accession.args.pii_rows:
+					yield row
+		num_rows += write_html(accession, 'Personally Identifiable Information (PII)', pii_header, rows())
+	accession.cursor.execute("PRAGMA temp_store = MEMORY")
+	return num_rows
+
+def html_cell(value):
+	'''Escape value for html table cell, linking PRONOM IDs'''
+	if value is None:
+		return ''
+	value = str(value)
+	if 'fmt/' in value and puid_re.match(value):
+		return '<a href="http://apps.nationalarchives.gov.uk/PRONOM/%s" target="_blank">%s</a>' % (value, value)
+	# most cells need no escaping, and the checks are cheaper than cgi.escape's replaces
+	if '&' in value or '<' in value or '>' in value or '"' in value:
+		return cgi.escape(value, True)
+	return value
+
+def write_row(out, row):
+	'''Write row to html table'''
+	out.write('\n<tr>%s\n</tr>' % ''.join(['\n<td>%s</td>' % html_cell(column) for column in row]))
+
+def page_path(header, number):
+	'''Return path of full-table page, relative to report directory'''
+	slug = re.sub(r'[^A-Za-z0-9]+', '-', header).strip('-').lower()
+	return os.path.join('html_pages', '%s-%04d.html' % (slug, number))
+
+def close_page(accession, pages, has_next):
+	'''Write navigation and closing tags to current full-table page'''
+	page = pages['file']
+	page.write('\n</table>')
+	page.write('\n<p>')
+	if pages['number'] > 1:
+		page.write('<a href="%s">Previous</a> | ' % os.path.basename(page_path(pages['header'], pages['number'] - 1)))
+	page.write('<a href="../%s.html#%s">Back to report</a>' % (html_cell(accession.basename), pages['header']))
+	if has_next:
+		page.write(' | <a href="%s">Next</a>' % os.path.basename(page_path(pages['header'], pages['number'] + 1)))
+	page.write('</p>')
+	close_html(page)
+	page.close()
+
+def write_page_row(accession, pages, row):
+	'''Write row to full-table pages, starting a new page when current one is full'''
+	if pages['file'] is None or pages['rows'] == accession.args.page_size:
+		if pages['file'] is not None:
+			close_page(accession, pages, True)
+		pages['number'] += 1
+		pages['rows'] = 0
+		pages['file'] = open(os.path.join(accession.report_dir, page_path(pages['header'], pages['number'])), 'wb')
+		write_html_head(pages['file'], '%s: %s (page %s)' % (accession.basename, pages['header'], pages['number']))
+		pages['file'].write('\n<h3>%s (page %s)</h3>' % (pages['header'], pages['number']))
+		pages['file'].write('\n<table class="table table-striped table-bordered table-condensed">')
+		write_row(pages['file'], pages['columns'])
+	write_row(pages['file'], row)
+	pages['rows'] += 1
+
+def write_html(accession, header, column_names, rows):
+	'''Write rows to html report as table, return number of rows'''
+	# write header
+	accession.html.write('\n<a name="%s"></a>' % header)
+	accession.html.write('\n<h3>%s</h3>' % header)
+	if header == 'Duplicates':
+		accession.html.write('\n<p><em>Duplicates are grouped by md5 hash.</em></p>')
+	elif header == 'Largest wasted space':
+		accession.html.write('\n<p><em>Space taken by duplicate copies beyond the first, per md5 hash.</em></p>')
+	elif header == 'Personally Identifiable Information (PII)':
+		accession.html.write('\n<p><em>Potential PII in source, as identified by bulk_extractor. Up to %s hits are shown, ordered by file; all hits are in csv_reports/piiHits.csv.</em></p>' % accession.args.pii_rows)
+
+	# generate table, opened on first row
+	num_rows = 0
+	preview = [] # with --paginate, rows held back until section outgrows its preview
+	pages = None
+	for row in rows:
+		if num_rows == 0:
+			accession.html.write('\n<table class="table table-striped table-bordered table-condensed">')
+			write_row(accession.html, column_names)
+		if accession.args.paginate == False:
+			write_row(accession.html, row)
+		elif num_rows < accession.args.preview:
+			write_row(accession.html, row)
+			preview.append(row)
+		else:
+			if pages is None: # full table goes to separate pages
+				pages = {'header': header, 'columns': column_names, 'file': None, 'number': 0, 'rows': 0}
+				for previewed in preview:
+					write_page_row(accession, pages, previewed)
+				preview = []
+			write_page_row(accession, pages, row)
+		num_rows += 1
+	if num_rows > 0:
+		accession.html.write('\n</table>')
+	else:
+		accession.html.write('\nNone found.')
+	if pages is not None:
+		close_page(accession, pages, False)
+		accession.html.write('\n<p><em>Showing first %s of %s rows.</em> Full table: <a href="%s">%s pages of up to %s rows</a></p>' % (accession.args.preview, num_rows, page_path(header, 1), pages['number'], accession.args.page_size))
+
+	# write link to top
+	accession.html.write('\n<p>(<a href="#top">Return to top</a>)</p>')
+	return num_rows
+
+def write_html_head(out, title):
+	'''Write html doctype and head'''
+	out.write('<!DOCTYPE html>')
+	out.write('\n<html lang="en">')
+	out.write('\n<head>')
+	out.write('\n<title>%s</title>' % html_cell(title))
+	out.write('\n<meta http-equiv="Content-Type" content="text/html; charset=utf-8">')
+	out.write('\n<link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u" crossorigin="anonymous">')
+	out.write('\n</head>')
+	out.write('\n<body max>')
+
+def close_html(out):
+	'''Write html closing tags'''
+	out.write('\n</body>')
+	out.write('\n</html>')
+
+def tree_size(num_bytes):
+	'''Format byte count the way tree -h does, e.g. 4.0K'''
+	size = float(num_bytes)
+	for unit in ['', 'K', 'M', 'G', 'T']:
+		if size < 1024 or unit == 'T':
+			break
+		size /= 1024
+	if unit == '':
+		return '%d' % num_bytes
+	if size < 9.95:
+		return '%.1f%s' % (size, unit)
+	return '%.0f%s' % (size, unit)
+
+def tree_date(mtime, now):
+	'''Format modification time the way tree -D does'''
+	if now - mtime > 60 * 60 * 24 * 182 or mtime > now:
+		return time.strftime('%b %d  %Y', time.localtime(mtime))
+	return time.strftime('%b %d %H:%M', time.localtime(mtime))
+
+def make_tree(accession, source_dir):
+	'''Render inventory as tree.txt, sorted by modification time like tree -tDhR'''
+	now = time.time()
+	num_dirs = 0
+	num_files = 0
+	with open(os.path.join(accession.report_dir, 'tree.txt'), 'wb') as tree:
+		tree.write('%s\n' % source_dir)
+		# stack of (indent prefix, remaining entries in reverse order)
+		sql = "SELECT path, name, type, size, mtime FROM inventory WHERE parent = ? ORDER BY mtime, name"
+		stack = [('', accession.cursor.execute(sql, ('',)).fetchall()[::-1])]
+		while stack:
+			prefix, entries = stack[-1]
+			if not entries:
+				stack.pop()
+				continue
+			path, name, entry_type, size, mtime = entries.pop()
+			last = not entries
+			tree.write('%s%s [%s %s]  %s\n' % (prefix, '\xe2\x94\x94\xe2\x94\x80\xe2\x94\x80' if last else '\xe2\x94\x9c\xe2\x94\x80\xe2\x94\x80', tree_size(size).rjust(4), tree_date(mtime, now), name))
+			if entry_type == 'dir':
+				num_dirs += 1
+				children = accession.cursor.execute(sql, (path,)).fetchall()[::-1]
+				stack.append((prefix + ('    ' if last else '\xe2\x94\x82   '), children))
 			else:
-				html.write('\nNone found.')
+				num_files += 1
+		tree.write('\n%s directories, %s files\n' % (num_dirs, num_files))
+
+def carve_files(accession, image, tempdir):
+	'''Export files from disk image into tempdir, return number of partitions carved'''
+	try:
+		os.makedirs(tempdir)
+	except OSError as exception:
+		if exception.errno != errno.EEXIST:
+			raise
+
+	if accession.args.hfs == True: # hfs disks
+		carvefiles = "bash /usr/share/hfsexplorer/bin/unhfs.sh -o '%s' '%s'" % (tempdir, image)
+		print("\nAttempting to carve files from disk image using HFS Explorer.")
+		# a failed extraction must not be recorded, or it would be reused while the image is unchanged
+		if subprocess.call(carvefiles, shell=True) != 0:
+			shutil.rmtree(accession.report_dir)
+			raise BrunnhildeError("Brunnhilde was unable to export files from disk image. Ending process.")
+		print("\nFile carving successful.")
+		return 1
+
+	# non-hfs disks (note: no UDF support yet)
+	partitions = []
+	if accession.args.carve_jobs > 1:
+		partitions = list_partitions(image)
+	if len(partitions) > 1:
+		return carve_partitions(accession, image, tempdir, partitions)
+
+	carvefiles = ['tsk_recover', '-a', image, tempdir]
+	print("\nAttempting to carve files from disk image using tsk_recover.")
+	try:
+		subprocess.check_output(carvefiles)
+		print("\nFile carving successful.")
+	except subprocess.CalledProcessError as e:
+		print(e.output)
+		shutil.rmtree(accession.report_dir)
+		raise BrunnhildeError("Brunnhilde was unable to export files from disk image. Ending process.")
+	return 1
+
+def list_partitions(image):
+	'''Return (start sector, description) of allocated partitions in disk image, listed by mmls'''
+	try:
+		with open(os.devnull, 'wb') as devnull:
+			output = subprocess.check_output(['mmls', '-a', image], stderr=devnull)
+	except (OSError, subprocess.CalledProcessError): # no volume system, or mmls not installed
+		return []
+	partitions = []
+	for line in output.splitlines():
+		# slot, table:slot, start, end, length, description
+		match = re.match(r'^\d+:\s+\S+\s+(\d+)\s+\d+\s+\d+\s+(.*)$', line)
+		if match is not None:
+			partitions.append((int(match.group(1)), match.group(2).strip()))
+	return partitions
+
+def carve_partition(accession, task):
+	'''Export files from one partition of disk image, return exit status of tsk_recover'''
+	image, tempdir, start = task
+	partition_dir = os.path.join(tempdir, 'partition_%d' % start)
+	os.makedirs(partition_dir)
+	with open(os.devnull, 'wb') as devnull:
+		return call_tool(accession, 'tsk_recover', ['tsk_recover', '-a', '-o', str(start), image, partition_dir], stdout=devnull)
+
+def carve_partitions(accession, image, tempdir, partitions):
+	'''Export files from partitions of disk image in parallel, each into its own subdirectory, return number carved'''
+	print("\nAttempting to carve files from %d partitions of disk image using tsk_recover, %d at a time." % (len(partitions), accession.args.carve_jobs))
+	pool = ThreadPool(min(accession.args.carve_jobs, len(partitions)))
+	try:
+		statuses = pool.map(lambda task: carve_partition(accession, task), [(image, tempdir, start) for start, description in partitions])
+	finally:
+		pool.close()
+		pool.join()
+	# like tsk_recover over the whole image, skip partitions without a file system it can read
+	for (start, description), status in zip(partitions, statuses):
+		if status != 0:
+			shutil.rmtree(os.path.join(tempdir, 'partition_%d' % start))
+			print("\nNo files carved from partition at sector %d (%s)." % (start, description))
+	if all(status != 0 for status in statuses):
+		shutil.rmtree(accession.report_dir)
+		raise BrunnhildeError("Brunnhilde was unable to export files from disk image. Ending process.")
+	print("\nFile carving successful.")
+	return statuses.count(0)
+
+def image_fingerprint(accession, image):
+	'''Return size, modification time and md5 of samples from start, middle and end of disk image'''
+	st = os.stat(image)
+	md5 = hashlib.md5()
+	offsets = set([0, max(st.st_size // 2 - carve_sample_bytes // 2, 0), max(st.st_size - carve_sample_bytes, 0)])
+	with open(image, 'rb') as f:
+		for offset in sorted(offsets):
+			f.seek(offset)
+			md5.update(f.read(carve_sample_bytes))
+	return {'size': st.st_size, 'mtime': st.st_mtime, 'sample_md5': md5.hexdigest(), 'hfs': accession.args.hfs}
+
+def carve_cached(accession, image):
+	'''Carve files from disk image, reusing an earlier extraction if the image is unchanged, return carving record'''
+	fingerprint = image_fingerprint(accession, image)
+	if accession.args.carve_cache is not None: # shared across accessions, keyed by fingerprint
+		cache_dir = os.path.abspath(accession.args.carve_cache)
+		try:
+			os.makedirs(cache_dir)
+		except OSError as exception:
+			if exception.errno != errno.EEXIST:
+				raise
+		key = hashlib.md5(json.dumps(fingerprint, sort_keys=True)).hexdigest()
+		carve_dir = os.path.join(cache_dir, key)
+		# another batch worker may be carving the same image
+		lock = open(carve_dir + '.lock', 'wb')
+		fcntl.flock(lock, fcntl.LOCK_EX)
+	else:
+		carve_dir = os.path.join(accession.report_dir, 'carved_files')
+		lock = None
+	record_file = carve_dir + '.json'
+	try:
+		record = None
+		if os.path.isfile(record_file) and os.path.isdir(carve_dir):
+			with open(record_file, 'rb') as f:
+				record = json.load(f)
+		if record is not None and all(record.get(field) == value for field, value in fingerprint.items()):
+			print("\nReusing files carved from unchanged disk image on %s, saving %.1f seconds and %s of writes." % (
+				record['carved'], record['seconds'], human_size(record['bytes'])))
+			record['reused'] = True
+			accession.carve_stats = record
+			return record
+
+		# image changed or not carved yet
+		if os.path.exists(record_file):
+			os.remove(record_file)
+		if os.path.isdir(carve_dir):
+			shutil.rmtree(carve_dir)
+		started = time.time()
+		partial_dir = carve_dir + '.part'
+		if os.path.isdir(partial_dir):
+			shutil.rmtree(partial_dir)
+		try:
+			num_partitions = carve_files(accession, image, partial_dir)
+		except BaseException:
+			if os.path.isdir(partial_dir):
+				shutil.rmtree(partial_dir)
+			raise
+		os.rename(partial_dir, carve_dir)
+		num_files = 0
+		num_bytes = 0
+		for root, dirs, files in os.walk(carve_dir):
+			for name in files:
+				num_files += 1
+				num_bytes += os.lstat(os.path.join(root, name)).st_size
+		record = dict(fingerprint, image=os.path.abspath(image), path=carve_dir, partitions=num_partitions,
+			files=num_files, bytes=num_bytes, seconds=round(time.time() - started, 3),
+			carved=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+		with open(record_file + '.part', 'wb') as f:
+			json.dump(record, f, indent=2, sort_keys=True)
+		os.rename(record_file + '.part', record_file) # extraction is only reused once its record is complete
+		record['reused'] = False
+		accession.carve_stats = record
+		return record
+	finally:
+		if lock is not None:
+			lock.close()
+
+class BrunnhildeError(Exception):
+	'''Processing of an accession cannot continue'''
+
+class Accession(object):
+	'''Source directory or disk image characterized into its own report directory
 
-		# otherwise write as normal
+	Options are the command line options by name, e.g.
+	Accession('/media/disk', '2017-001', noclam=True, jobs=4).run()
+	Stages are open, scan, ingest, stats, reports and close, in that order.
+	With report_only=True, load replaces scan and ingest.
+	Stage functions take the accession first, e.g. summarize(accession),
+	so accessions can run side by side in threads of one process.
+	'''
+
+	def __init__(self, source, basename, output_dir=None, args=None, **options):
+		if args is None:
+			args = build_parser().parse_args([])
+		else:
+			args = copy.copy(args)
+		for name, value in options.items():
+			if not hasattr(args, name):
+				raise TypeError("Unknown option: %s" % name)
+			setattr(args, name, value)
+		args.source = source
+		args.basename = basename
+		self.args = args
+		self.source = source
+		self.basename = basename
+		if output_dir is None:
+			output_dir = os.getcwd()
+		self.report_dir = os.path.join(output_dir, '%s' % basename)
+		self.csv_dir = os.path.join(self.report_dir, 'csv_reports')
+		self.log_dir = os.path.join(self.report_dir, 'logs')
+		self.bulkext_dir = os.path.join(self.report_dir, 'bulk_extractor')
+		self.virus_log = os.path.join(self.log_dir, 'viruscheck-log.txt')
+		self.virus_results_file = os.path.join(self.log_dir, 'clamd-results.csv')
+		if args.json == True:
+			if args.incremental == True:
+				raise BrunnhildeError("--json cannot be combined with --incremental, whose cache holds csv rows.")
+			self.sf_file = os.path.join(self.report_dir, 'siegfried.json')
+		else:
+			self.sf_file = os.path.join(self.report_dir, 'siegfried.csv')
+		self.html_file = os.path.join(self.report_dir, '%s.html' % basename)
+		self.db_file = os.path.join(self.report_dir, 'siegfried.sqlite')
+		self.cache_stats = None
+		self.carve_stats = None
+		self.sf_command = None
+		self.sf_version = None # siegfried version of an earlier run, with --report-only
+		self.inventory_retaken = None # when --report-only took inventory again, if it did
+		self.html = None
+		self.conn = None
+		self.cursor = None
+		self.source_dir = None # directory scanned, carved_files for disk images
+		self.scan_started = None
+		self.scans = None
+		self.summary = None
+		self.metrics = {'stages': [], 'tools': {}}
+
+	def open(self):
+		'''Create report directories, html report and sqlite db'''
+		# rewriting reports needs an earlier run, checked before anything is created
+		if self.args.report_only == True and not any(os.path.isfile(os.path.join(self.report_dir, name))
+				for name in ['siegfried.sqlite', 'siegfried.csv', 'siegfried.json']):
+			raise BrunnhildeError("No siegfried.sqlite or Siegfried output to report on in %s." % self.report_dir)
+
+		# create directory for reports
+		try:
+			os.makedirs(self.report_dir)
+		except OSError as exception:
+			if exception.errno != errno.EEXIST:
+				raise
+
+		# create subdirectory for CSV reports
+		try:
+			os.makedirs(self.csv_dir)
+		except OSError as exception:
+			if exception.errno != errno.EEXIST:
+				raise
+
+		# create subdirectory for logs if needed
+		if self.args.bulkextractor == False and self.args.noclam == True:
+			pass
 		else:
-			if numline > 1: #aka more rows than just header
-				html.write('\n<table class="table table-striped table-bordered table-condensed">')
-				# generate table
-				for row in r:
-					# write data
-					html.write('\n<tr>')
-					for column in row:
-						html.write('\n<td>' + column + '</td>')
-					html.write('\n</tr>')
-				html.write('\n</table>')
+			try:
+				os.makedirs(self.log_dir)
+			except OSError as exception:
+				if exception.errno != errno.EEXIST:
+					raise
+
+		# create html report, removing pages of an earlier run that it would no longer link to
+		pages_dir = os.path.join(self.report_dir, 'html_pages')
+		if os.path.isdir(pages_dir):
+			shutil.rmtree(pages_dir)
+		if self.args.paginate == True:
+			os.makedirs(pages_dir)
+		self.html = open(self.html_file, 'wb')
+
+		# open sqlite db
+		self.conn = sqlite3.connect(self.db_file, check_same_thread=False) # loaded from the siegfried scan thread, one thread at a time
+		self.conn.text_factory = str  # allows utf-8 data to be stored
+		self.cursor = self.conn.cursor()
+		# single writer and db is rebuilt from siegfried.csv on failure, so trade durability for speed
+		# (the --incremental cache, which can't be rebuilt, is kept in sf_cache.sqlite)
+		self.cursor.execute("PRAGMA journal_mode = MEMORY")
+		self.cursor.execute("PRAGMA synchronous = OFF")
+		self.cursor.execute("PRAGMA cache_size = -65536") # 64 MB
+		self.cursor.execute("PRAGMA temp_store = MEMORY")
+		return self
+
+	def scan(self):
+		'''Carve disk image if needed, then take inventory and run clamav, siegfried and bulk extractor'''
+		self.scan_started = str(datetime.datetime.now()) # get time
+		if self.args.diskimage == True: # source is a disk image
+			with stage(self, 'Carving') as record:
+				carving = carve_cached(self, self.source)
+				self.source_dir = carving['path']
+				if carving['reused'] == True:
+					record['bytes_read'] = min(carve_sample_bytes * 3, os.path.getsize(self.source)) # sampled for fingerprint
+				else:
+					record['bytes_read'] = os.path.getsize(self.source)
+				record['rows'] = carving['files']
+		else: #source is a directory
+			if os.path.isdir(self.source) == False:
+				raise BrunnhildeError("Source is not a Directory. If you're processing a disk image, place '-d' before source.")
+			self.source_dir = self.source
+		with stage(self, 'Inventory') as record:
+			take_inventory(self, self.source_dir) # walk source once for file counts, sizes and tree
+			record['rows'] = count_inventory_files(self)
+		with stage(self, 'Scans') as record:
+			self.scans = run_scans(self, self.source_dir) # run clamav, siegfried and bulk extractor concurrently
+			record['rows'] = count_inventory_files(self)
+		record_scans(self, self.scans)
+		if not self.scans['Siegfried']['ok']:
+			raise BrunnhildeError("Siegfried scan failed. Ending process.")
+		return self.scans
+
+	def ingest(self):
+		'''Load virus check results and bulk extractor pii hits, and group duplicate files'''
+		if 'ClamAV' in self.scans:
+			with stage(self, 'Virus check') as record:
+				if self.scans['ClamAV']['ok']:
+					check_clamav(self, self.source_dir) # check for missed and infected files
+					record['bytes_read'] = os.path.getsize(self.virus_log)
+				elif not keep_processing(self, "\nVirus check failed."):
+					raise BrunnhildeError("Processing stopped after virus check.")
+		if 'Bulk Extractor' in self.scans and self.scans['Bulk Extractor']['ok']:
+			with stage(self, 'PII import') as record:
+				record['rows'], record['bytes_read'] = import_pii(self) # load feature files into pii_hits
+		with stage(self, 'Duplicates') as record:
+			find_duplicates(self) # group duplicate files by size and md5
+			record['rows'] = self.cursor.execute("SELECT COUNT(*) FROM duplicate_groups").fetchone()[0]
+		if self.args.hash_index is not None:
+			with stage(self, 'Hash index') as record:
+				update_hash_index(self, self.source_dir) # check and record hashes in shared index
+				record['rows'] = self.cursor.execute("SELECT COUNT(*) FROM held_elsewhere").fetchone()[0]
+
+	def load(self):
+		'''Load results, provenance and aggregate stats of an earlier run from its report directory, instead of scanning'''
+		provenance, self.summary = load_run(self)
+		self.source_dir = provenance.get('source_dir', self.args.source)
+		self.scan_started = provenance.get('scan_started', 'Unknown')
+		self.scans = {}
+		if self.args.bulkextractor == True: # pii hits were loaded
+			self.scans['Bulk Extractor'] = {'ok': True}
+		return self.summary
+
+	def stats(self):
+		'''Get aggregate statistics and write them to html report'''
+		with stage(self, 'Stats') as record:
+			summary = None
+			if self.args.report_only == True:
+				summary = self.summary # stored by earlier run, if any
+			self.summary = get_stats(self, self.scan_started, summary) # get aggregate stats and write to html file
+			save_run(self, self.summary, self.scan_started, self.source_dir) # for later --report-only runs
+			record['rows'] = self.summary['num_files']
+		return self.summary
+
+	def reports(self):
+		'''Write csv and html reports and tree.txt'''
+		with stage(self, 'Reports') as record:
+			record['rows'] = generate_reports(self) # run sql queries, print to html and csv
+		if 'Bulk Extractor' in self.scans:
+			if self.scans['Bulk Extractor']['ok']:
+				with stage(self, 'PII report') as record:
+					record['rows'] = write_pii(self)
 			else:
-				html.write('\nNone found.')
-		
-		# write link to top
-		html.write('\n<p>(<a href="#top">Return to top</a>)</p>')
+				print("\nBulk Extractor failed. Skipping PII report.")
+		close_html(self.html) # close HTML file tags
+		with stage(self, 'Tree') as record:
+			make_tree(self, self.source_dir) # create tree.txt
+			record['rows'] = self.cursor.execute("SELECT COUNT(*) FROM inventory").fetchone()[0]
+		if self.args.diskimage == True and self.args.removefiles == True and self.args.carve_cache is None and self.args.report_only == False:
+			shutil.rmtree(self.source_dir)
+			os.remove(self.source_dir + '.json')
 
-def close_html():
-	'''Write html closing tags'''
-	html.write('\n</body>')
-	html.write('\n</html>')
-
-def make_tree(source_dir):
-	'''Call tree on source directory and save output to tree.txt'''
-	# create tree report
-	tree_command = "tree -tDhR '%s' > %s" % (source_dir, os.path.join(report_dir, 'tree.txt'))
-	subprocess.call(tree_command, shell=True)
-
-def process_content(source_dir):
-	'''Run through main processing flow on specified directory'''
-	scan_started = str(datetime.datetime.now()) # get time
-	run_siegfried(source_dir) # run siegfried
-	import_csv() # load csv into sqlite db
-	get_stats(source_dir, scan_started) # get aggregate stats and write to html file
-	generate_reports() # run sql queries, print to html and csv
-	close_html() # close HTML file tags
-	make_tree(source_dir) # create tree.txt
-
-
-""" 
-MAIN FLOW 
+	def write_metrics(self):
+		'''Write stage metrics to metrics.json in report directory'''
+		with open(os.path.join(self.report_dir, 'metrics.json'), 'wb') as f:
+			json.dump({'accession': self.basename, 'source': os.path.abspath(self.source), 'scan_started': self.scan_started,
+				'stages': self.metrics['stages'], 'tools': self.metrics['tools'], 'carving': self.carve_stats}, f, indent=2, sort_keys=True)
+
+	def close(self):
+		'''Write metrics, close html report and database connection'''
+		# metrics.json is left as recorded by the scan when only reports are rewritten
+		if self.metrics['stages'] and os.path.isdir(self.report_dir) and self.args.report_only == False: # removed when carving fails
+			self.write_metrics()
+		if self.html is not None:
+			self.html.close()
+			self.html = None
+		if self.conn is not None:
+			self.cursor.close()
+			self.conn.close()
+			self.cursor = None
+			self.conn = None
+
+	def run(self):
+		'''Run all stages, return report directory'''
+		self.open()
+		try:
+			if self.args.report_only == True:
+				self.load()
+			else:
+				self.scan()
+				self.ingest()
+			self.stats()
+			self.reports()
+		finally:
+			self.close()
+		return self.report_dir
+
+
+"""
+MAIN FLOW
 """
 
 # system info
 brunnhilde_version = 'v1.0.0'
-siegfried_version = subprocess.check_output(["sf", "-version"])
-
-# parse arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-b", "--bulkextractor", help="Run Bulk Extractor on source", action="store_true")
-parser.add_argument("-d", "--diskimage", help="Use disk image instead of dir as input", action="store_true")
-parser.add_argument("--hfs", help="Use for raw disk images of HFS disks", action="store_true")
-parser.add_argument("-n", "--noclam", help="Skip ClamScan Virus Check", action="store_true")
-parser.add_argument("-r", "--removefiles", help="Delete 'carved_files' directory when done (disk image input only)", action="store_true")
-parser.add_argument("-t", "--throttle", help="Pause for 1s between Siegfried scans", action="store_true")
-parser.add_argument("-v", "--version", help="Display Brunnhilde version", action="version", version="Brunnhilde %s" % brunnhilde_version)
-parser.add_argument("-z", "--scanarchives", help="Decompress and scan zip, tar, gzip, warc, arc with Siegfried", action="store_true")
-parser.add_argument("source", help="Path to source directory or disk image")
-parser.add_argument("basename", help="Accession number or identifier, used as basename for outputs")
-args = parser.parse_args()
-
-# global variables
-current_dir = os.getcwd()
-basename = args.basename
-report_dir = os.path.join(current_dir, '%s' % basename)
-csv_dir = os.path.join(report_dir, 'csv_reports')
-log_dir = os.path.join(report_dir, 'logs')
-bulkext_dir = os.path.join(report_dir, 'bulk_extractor')
-sf_file = os.path.join(report_dir, 'siegfried.csv')
-
-# create directory for reports
-try:
-	os.makedirs(report_dir)
-except OSError as exception:
-	if exception.errno != errno.EEXIST:
-		raise
-	
-# create subdirectory for CSV reports
-try:
-	os.makedirs(csv_dir)
-except OSError as exception:
-	if exception.errno != errno.EEXIST:
-		raise
-
-# create subdirectory for logs if needed
-if args.bulkextractor == False and args.noclam == True:
-	pass
-else:
+
+def build_parser():
+	'''Build command line argument parser'''
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-b", "--bulkextractor", help="Run Bulk Extractor on source", action="store_true")
+	parser.add_argument("--batch", help="Process each accession listed in csv manifest of source, basename, options", metavar="MANIFEST")
+	parser.add_argument("--carve-cache", help="Keep files carved from disk images in this directory, reused while an image is unchanged", metavar="DIR")
+	parser.add_argument("--carve-jobs", help="Number of partitions of a disk image carved at once (default: 1)", type=int, default=1)
+	parser.add_argument("--clamd", help="Scan with clamd listening on this local socket instead of clamscan", metavar="SOCKET")
+	parser.add_argument("-d", "--diskimage", help="Use disk image instead of dir as input", action="store_true")
+	parser.add_argument("--hash-index", help="Check and record file hashes in this sqlite db shared across accessions", metavar="DB")
+	parser.add_argument("--hfs", help="Use for raw disk images of HFS disks", action="store_true")
+	parser.add_argument("-i", "--incremental", help="Reuse cached Siegfried results for files unchanged since last run", action="store_true")
+	parser.add_argument("-j", "--jobs", help="Number of parallel Siegfried workers (default: 1)", type=int, default=1)
+	parser.add_argument("--json", help="Load Siegfried json output, which can include several identifiers (saved as siegfried.json)", action="store_true")
+	parser.add_argument("-n", "--noclam", help="Skip ClamScan Virus Check", action="store_true")
+	parser.add_argument("--paginate", help="Cap html report sections at a preview, writing full tables to paged files in html_pages", action="store_true")
+	parser.add_argument("--page-size", help="Rows per page with --paginate (default: 1000)", type=int, default=1000)
+	parser.add_argument("--preview", help="Rows shown per section of html report with --paginate (default: 100)", type=int, default=100)
+	parser.add_argument("--pii-rows", help="PII hits listed in html report, all are in piiHits.csv (default: 1000)", type=int, default=1000)
+	parser.add_argument("--profile", help="Write cProfile data for each Python stage to profiles directory", action="store_true")
+	parser.add_argument("-p", "--parallel", help="Number of scans (ClamAV, Siegfried, Bulk Extractor) to run at once (default: 3)", type=int, default=3)
+	parser.add_argument("-r", "--removefiles", help="Delete 'carved_files' directory when done (disk image input only)", action="store_true")
+	parser.add_argument("--report-only", help="Rewrite reports from siegfried.sqlite (or siegfried.csv) of an earlier run, without scanning", action="store_true")
+	parser.add_argument("-s", "--stream", help="Load Siegfried output into database while scan runs", action="store_true")
+	parser.add_argument("-t", "--throttle", help="Pause for 1s between Siegfried scans", action="store_true")
+	parser.add_argument("-v", "--version", help="Display Brunnhilde version", action="version", version="Brunnhilde %s" % brunnhilde_version)
+	parser.add_argument("--watch", help="Watch drop directory, processing each accession copied into it (see also --job-options, --quiet-period, --poll-interval, --queue, --status)", metavar="DIR")
+	parser.add_argument("--job-options", help="Options for each accession found by --watch, as on the command line (e.g. --job-options=\"-n -j 4\")", default="")
+	parser.add_argument("--quiet-period", help="Seconds an accession's size and mtime must stay unchanged before --watch queues it (default: 300)", type=float, default=300)
+	parser.add_argument("--poll-interval", help="Seconds between scans of the --watch drop directory (default: 30)", type=float, default=30)
+	parser.add_argument("--queue", help="Sqlite db of --watch jobs, kept across restarts (default: brunnhilde-queue.sqlite)", default="brunnhilde-queue.sqlite", metavar="DB")
+	parser.add_argument("--status", help="JSON status file written by --watch (default: watch-status.json)", default="watch-status.json", metavar="FILE")
+	parser.add_argument("-w", "--workers", help="Number of accessions processed at once with --batch or --watch (default: 2)", type=int, default=2)
+	parser.add_argument("-y", "--yes", help="Keep processing without prompting when virus check finds problems", action="store_true")
+	parser.add_argument("-z", "--scanarchives", help="Decompress and scan zip, tar, gzip, warc, arc with Siegfried", action="store_true")
+	parser.add_argument("source", help="Path to source directory or disk image", nargs='?')
+	parser.add_argument("basename", help="Accession number or identifier, used as basename for outputs", nargs='?')
+	return parser
+
+def process_accession(accession_args):
+	'''Characterize one source and write its reports'''
+	report_dir = Accession(accession_args.source, accession_args.basename, args=accession_args).run()
+	print("\nProcess complete. Reports in %s." % report_dir)
+	return report_dir
+
+def read_manifest(manifest):
+	'''Read batch manifest rows of source, basename and options, each with the reason it can't be run or an empty string'''
+	accessions = []
+	first_line = {} # basename: manifest line using it first
+	with open(manifest, 'rb') as f:
+		reader = csv.reader(f)
+		for row in reader:
+			if not row or row[0].startswith('#') or row[0] == 'source': # skip blank, comment and header rows
+				continue
+			basename = row[1].strip() if len(row) > 1 else ''
+			options = row[2] if len(row) > 2 else ''
+			error = ''
+			if row[0].strip() == '' or basename == '':
+				error = "Manifest line %s needs a source and a basename." % reader.line_num
+			elif basename in first_line: # both would write the same reports and log
+				error = "Basename %s is already used on manifest line %s." % (basename, first_line[basename])
+			else:
+				first_line[basename] = reader.line_num
+			accessions.append((row[0], basename, options, error))
+	return accessions
+
+def run_batch_accession(accession):
+	'''Process one batch accession in a worker process, return its summary row'''
+	position, (source, basename, options) = accession
+	started = time.time()
+	result = {'position': position, 'source': source, 'basename': basename, 'options': options, 'status': 'ok', 'error': '', 'report': '',
+		'started': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+	# send this accession's output, including from external tools, to its own log
+	log_path = os.path.join(os.getcwd(), 'batch_logs', '%s.txt' % basename)
+	log = open(log_path, 'wb')
+	sys.stdout.flush()
+	sys.stderr.flush()
+	os.dup2(log.fileno(), 1)
+	os.dup2(log.fileno(), 2)
+	try:
+		accession_args = build_parser().parse_args(shlex.split(options) + [source, basename])
+		accession_args.yes = True # no one to answer prompts in batch mode
+		result['report'] = process_accession(accession_args)
+	except BrunnhildeError as e:
+		result['status'] = 'failed'
+		result['error'] = str(e)
+		print("\n%s" % e)
+	except SystemExit: # argparse explains itself before exiting
+		result['status'] = 'failed'
+	except BaseException as e:
+		result['status'] = 'failed'
+		result['error'] = "%s: %s" % (type(e).__name__, e)
+		traceback.print_exc()
+	sys.stdout.flush()
+	sys.stderr.flush()
+	log.close()
+	if result['status'] == 'failed' and result['error'] == '':
+		with open(log_path, 'rb') as f:
+			lines = [line.strip() for line in f if line.strip()]
+		result['error'] = lines[-1] if lines else 'Exited'
+	result['seconds'] = round(time.time() - started, 1)
+	result['log'] = log_path
+	return result
+
+def run_batch(manifest, num_workers):
+	'''Process accessions in manifest with a pool of worker processes, write batch summary'''
+	accessions = read_manifest(manifest)
 	try:
-		os.makedirs(log_dir)
+		os.makedirs(os.path.join(os.getcwd(), 'batch_logs'))
 	except OSError as exception:
 		if exception.errno != errno.EEXIST:
 			raise
+	started = time.time()
+	# rows that can't be run are recorded as failed without stopping the rest
+	results = []
+	jobs = []
+	for position, (source, basename, options, error) in enumerate(accessions):
+		if error:
+			print("  %s: not run. %s" % (basename or source, error))
+			results.append({'position': position, 'source': source, 'basename': basename, 'options': options, 'status': 'failed',
+				'error': error, 'report': '', 'started': '', 'seconds': 0, 'log': ''})
+		else:
+			jobs.append((position, (source, basename, options)))
+	print("\nProcessing %s accessions from %s with %s workers." % (len(jobs), manifest, num_workers))
+	# workers are forked from this process so tool versions are only probed once,
+	# and each handles a single accession so module state never leaks between them
+	pool = multiprocessing.Pool(max(num_workers, 1), maxtasksperchild=1)
+	for result in pool.imap_unordered(run_batch_accession, jobs):
+		print("  %s: %s in %.1f seconds %s" % (result['basename'], result['status'], result['seconds'], result['error']))
+		results.append(result)
+	pool.close()
+	pool.join()
+
+	summary_path = os.path.join(os.getcwd(), 'batch-summary.csv')
+	with open(summary_path, 'wb') as summary:
+		summary_writer = csv.writer(summary)
+		summary_writer.writerow(['Basename', 'Source', 'Options', 'Status', 'Started', 'Seconds', 'Error', 'Report', 'Log'])
+		for result in sorted(results, key=lambda result: result['position']):
+			summary_writer.writerow([result['basename'], result['source'], result['options'], result['status'], result['started'],
+				result['seconds'], result['error'], result['report'], result['log']])
+	failed = len([result for result in results if result['status'] != 'ok'])
+	print("\nBatch complete in %.1f seconds: %s succeeded, %s failed. Summary in %s." % (time.time() - started, len(results) - failed, failed, summary_path))
+	return failed
+
+def drop_signature(path):
+	'''Return total file size, latest mtime and number of entries under dropped path, or None if it changed while being read'''
+	try:
+		st = os.lstat(path)
+		if not stat.S_ISDIR(st.st_mode): # disk image
+			return (st.st_size, st.st_mtime, 1)
+		size = 0
+		mtime = st.st_mtime
+		num_entries = 0
+		directories = [path]
+		while directories:
+			directory = directories.pop()
+			for name, entry_type, entry_size, entry_mtime in list_entries(directory):
+				num_entries += 1
+				mtime = max(mtime, entry_mtime)
+				if entry_type == 'file':
+					size += entry_size
+				elif entry_type == 'dir':
+					directories.append(os.path.join(directory, name))
+		return (size, mtime, num_entries)
+	except OSError: # entry removed or renamed mid-copy
+		return None
+
+class JobQueue(object):
+	'''Accessions found by --watch, queued and processed in order, kept in a sqlite db so they survive restarts'''
+
+	def __init__(self, db_file):
+		self.conn = sqlite3.connect(db_file)
+		self.conn.text_factory = str
+		self.conn.execute("PRAGMA journal_mode = WAL") # status can be read while the service writes
+		self.conn.execute("PRAGMA busy_timeout = %d" % hash_index_timeout)
+		self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (job_id integer primary key, source text, basename text, options text, "
+			"size integer, mtime real, entries integer, status text, found real, queued real, started real, finished real, "
+			"error text, report text, log text)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, job_id)")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_source ON jobs (source, job_id)")
+		self.conn.commit()
+
+	def recover(self):
+		'''Queue again jobs left running when the service last stopped, return how many'''
+		cursor = self.conn.execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'")
+		self.conn.commit()
+		return cursor.rowcount
+
+	def last_signature(self, source):
+		'''Return (size, mtime, entries) of latest job for source, or None'''
+		return self.conn.execute("SELECT size, mtime, entries FROM jobs WHERE source = ? ORDER BY job_id DESC LIMIT 1", (source,)).fetchone()
+
+	def enqueue(self, source, basename, options, signature, found):
+		'''Add job for source, return its id'''
+		cursor = self.conn.execute("INSERT INTO jobs (source, basename, options, size, mtime, entries, status, found, queued) "
+			"VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)", (source, basename, options) + tuple(signature) + (found, time.time()))
+		self.conn.commit()
+		return cursor.lastrowid
+
+	def start_next(self):
+		'''Mark oldest queued job as running, return (job_id, source, basename, options) or None'''
+		# a source changed while its job runs waits for that job, since both would write the same reports and log
+		job = self.conn.execute("SELECT job_id, source, basename, options FROM jobs WHERE status = 'queued' "
+			"AND source NOT IN (SELECT source FROM jobs WHERE status = 'running') ORDER BY job_id LIMIT 1").fetchone()
+		if job is not None:
+			self.conn.execute("UPDATE jobs SET status = 'running', started = ? WHERE job_id = ?", (time.time(), job[0]))
+			self.conn.commit()
+		return job
+
+	def finish(self, result):
+		'''Record result of job returned by run_batch_accession'''
+		status = 'done' if result['status'] == 'ok' else 'failed'
+		self.conn.execute("UPDATE jobs SET status = ?, finished = ?, error = ?, report = ?, log = ? WHERE job_id = ?",
+			(status, time.time(), result['error'], result['report'], result['log'], result['position']))
+		self.conn.commit()
+
+	def status(self, recent=20):
+		'''Return job counts by status, queue depth, running jobs and latency of recently finished jobs'''
+		now = time.time()
+		counts = dict((status, 0) for status in ['queued', 'running', 'done', 'failed'])
+		counts.update(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+		running = [{'job_id': job_id, 'basename': basename, 'source': source, 'started': status_time(started),
+			'running_seconds': round(now - started, 1)} for job_id, basename, source, started in
+			self.conn.execute("SELECT job_id, basename, source, started FROM jobs WHERE status = 'running' ORDER BY job_id")]
+		finished = []
+		for row in self.conn.execute("SELECT job_id, basename, source, status, found, queued, started, finished, error, report, log "
+				"FROM jobs WHERE status IN ('done', 'failed') ORDER BY finished DESC LIMIT ?", (recent,)):
+			job_id, basename, source, status, found, queued, started, finished_at, error, report, log = row
+			finished.append({'job_id': job_id, 'basename': basename, 'source': source, 'status': status,
+				'found': status_time(found), 'queued': status_time(queued), 'started': status_time(started), 'finished': status_time(finished_at),
+				'quiet_seconds': round(queued - found, 1), # waiting for copying to finish
+				'wait_seconds': round(started - queued, 1), # waiting for a worker
+				'run_seconds': round(finished_at - started, 1),
+				'latency_seconds': round(finished_at - found, 1), # from first seen to reports written
+				'error': error, 'report': report, 'log': log})
+		latencies = [job['latency_seconds'] for job in finished]
+		return {'queue_depth': counts['queued'], 'jobs': counts, 'running': running, 'recent': finished,
+			'recent_latency_seconds': {'mean': round(sum(latencies) / len(latencies), 1) if latencies else None,
+				'max': max(latencies) if latencies else None}}
+
+	def close(self):
+		'''Close queue db'''
+		self.conn.close()
 
-# create html report
-temp_html = os.path.join(report_dir, 'temp.html')
-html = open(temp_html, 'wb')
+def status_time(timestamp):
+	'''Format epoch time for status file'''
+	if timestamp is None:
+		return None
+	return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
-# open sqlite db
-db = os.path.join(report_dir, 'siegfried.sqlite')
-conn = sqlite3.connect(db)
-conn.text_factory = str  # allows utf-8 data to be stored
-cursor = conn.cursor()
+def write_status(path, status):
+	'''Replace status file with status, so readers never see it half-written'''
+	with open(path + '.part', 'wb') as f:
+		json.dump(status, f, indent=2, sort_keys=True)
+	os.rename(path + '.part', path)
 
-# characterize source
-if args.diskimage == True: # source is a disk image
-	# make tempdir
-	tempdir = os.path.join(report_dir, 'carved_files')
+def run_watch_job(job, connection):
+	'''Run one --watch job in a worker process, sending its result back over connection'''
+	# leave stopping to the watch service, which kills the job's process group, tools included
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	os.setpgrp()
+	connection.send(run_batch_accession(job))
+	connection.close()
+
+def finished_watch_jobs(running):
+	'''Remove jobs whose workers have finished from running, return their results'''
+	results = []
+	for job_id, (process, connection, basename, started) in list(running.items()):
+		result = None
+		if connection.poll():
+			try:
+				result = connection.recv()
+			except EOFError: # exited without a result
+				pass
+		elif process.is_alive():
+			continue
+		if result is None:
+			result = {'position': job_id, 'basename': basename, 'status': 'failed', 'report': '',
+				'error': "Worker exited with status %s" % process.exitcode, 'seconds': round(time.time() - started, 1),
+				'log': os.path.join(os.getcwd(), 'batch_logs', '%s.txt' % basename)}
+		process.join()
+		connection.close()
+		del running[job_id]
+		results.append(result)
+	return results
+
+def kill_watch_job(process):
+	'''Kill worker process of a --watch job and the tools it started'''
+	for kill in [os.killpg, os.kill]: # the worker may not have its own group yet
+		try:
+			kill(process.pid, signal.SIGKILL)
+		except OSError as exception:
+			if exception.errno != errno.ESRCH:
+				raise
+	process.join()
+
+def stop_service(signum, frame):
+	'''Stop watch service on SIGTERM as on Ctrl-C'''
+	raise KeyboardInterrupt
+
+def watch(watch_args):
+	'''Poll drop directory for accessions, queue each once copying into it has finished, and process the queue with a pool of workers'''
+	drop_dir = os.path.abspath(watch_args.watch)
+	if not os.path.isdir(drop_dir):
+		raise BrunnhildeError("Drop directory %s is not a directory." % drop_dir)
+	if os.path.join(os.getcwd(), '').startswith(os.path.join(drop_dir, '')):
+		raise BrunnhildeError("Run --watch from outside the drop directory, so reports are not picked up as accessions.")
+	# options of each accession, checked now rather than failing every job
+	job_args = build_parser().parse_args(shlex.split(watch_args.job_options) + ['source', 'basename'])
+	for name in ['batch', 'watch', 'report_only']:
+		if getattr(job_args, name) not in [None, False]:
+			raise BrunnhildeError("--%s cannot be used in --job-options." % name.replace('_', '-'))
 	try:
-		os.makedirs(tempdir)
+		os.makedirs(os.path.join(os.getcwd(), 'batch_logs'))
 	except OSError as exception:
 		if exception.errno != errno.EEXIST:
 			raise
 
-	# export disk image contents to tempdir
-	if args.hfs == True: # hfs disks
-		carvefiles = "bash /usr/share/hfsexplorer/bin/unhfs.sh -o '%s' '%s'" % (tempdir, args.source)
-		print("\nAttempting to carve files from disk image using HFS Explorer.")
-		try:
-			subprocess.call(carvefiles, shell=True)
-			print("\nFile carving successful.")
-		except subprocess.CalledProcessError as e:
-			print(e.output)
-			print("\nBrunnhilde was unable to export files from disk image. Ending process.")
-			shutil.rmtree(report_dir)
-			sys.exit()
-
-	else: # non-hfs disks (note: no UDF support yet)
-		carvefiles = ['tsk_recover', '-a', args.source, tempdir]
-		print("\nAttempting to carve files from disk image using tsk_recover.")
-		try:
-			subprocess.check_output(carvefiles)
-			print("\nFile carving successful.")
-		except subprocess.CalledProcessError as e:
-			print(e.output)
-			print("\nBrunnhilde was unable to export files from disk image. Ending process.")
-			shutil.rmtree(report_dir)
-			sys.exit()
-
-	# process tempdir
-	if args.noclam == False: # run clamAV virus check unless specified otherwise
-		run_clamav(tempdir)
-	process_content(tempdir)
-	if args.bulkextractor == True: # bulk extractor option is chosen
-		run_bulkext(tempdir)
-		write_html('Personally Identifiable Information (PII)', '%s/pii.txt' % bulkext_dir, '\t')
-	if args.removefiles == True:
-		shutil.rmtree(tempdir)
-
-
-else: #source is a directory
-	if os.path.isdir(args.source) == False:
-		print("\nSource is not a Directory. If you're processing a disk image, place '-d' before source.")
-		sys.exit()
-	if args.noclam == False: # run clamAV virus check unless specified otherwise
-		run_clamav(args.source)
-	process_content(args.source)
-	if args.bulkextractor == True: # bulk extractor option is chosen
-		run_bulkext(args.source)
-		write_html('Personally Identifiable Information (PII)', '%s/pii.txt' % bulkext_dir, '\t')
-
-# close HTML file
-html.close()
-
-# write new html file, with hrefs for PRONOM IDs
-new_html = os.path.join(report_dir, '%s.html' % basename)
-with open(temp_html, 'rb') as in_file:
-	with open(new_html, 'wb') as out_file:
-		for line in in_file:
-			if line.startswith('<td>x-fmt/') or line.startswith('<td>fmt/'):
-				puid = line.replace('<td>', '')
-				puid = puid.replace('</td>', '')
-				newline = '<td><a href="http://apps.nationalarchives.gov.uk/PRONOM/%s" target="_blank">%s</a></td>' % (puid, puid)
-				out_file.write(newline)
-			else:
-				out_file.write(line)
+	queue = JobQueue(watch_args.queue)
+	recovered = queue.recover()
+	print("\nWatching %s for accessions with %s workers (quiet period %s seconds, polling every %s seconds)." % (
+		drop_dir, watch_args.workers, watch_args.quiet_period, watch_args.poll_interval))
+	if recovered > 0:
+		print("Queued again %s jobs interrupted when the service last stopped." % recovered)
+
+	siegfried_version() # probe before forking workers, so they share the result
+	signal.signal(signal.SIGTERM, stop_service)
+	running = {} # job_id: (worker process, connection to it, basename, time started)
+	waiting = {} # path: (signature, time first seen with it, time first seen at all)
+	settled = set() # paths queued or processed as they are now
+	try:
+		while True:
+			# find dropped accessions that have stopped changing
+			now = time.time()
+			present = set()
+			for name, entry_type, size, mtime in list_entries(drop_dir):
+				if name.startswith('.'): # hidden and partial files of copying tools
+					continue
+				if entry_type != 'dir' and not (entry_type == 'file' and job_args.diskimage == True):
+					continue
+				path = os.path.join(drop_dir, name)
+				present.add(path)
+				signature = drop_signature(path)
+				previous = waiting.get(path)
+				if signature is None or previous is None or previous[0] != signature:
+					waiting[path] = (signature, now, previous[2] if previous is not None else now)
+					settled.discard(path)
+					continue
+				if path in settled or now - previous[1] < watch_args.quiet_period:
+					continue
+				last = queue.last_signature(path)
+				if last is None or tuple(last) != signature: # not already queued or processed as it is
+					job_id = queue.enqueue(path, name, watch_args.job_options, signature, previous[2])
+					print("  queued %s as job %s" % (name, job_id))
+				settled.add(path)
+			for path in list(waiting):
+				if path not in present: # moved away or deleted
+					del waiting[path]
+					settled.discard(path)
 
-# remove temp html file
-os.remove(temp_html)
+			# hand queued jobs to free workers
+			while len(running) < max(watch_args.workers, 1):
+				job = queue.start_next()
+				if job is None:
+					break
+				job_id, source, basename, options = job
+				receiver, sender = multiprocessing.Pipe(False)
+				process = multiprocessing.Process(target=run_watch_job, args=((job_id, (source, basename, options)), sender))
+				process.start()
+				sender.close()
+				running[job_id] = (process, receiver, basename, time.time())
 
-# close database connections
-cursor.close()
-conn.close()
+			# record finished jobs, waking early when one finishes
+			deadline = time.time() + watch_args.poll_interval
+			while True:
+				status = queue.status()
+				status.update({'updated': status_time(time.time()), 'drop_dir': drop_dir, 'workers': watch_args.workers,
+					'quiet_period': watch_args.quiet_period, 'poll_interval': watch_args.poll_interval,
+					'waiting': [{'source': path, 'unchanged_seconds': round(time.time() - since, 1)}
+						for path, (signature, since, found) in sorted(waiting.items()) if path not in settled]})
+				write_status(watch_args.status, status)
+				results = finished_watch_jobs(running)
+				while not results and time.time() < deadline:
+					time.sleep(min(0.2, max(deadline - time.time(), 0)))
+					results = finished_watch_jobs(running)
+				if not results:
+					break
+				for result in results:
+					queue.finish(result)
+					print("  %s: %s in %.1f seconds %s" % (result['basename'], result['status'], result['seconds'], result['error']))
+				if len(running) < max(watch_args.workers, 1):
+					break # start next job
+	except KeyboardInterrupt:
+		print("\nStopping. Running jobs will be queued again on restart.")
+	finally:
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		signal.signal(signal.SIGINT, signal.SIG_IGN) # finish stopping workers even if Ctrl-C is pressed again
+		for process, connection, basename, started in running.values():
+			kill_watch_job(process)
+			connection.close()
+		queue.close()
+
+def main():
+	'''Parse arguments and process a single accession, a batch, or accessions dropped into a watched directory'''
+	parser = build_parser()
+	main_args = parser.parse_args()
+	if main_args.batch is None and main_args.watch is None and (main_args.source is None or main_args.basename is None):
+		parser.error("source and basename are required unless --batch or --watch is used")
+	if main_args.watch is not None:
+		try:
+			watch(main_args)
+		except BrunnhildeError as e:
+			print("\n%s" % e)
+			sys.exit(1)
+	elif main_args.batch is not None:
+		siegfried_version() # probe before forking workers, so they share the result
+		if run_batch(main_args.batch, main_args.workers) > 0:
+			sys.exit(1)
+	else:
+		try:
+			process_accession(main_args)
+		except BrunnhildeError as e:
+			print("\n%s" % e)
+			sys.exit(1)
 
-print("\nProcess complete. Reports in %s." % report_dir)
+if __name__ == '__main__':
+	main()